@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# Benchmark mailnex commands against a stand-in IMAP server.
+#
+# Runs the commands below the way the interactive prompt would, and times
+# each step. Output is discarded; what's measured is the time to the next
+# prompt.
+#
+#   open            folder open (connect, login, select, unseen search)
+#   headers         page through the whole mailbox with headers and z
+#   headers-cached  the same again, now from the message cache
+#   findrefs        findrefs 1-$
+#   index           index the mailbox for search (needs python-xapian)
+#   search          a few searches of the index (needs python-xapian)
+#   attachments     saveAttachments on messages that have attachments
+#   flags           flag/unflag everything, and read/unread a range
+#
+# By default the server is imapsim.py's simulated server with a synthetic
+# mailbox of --count messages. --replay serves a log recorded by imapsim.py
+# (or by --record here) instead, and --upstream goes to a real server through
+# the recorder. With --upstream, the flags step changes the real mailbox, so
+# it only runs with --write.
+#
+# Each step reports its best wall time over --runs runs, along with the
+# per-command profile of that run (time waiting on the server, parsing,
+# round trips, and bytes; see the stats command).
+#
+# Run from the top of the source tree:
+#
+#   python3 experiments/imap-bench.py [--count N] [--latency MS] [--runs N]
+#           [--steps open,headers,...] [--output results.json]
+#           [--compare old.json [--threshold 1.2]]
+#
+# --output writes the results as JSON. --compare prints each step's change
+# against an earlier results file and exits non-zero if any got slower than
+# the threshold ratio, so it can be used as a regression check.
+
+import os
+import io
+import sys
+import json
+import time
+import getpass
+import argparse
+import tempfile
+import platform
+import datetime
+import contextlib
+import subprocess
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import imapsim
+
+STEPS = ["open", "headers", "headers-cached", "findrefs", "index", "search", "attachments", "flags"]
+
+# Searches run by the search step
+SEARCHES = ["budget", "meeting report", "release OR deploy"]
+
+class Bench(object):
+    def __init__(self, args, url, attachmentMessages):
+        object.__init__(self)
+        self.args = args
+        self.url = url
+        self.attachmentMessages = attachmentMessages
+    def commands(self, step, C, rundir):
+        """Return the command lines for a step, or a reason to skip it"""
+        args = self.args
+        if step == "open":
+            return ["folder " + self.url]
+        if not C.connection:
+            return "no connection"
+        if step in ("headers", "headers-cached"):
+            pages = max(1, (C.lastMessage + args.rows - 1) // args.rows)
+            return ["headers 1"] + ["z"] * (pages - 1)
+        if step == "findrefs":
+            return ["findrefs 1-$"]
+        if step in ("index", "search"):
+            from mailnex import mailnex
+            if not mailnex.haveXapian:
+                return "python-xapian isn't installed"
+            if step == "index":
+                return ["index"]
+            return ["search " + s for s in SEARCHES]
+        if step == "attachments":
+            if not self.attachmentMessages:
+                return "no messages with attachments"
+            return ["saveAttachments {} {}".format(" ".join(map(str, self.attachmentMessages)), os.path.join(rundir, "attachments"))]
+        if step == "flags":
+            if args.upstream and not args.write:
+                return "would change a real mailbox; use --write"
+            last = min(C.lastMessage, 100)
+            return ["flag 1-$", "unflag 1-$", "unread 1-{}".format(last), "read 1-{}".format(last)]
+        raise ValueError("unknown step {}".format(step))
+
+@contextlib.contextmanager
+def captured(f):
+    """Send everything written to stdout to file f.
+
+    Done at the file descriptor level, since some commands print to the
+    sys.stdout that was current when mailnex was imported.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    os.dup2(f.fileno(), 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+async def runOnce(bench, steps, rundir):
+    """Run the steps in a fresh session; returns {step: result}"""
+    import anyio
+    import blessings
+    from mailnex import mailnex, trace
+    results = {}
+    async with anyio.create_task_group() as tg:
+        # Set up as interact() does, minus the terminal
+        cmd = mailnex.Cmd(prompt="bench> ")
+        C = mailnex.Context()
+        C.dbpath = os.path.join(rundir, "searchdb")
+        C.lastcommand = ""
+        C.printInfo = print
+        C.printWarning = print
+        C.printError = print
+        cmd.C = C
+        options = mailnex.getOptionsSet()
+        C.settings = options
+        options.watch("debug", lambda opt: trace.configure(opt.value))
+        C.t = blessings.Terminal(stream=io.StringIO())
+        mailnex.setupContext(C)
+        mailnex.startBackground(cmd, tg)
+        with open(os.path.join(rundir, "setup.out"), "w") as f, captured(f):
+            for line in ["set headlinerows={}".format(bench.args.rows), "set noheaders", "set debug=exception"]:
+                await cmd.onecmd(line)
+        for step in steps:
+            lines = bench.commands(step, C, rundir)
+            if isinstance(lines, str):
+                results[step] = {"skipped": lines}
+                continue
+            total = [0] * 6
+            outname = os.path.join(rundir, "{}.out".format(step))
+            with open(outname, "w") as f, captured(f):
+                for line in lines:
+                    await cmd.onecmd(line)
+                    total = [a + b for a, b in zip(total, C.profiler.last[1])]
+                    # Let background tasks (e.g. the IDLE poller) run, as
+                    # they would between prompts
+                    await anyio.sleep(0)
+            with open(outname) as f:
+                output = f.read()
+            wall, parse, wait, trips, bytesIn, bytesOut = total
+            results[step] = {
+                    "commands": len(lines),
+                    "wall": wall,
+                    "server": wait,
+                    "parse": parse,
+                    "trips": trips,
+                    "in": bytesIn,
+                    "out": bytesOut,
+                    }
+            if "Traceback (most recent call last)" in output:
+                results[step]["error"] = True
+        c = C.connection
+        if c:
+            if c.poller:
+                c.poller.stop()
+            C.pool.release(c)
+            C.connection = None
+        C.pool.closeAll()
+        tg.cancel_scope.cancel()
+    return results
+
+def summarize(runs):
+    """Combine per-run results into one entry per step"""
+    res = {}
+    for step in runs[0]:
+        entries = [r[step] for r in runs]
+        if "skipped" in entries[0]:
+            res[step] = entries[0]
+            continue
+        walls = sorted(e["wall"] for e in entries)
+        best = min(entries, key=lambda e: e["wall"])
+        res[step] = dict(best)
+        del res[step]["wall"]
+        res[step]["best"] = walls[0]
+        res[step]["median"] = walls[len(walls) // 2]
+        res[step]["runs"] = [e["wall"] for e in entries]
+        if any(e.get("error") for e in entries):
+            res[step]["error"] = True
+    return res
+
+def report(results, out=sys.stdout):
+    out.write("{:15} {:>5} {:>9} {:>9} {:>8} {:>8} {:>7} {:>10} {:>9}\n".format(
+        "step", "cmds", "best ms", "med ms", "server", "parse", "trips", "in", "out"))
+    for step, r in results["steps"].items():
+        if "skipped" in r:
+            out.write("{:15} skipped: {}\n".format(step, r["skipped"]))
+            continue
+        out.write("{:15} {:5} {:9.1f} {:9.1f} {:7.0f}% {:7.0f}% {:7} {:10} {:9}{}\n".format(
+            step,
+            r["commands"],
+            r["best"] * 1000,
+            r["median"] * 1000,
+            100 * r["server"] / r["best"] if r["best"] else 0,
+            100 * r["parse"] / r["best"] if r["best"] else 0,
+            r["trips"],
+            r["in"],
+            r["out"],
+            "  (errors; see the step's .out file with --keep)" if r.get("error") else "",
+            ))
+
+def compare(results, oldfile, threshold, out=sys.stdout):
+    """Print changes against older results; return whether any step regressed"""
+    with open(oldfile) as f:
+        old = json.load(f)
+    regressed = False
+    out.write("\nAgainst {} ({}, {}):\n".format(oldfile, old.get("when"), old.get("commit")))
+    for step, r in results["steps"].items():
+        o = old["steps"].get(step)
+        if "skipped" in r or not o or "skipped" in o:
+            continue
+        ratio = r["best"] / o["best"] if o["best"] else float("inf")
+        mark = ""
+        if ratio > threshold:
+            mark = "  REGRESSION"
+            regressed = True
+        out.write("  {:15} {:9.1f} -> {:9.1f} ms  x{:.2f}{}\n".format(step, o["best"] * 1000, r["best"] * 1000, ratio, mark))
+    return regressed
+
+def gitCommit():
+    try:
+        res = subprocess.run(["git", "-C", TOP, "describe", "--always", "--dirty"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return res.stdout.decode().strip()
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark mailnex against a stand-in IMAP server")
+    parser.add_argument("--count", type=int, default=2000, help="messages in the synthetic INBOX")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds the simulated server adds to each round trip")
+    parser.add_argument("--no-compress", action="store_true", help="don't offer COMPRESS=DEFLATE")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=50, help="headlinerows for the headers steps")
+    parser.add_argument("--steps", default=",".join(STEPS), help="comma separated steps to run; open is always run first")
+    parser.add_argument("--replay", metavar="LOG", help="serve a recorded log instead of a synthetic mailbox")
+    parser.add_argument("--upstream", metavar="HOST:PORT", help="use a real server (through the recorder)")
+    parser.add_argument("--tls", action="store_true", help="connect to the upstream server with TLS")
+    parser.add_argument("--user", default=None, help="user name for the upstream server")
+    parser.add_argument("--box", default="INBOX")
+    parser.add_argument("--write", action="store_true", help="allow steps that change the upstream mailbox")
+    parser.add_argument("--record", metavar="LOG", help="record the session's traffic")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against earlier results")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory (command output, saved attachments)")
+    args = parser.parse_args()
+    steps = [s for s in args.steps.split(",") if s]
+    for s in steps:
+        if s not in STEPS:
+            parser.error("unknown step {}".format(s))
+    if "open" in steps:
+        steps.remove("open")
+    steps.insert(0, "open")
+
+    scratch = tempfile.mkdtemp(prefix="imap-bench.")
+    # mailnex works out its cache and data paths on import; keep it out of
+    # the user's
+    for name in ("XDG_CACHE_HOME", "XDG_DATA_HOME", "XDG_CONFIG_HOME"):
+        os.environ[name] = os.path.join(scratch, name.lower())
+    import anyio
+
+    attachmentMessages = []
+    user = "bench"
+    password = "bench"
+    snapshot = None
+    if args.upstream:
+        host, _, port = args.upstream.rpartition(":")
+        user = args.user or getpass.getuser()
+        password = os.environ.get("MAILNEX_BENCH_PASSWORD") or getpass.getpass("Password for {}@{}: ".format(user, host))
+        server = imapsim.RecordServer(("127.0.0.1", 0), (host, int(port)), args.tls, args.record or os.path.join(scratch, "session.log"))
+        port = imapsim.startServer(server)
+        kind = "upstream"
+    else:
+        start = time.perf_counter()
+        mailboxes = imapsim.makeMailboxes(args.count, args.seed)
+        sys.stderr.write("Generated {} messages in {:.2f}s\n".format(sum(len(b.messages) for b in mailboxes.values()), time.perf_counter() - start))
+        if args.box in mailboxes:
+            attachmentMessages = [i for i, m in enumerate(mailboxes[args.box].messages, 1) if m.attachments][:20]
+        if args.replay:
+            server = imapsim.ReplayServer(("127.0.0.1", 0), args.replay)
+            port = imapsim.startServer(server)
+            kind = "replay"
+        else:
+            server = imapsim.SimServer(("127.0.0.1", 0), mailboxes, args.latency / 1000.0, not args.no_compress)
+            port = imapsim.startServer(server)
+            # Runs change flags; each run starts from the same state
+            snapshot = {name: [set(m.flags) for m in box.messages] for name, box in mailboxes.items()}
+            kind = "sim"
+            if args.record:
+                recorder = imapsim.RecordServer(("127.0.0.1", 0), ("127.0.0.1", port), False, args.record)
+                port = imapsim.startServer(recorder)
+    url = "imap+plain://{}@127.0.0.1:{}/{}".format(user, port, args.box)
+    # do_folder asks for the password of imap+plain connections on the
+    # terminal
+    getpass.getpass = lambda prompt="Password: ", stream=None: password
+
+    bench = Bench(args, url, attachmentMessages)
+    runs = []
+    for i in range(args.runs):
+        if snapshot is not None:
+            for name, flags in snapshot.items():
+                for m, f in zip(server.mailboxes[name].messages, flags):
+                    m.flags = set(f)
+        rundir = os.path.join(scratch, "run{}".format(i + 1))
+        os.mkdir(rundir)
+        sys.stderr.write("Run {} of {}\n".format(i + 1, args.runs))
+        runs.append(anyio.run(runOnce, bench, steps, rundir))
+
+    results = {
+            "benchmark": "imap-bench",
+            "when": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": gitCommit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server": kind,
+            "count": args.count if kind == "sim" else None,
+            "seed": args.seed if kind == "sim" else None,
+            "latency_ms": args.latency if kind == "sim" else None,
+            "compress": not args.no_compress if kind == "sim" else None,
+            "rows": args.rows,
+            "runs": args.runs,
+            "steps": summarize(runs),
+            }
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    failed = any(r.get("error") for r in results["steps"].values())
+    if args.compare:
+        failed = compare(results, args.compare, args.threshold) or failed
+    if args.keep:
+        print("Scratch files in", scratch)
+    else:
+        import shutil
+        shutil.rmtree(scratch, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
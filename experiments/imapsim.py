@@ -0,0 +1,1296 @@
+#!/usr/bin/env python3
+# Stand-in IMAP servers for benchmarks and experiments.
+#
+# Three servers, all on the loopback interface:
+#
+#   serve   - a simulated server with a synthetic mailbox of any size.
+#             Messages have realistic MIME structures (plain text,
+#             text+html alternatives, attachments, forwarded messages,
+#             non-ASCII subjects and names) and are threaded with
+#             References/In-Reply-To headers. The content is generated from a
+#             seed, so the same size and seed always give the same mailbox.
+#   record  - a proxy to a real server that logs the traffic each way, so a
+#             real session can be replayed later.
+#   replay  - serves a recorded log back to a client that sends the same
+#             commands.
+#
+# Run from the top of the source tree:
+#
+#   python3 experiments/imapsim.py serve [--count N] [--seed S] [--port P] [--latency MS]
+#   python3 experiments/imapsim.py record --upstream HOST:PORT [--tls] --log FILE [--port P]
+#   python3 experiments/imapsim.py replay --log FILE [--port P] [--realtime]
+#
+# then point mailnex at it, e.g.
+#
+#   folder imap+plain://bench@127.0.0.1:PORT/INBOX
+#
+# The simulated server takes any user name and password.
+#
+# The recorder logs one JSON object per line: a header, then
+#   {"conn": N, "t": seconds, "dir": "c" or "s", "data": "..."}
+# for each chunk sent by the client ("c") or the server ("s"). data holds the
+# bytes as latin-1. Passwords in LOGIN and AUTHENTICATE commands are replaced
+# with <redacted>; on replay any credentials are accepted. The recorder
+# refuses COMPRESS, so that the log stays readable.
+#
+# A replayed session only works if the client sends exactly what was
+# recorded; the replay server reports where the client diverged. Since
+# mailnex numbers its command tags from 1 on each connection, replaying the
+# same steps against the same recording works.
+#
+# The benchmarks (imap-bench.py) use this as a module.
+
+import os
+import re
+import sys
+import ssl
+import json
+import time
+import zlib
+import email
+import email.utils
+import base64
+import quopri
+import random
+import socket
+import argparse
+import datetime
+import threading
+import socketserver
+
+CAPABILITIES = b"IMAP4rev1 LITERAL+ SASL-IR AUTH=PLAIN IDLE ESEARCH UIDPLUS MOVE NAMESPACE ID ENABLE UNSELECT CHILDREN LIST-EXTENDED LIST-STATUS"
+
+SYSTEM_FLAGS = ("\\Answered", "\\Flagged", "\\Deleted", "\\Seen", "\\Draft")
+
+# Words for generated subjects and text
+WORDS = """
+    about above account action address after again agenda almost already
+    answer anyone april archive around backup before below between branch
+    budget build cache change check client commit config contract copy
+    customer daily data deadline debug deploy design detail draft email
+    error estimate event feature final folder follow friday group handle
+    header hotel import index invoice issue joint kernel label latest
+    launch layout letter limit local lunch march market meeting memory
+    merge message minutes monday network notes office order outage owner
+    packet patch payment photo plan please policy print project proposal
+    quarter quick quote receipt release report request review roadmap
+    sample schedule screen search server session setup shared sheet
+    signed status summary support survey switch system team thanks thread
+    ticket timeline today travel trial update upgrade urgent vendor
+    version weekly window workshop
+    """.split()
+
+# Some with characters that need encoding in headers
+NAMES = [
+        "Alice Johnson", "Bob Smith", "Carol Nguyen", "Dave O'Brien",
+        "Eve Martin", "Frank Müller", "Grace Hopper", "Heidi Klum",
+        "Ivan Petrov", "Judy Garcia", "Mallory Reyes", "José Álvarez",
+        "Ōta Hiroshi", "Zoë Smith", "Peggy Carter", "Trent Lee",
+        "Victor Chen", "Walter White", "Björk Guðmundsdóttir", "李 小龙",
+        ]
+DOMAINS = ["example.com", "example.org", "mail.example.net", "lists.example.com", "corp.example"]
+ACCENTED = ["café", "naïve", "résumé", "façade", "jalapeño", "smörgåsbord", "日本語", "Grüße", "€100"]
+ATTACHMENTS = [
+        ("application", "pdf", "report-{}.pdf"),
+        ("image", "jpeg", "photo-{}.jpg"),
+        ("image", "png", "screenshot-{}.png"),
+        ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet", "budget-{}.xlsx"),
+        ("application", "zip", "logs-{}.zip"),
+        ("text", "csv", "export-{}.csv"),
+        ]
+
+def encodeWord(text):
+    """Return text as an RFC 2047 encoded-word if it isn't plain ASCII"""
+    try:
+        text.encode("ascii")
+        return text
+    except UnicodeEncodeError:
+        return "=?utf-8?b?{}?=".format(base64.b64encode(text.encode("utf-8")).decode("ascii"))
+
+def crlf(text):
+    """Normalize line endings to CRLF"""
+    return text.replace("\r\n", "\n").replace("\n", "\r\n")
+
+
+class Part(object):
+    """A node of a MIME tree, serialized exactly as it is served.
+
+    For a multipart, parts holds the sub-parts. For message/rfc822, message
+    holds the encapsulated message (itself a Part). Otherwise, body holds the
+    encoded content.
+    """
+    def __init__(self, maintype, subtype, params=None, headers=None, body=b"", parts=None, message=None, encoding="7bit", disposition=None):
+        object.__init__(self)
+        self.maintype = maintype.lower()
+        self.subtype = subtype.lower()
+        self.params = params or []
+        self.headers = headers or []
+        self.body = body
+        self.parts = parts
+        self.message = message
+        self.encoding = encoding
+        # (type, [(name, value), ...]) or None
+        self.disposition = disposition
+        self._raw = None
+    def isMultipart(self):
+        return self.parts is not None
+    def isMessage(self):
+        return self.message is not None
+    def header(self, name):
+        """Return the first value of the named header, or None"""
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return None
+    def headerBytes(self):
+        """The header block, including the blank line that ends it"""
+        return b"".join("{}: {}\r\n".format(k, v).encode("utf-8") for k, v in self.headers) + b"\r\n"
+    def bodyBytes(self):
+        if self.isMultipart():
+            boundary = dict(self.params)["boundary"].encode("ascii")
+            res = [b"This is a multi-part message in MIME format.\r\n"]
+            for p in self.parts:
+                res.append(b"\r\n--%s\r\n" % boundary)
+                res.append(p.raw())
+            res.append(b"\r\n--%s--\r\n" % boundary)
+            return b"".join(res)
+        if self.isMessage():
+            return self.message.raw()
+        return self.body
+    def raw(self):
+        if self._raw is None:
+            self._raw = self.headerBytes() + self.bodyBytes()
+        return self._raw
+
+def textPart(text, subtype="plain", headers=None):
+    try:
+        body = crlf(text).encode("ascii")
+        encoding = "7bit"
+    except UnicodeEncodeError:
+        body = quopri.encodestring(text.replace("\r\n", "\n").encode("utf-8")).replace(b"\n", b"\r\n")
+        encoding = "quoted-printable"
+    if not body.endswith(b"\r\n"):
+        body += b"\r\n"
+    headers = list(headers or [])
+    headers.append(("Content-Type", "text/{}; charset=utf-8".format(subtype)))
+    headers.append(("Content-Transfer-Encoding", encoding))
+    return Part("text", subtype, [("charset", "utf-8")], headers, body, encoding=encoding)
+
+def binaryPart(maintype, subtype, data, filename):
+    encoded = base64.encodebytes(data).replace(b"\n", b"\r\n")
+    headers = [
+            ("Content-Type", '{}/{}; name="{}"'.format(maintype, subtype, filename)),
+            ("Content-Transfer-Encoding", "base64"),
+            ("Content-Disposition", 'attachment; filename="{}"'.format(filename)),
+            ]
+    return Part(maintype, subtype, [("name", filename)], headers, encoded, encoding="base64", disposition=("attachment", [("filename", filename)]))
+
+def multipart(subtype, parts, boundary, headers=None):
+    headers = list(headers or [])
+    headers.append(("Content-Type", 'multipart/{}; boundary="{}"'.format(subtype, boundary)))
+    return Part("multipart", subtype, [("boundary", boundary)], headers, parts=parts)
+
+def rfc822Part(message, description=None):
+    headers = [("Content-Type", "message/rfc822")]
+    if description:
+        headers.append(("Content-Description", description))
+    return Part("message", "rfc822", headers=headers, message=message, disposition=("inline", []))
+
+def partFromEmail(msg):
+    """Build a Part tree from an email.message.Message (for APPEND)"""
+    headers = [(k, str(v)) for k, v in msg.items()]
+    params = [(k, v) for k, v in (msg.get_params() or [])[1:]]
+    encoding = (msg.get("Content-Transfer-Encoding") or "7bit").lower()
+    disp = msg.get("Content-Disposition")
+    disposition = None
+    if disp:
+        dparams = msg.get_params(header="Content-Disposition") or []
+        disposition = (dparams[0][0].lower(), dparams[1:])
+    if msg.is_multipart():
+        if msg.get_content_type() == "message/rfc822":
+            return Part("message", "rfc822", params, headers, message=partFromEmail(msg.get_payload(0)), disposition=disposition)
+        return Part(msg.get_content_maintype(), msg.get_content_subtype(), params, headers,
+                parts=[partFromEmail(p) for p in msg.get_payload()], disposition=disposition)
+    body = msg.get_payload().encode("latin-1", "replace").replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+    return Part(msg.get_content_maintype(), msg.get_content_subtype(), params, headers, body, encoding=encoding, disposition=disposition)
+
+
+class Message(object):
+    def __init__(self, uid, root, internaldate, flags=()):
+        object.__init__(self)
+        self.uid = uid
+        self.root = root
+        self.internaldate = internaldate
+        self.flags = set(flags)
+        # Set by the generator; which parts are attachments
+        self.attachments = 0
+
+class Mailbox(object):
+    def __init__(self, name, uidvalidity):
+        object.__init__(self)
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+    def add(self, root, internaldate, flags=()):
+        m = Message(self.uidnext, root, internaldate, flags)
+        self.uidnext += 1
+        self.messages.append(m)
+        return m
+
+
+class Generator(object):
+    """Makes synthetic messages from a seeded random source"""
+    def __init__(self, seed=1):
+        object.__init__(self)
+        self.rand = random.Random(seed)
+        self.start = datetime.datetime(2024, 1, 1, 8, 0, tzinfo=datetime.timezone.utc)
+        self.people = ["{} <{}@{}>".format(encodeWord(n), n.split()[0].lower().encode("ascii", "ignore").decode() or "user", self.rand.choice(DOMAINS)) for n in NAMES]
+        self.count = 0
+    def words(self, low, high):
+        return " ".join(self.rand.choice(WORDS) for _ in range(self.rand.randint(low, high)))
+    def subject(self):
+        r = self.rand.random()
+        s = self.words(2, 8).capitalize()
+        if r < 0.1:
+            s = "{} {}".format(s, self.rand.choice(ACCENTED))
+        elif r < 0.15:
+            s = "[{}] {}".format(self.rand.choice(["dev", "announce", "ops"]), s)
+        elif r < 0.18:
+            s = " ".join([s] * 6)
+        return s
+    def paragraphs(self, accented=False):
+        res = []
+        for _ in range(self.rand.randint(1, 6)):
+            lines = []
+            for _ in range(self.rand.randint(1, 8)):
+                line = self.words(6, 12)
+                if accented and self.rand.random() < 0.2:
+                    line += " " + self.rand.choice(ACCENTED)
+                lines.append(line)
+            res.append("\n".join(lines))
+        return "\n\n".join(res) + "\n"
+    def body(self, parent, accented):
+        """Return the body Part of a new message, and its attachment count"""
+        text = self.paragraphs(accented)
+        if parent is not None:
+            quoted = "\n".join("> " + l for l in parent.text.splitlines()[:12])
+            text = "{}\nOn a previous day, someone wrote:\n{}\n".format(text, quoted)
+        r = self.rand.random()
+        n = self.count
+        if r < 0.55:
+            return textPart(text), text, 0
+        if r < 0.75:
+            html = "<html><body>{}</body></html>\n".format("".join("<p>{}</p>\n".format(p.replace("\n", "<br>\n")) for p in text.split("\n\n")))
+            return multipart("alternative", [textPart(text), textPart(html, "html")], "alt-{}".format(n)), text, 0
+        if r < 0.93:
+            parts = [textPart(text)]
+            for i in range(self.rand.choice((1, 1, 1, 2, 3))):
+                maintype, subtype, name = self.rand.choice(ATTACHMENTS)
+                name = name.format("{}-{}".format(n, i + 1))
+                size = int(self.rand.expovariate(1 / 30000.0)) + 200
+                if maintype == "text":
+                    parts.append(textPart("\n".join(",".join(self.words(3, 3).split()) for _ in range(size // 30))))
+                    parts[-1].headers.append(("Content-Disposition", 'attachment; filename="{}"'.format(name)))
+                    parts[-1].disposition = ("attachment", [("filename", name)])
+                else:
+                    parts.append(binaryPart(maintype, subtype, self.rand.randbytes(size), name))
+            return multipart("mixed", parts, "mixed-{}".format(n)), text, len(parts) - 1
+        # A forward of an earlier message, inline
+        if self.previous:
+            fwd = self.rand.choice(self.previous)
+            return multipart("mixed", [textPart(text), rfc822Part(fwd.root, "Forwarded message")], "fwd-{}".format(n)), text, 0
+        return textPart(text), text, 0
+    def mailbox(self, name, count, uidvalidity=None):
+        """Make a mailbox of count messages, threaded, with realistic flags"""
+        box = Mailbox(name, uidvalidity or 1000 + len(name))
+        self.previous = []
+        when = self.start
+        for i in range(count):
+            self.count += 1
+            when += datetime.timedelta(minutes=self.rand.randint(1, 240))
+            parent = None
+            if self.previous and self.rand.random() < 0.35:
+                parent = self.rand.choice(self.previous[-200:])
+            accented = self.rand.random() < 0.1
+            body, text, attachments = self.body(parent, accented)
+            sender = self.rand.choice(self.people)
+            to = self.rand.sample(self.people, self.rand.randint(1, 3))
+            mid = "<{}.{}@{}>".format(self.count, self.rand.getrandbits(32), self.rand.choice(DOMAINS))
+            headers = [
+                    ("Received", "from relay.example.net (relay.example.net [192.0.2.{}]) by mx.example.com with ESMTPS id {:x}; {}".format(
+                        self.rand.randint(1, 254), self.rand.getrandbits(40), email.utils.format_datetime(when))),
+                    ("Date", email.utils.format_datetime(when)),
+                    ("From", sender),
+                    ("To", ", ".join(to)),
+                    ]
+            if self.rand.random() < 0.2:
+                headers.append(("Cc", self.rand.choice(self.people)))
+            if parent is not None:
+                subject = parent.subject if parent.subject.startswith("Re: ") else "Re: " + parent.subject
+                refs = (parent.refs + [parent.mid])[-20:]
+                headers.append(("In-Reply-To", parent.mid))
+                headers.append(("References", " ".join(refs)))
+            else:
+                subject = self.subject()
+                refs = []
+            headers.append(("Subject", encodeWord(subject)))
+            headers.append(("Message-ID", mid))
+            headers.append(("MIME-Version", "1.0"))
+            if self.rand.random() < 0.3:
+                headers.append(("X-Mailer", "Synthetic Mailer {}.{}".format(self.rand.randint(1, 9), self.rand.randint(0, 20))))
+            body.headers = headers + body.headers
+            if i < count * 0.9:
+                flags = {"\\Seen"} if self.rand.random() < 0.95 else set()
+            else:
+                flags = {"\\Seen"} if self.rand.random() < 0.3 else set()
+            if self.rand.random() < 0.03:
+                flags.add("\\Flagged")
+            if parent is not None and "\\Seen" in flags and self.rand.random() < 0.3:
+                flags.add("\\Answered")
+            msg = box.add(body, when, flags)
+            msg.attachments = attachments
+            # Remember what replies need
+            msg.subject = subject
+            msg.mid = mid
+            msg.refs = refs
+            msg.text = text
+            self.previous.append(msg)
+        return box
+
+def makeMailboxes(count, seed=1):
+    """The standard set of mailboxes: INBOX of count messages, and some others"""
+    gen = Generator(seed)
+    boxes = {}
+    for name, size in (
+            ("INBOX", count),
+            ("Archive", count // 4),
+            ("Sent", min(count, 50)),
+            ("Trash", 0),
+            ("Lists/dev", count // 2),
+            ("Lists/announce", min(count, 20)),
+            ):
+        boxes[name] = gen.mailbox(name, size)
+    return boxes
+
+
+# Formatting of IMAP data
+
+def quoted(s):
+    """IMAP nstring for s: NIL, a quoted string, or a literal"""
+    if s is None:
+        return b"NIL"
+    if isinstance(s, str):
+        s = s.encode("utf-8")
+    if any(c > 126 or c in (10, 13) for c in s) or len(s) > 1000:
+        return b"{%d}\r\n%s" % (len(s), s)
+    return b'"%s"' % s.replace(b"\\", b"\\\\").replace(b'"', b'\\"')
+
+def plist(items):
+    """Parenthesized list of already formatted items, or NIL if empty"""
+    if not items:
+        return b"NIL"
+    return b"(" + b" ".join(items) + b")"
+
+def addresses(value):
+    if value is None:
+        return b"NIL"
+    res = []
+    for name, addr in email.utils.getaddresses([value]):
+        mailbox, _, host = addr.partition("@")
+        res.append(b"(%s NIL %s %s)" % (quoted(name or None), quoted(mailbox), quoted(host or None)))
+    return b"(" + b"".join(res) + b")" if res else b"NIL"
+
+def envelope(part):
+    sender = part.header("Sender") or part.header("From")
+    replyto = part.header("Reply-To") or part.header("From")
+    return b"(%s)" % b" ".join((
+        quoted(part.header("Date")),
+        quoted(part.header("Subject")),
+        addresses(part.header("From")),
+        addresses(sender),
+        addresses(replyto),
+        addresses(part.header("To")),
+        addresses(part.header("Cc")),
+        addresses(part.header("Bcc")),
+        quoted(part.header("In-Reply-To")),
+        quoted(part.header("Message-ID")),
+        ))
+
+def params(pairs):
+    return plist([quoted(k.upper()) + b" " + quoted(v) for k, v in pairs])
+
+def disposition(disp):
+    if disp is None:
+        return b"NIL"
+    return b"(%s %s)" % (quoted(disp[0].upper()), params(disp[1]))
+
+def bodystructure(part, extensible=True):
+    if part.isMultipart():
+        res = b"(" + b"".join(bodystructure(p, extensible) for p in part.parts) + b" " + quoted(part.subtype.upper())
+        if extensible:
+            res += b" %s %s NIL NIL" % (params(part.params), disposition(part.disposition))
+        return res + b")"
+    body = part.bodyBytes()
+    res = b"(%s %s %s %s %s %s %d" % (
+            quoted(part.maintype.upper()),
+            quoted(part.subtype.upper()),
+            params(part.params),
+            quoted(part.header("Content-ID")),
+            quoted(part.header("Content-Description")),
+            quoted(part.encoding.upper()),
+            len(body),
+            )
+    if part.isMessage():
+        res += b" %s %s %d" % (envelope(part.message), bodystructure(part.message, extensible), body.count(b"\n"))
+    elif part.maintype == "text":
+        res += b" %d" % body.count(b"\n")
+    if extensible:
+        res += b" NIL %s NIL NIL" % disposition(part.disposition)
+    return res + b")"
+
+def internaldate(when):
+    return when.strftime("{:2d}-%b-%Y %H:%M:%S %z".format(when.day)).encode("ascii")
+
+def headerFields(part, names, invert=False):
+    names = set(n.lower() for n in names)
+    res = [b"%s: %s\r\n" % (k.encode("utf-8"), v.encode("utf-8")) for k, v in part.headers if (k.lower() in names) != invert]
+    return b"".join(res) + b"\r\n"
+
+def section(root, spec):
+    """Return the bytes of a BODY[spec] section of the message root"""
+    spec = spec.upper()
+    nums = []
+    rest = spec
+    while rest:
+        head, _, tail = rest.partition(".")
+        if not head.isdigit():
+            break
+        nums.append(int(head))
+        rest = tail
+    cur = root
+    for i, n in enumerate(nums):
+        base = cur.message if (i > 0 and cur.isMessage()) else cur
+        if base.isMultipart():
+            if not 0 < n <= len(base.parts):
+                return b""
+            cur = base.parts[n - 1]
+        elif n != 1:
+            return b""
+        else:
+            cur = base
+    if rest == "":
+        return cur.raw() if not nums else cur.bodyBytes()
+    if rest == "MIME":
+        return cur.headerBytes()
+    msg = cur.message if (nums and cur.isMessage()) else cur
+    if rest == "HEADER":
+        return msg.headerBytes()
+    if rest == "TEXT":
+        return msg.bodyBytes()
+    m = re.match(r"HEADER\.FIELDS(\.NOT)?\s*\((.*)\)", rest)
+    if m:
+        return headerFields(msg, m.group(2).split(), bool(m.group(1)))
+    return b""
+
+
+# Parsing of client commands
+
+class Literal(bytes):
+    """A literal string argument"""
+
+def tokenize(line, literals):
+    """Split a command line into atoms, strings, and (nested) lists.
+
+    Brackets (as in BODY[HEADER.FIELDS (A B)]) and a following <partial>
+    stay part of their atom. literals holds the data of each {n} in order.
+    """
+    stack = [[]]
+    i = 0
+    literals = list(literals)
+    n = len(line)
+    while i < n:
+        c = line[i:i + 1]
+        if c == b" ":
+            i += 1
+        elif c == b"(":
+            stack.append([])
+            i += 1
+        elif c == b")":
+            done = stack.pop()
+            stack[-1].append(done)
+            i += 1
+        elif c == b'"':
+            j = i + 1
+            s = b""
+            while j < n and line[j:j + 1] != b'"':
+                if line[j:j + 1] == b"\\":
+                    j += 1
+                s += line[j:j + 1]
+                j += 1
+            stack[-1].append(s)
+            i = j + 1
+        elif c == b"{" and re.match(rb"\{\d+\+?\}$", line[i:].split(b" ")[0]):
+            stack[-1].append(Literal(literals.pop(0)))
+            i = n if b" " not in line[i:] else i + line[i:].index(b" ")
+        else:
+            j = i
+            while j < n and line[j:j + 1] not in b" ()":
+                if line[j:j + 1] == b"[":
+                    j = line.index(b"]", j)
+                j += 1
+            stack[-1].append(line[i:j])
+            i = j
+    while len(stack) > 1:
+        done = stack.pop()
+        stack[-1].append(done)
+    return stack[0]
+
+def parseSet(spec, maximum):
+    """Return the set of numbers in an IMAP sequence set; * is maximum"""
+    res = set()
+    for r in spec.split(b","):
+        lo, _, hi = r.partition(b":")
+        lo = maximum if lo == b"*" else int(lo)
+        hi = lo if not hi else (maximum if hi == b"*" else int(hi))
+        if lo > hi:
+            lo, hi = hi, lo
+        res.update(range(lo, min(hi, maximum) + 1))
+    return res
+
+def compactSet(numbers):
+    """Format sorted numbers as an IMAP sequence set"""
+    res = []
+    for n in numbers:
+        if res and res[-1][1] == n - 1:
+            res[-1][1] = n
+        else:
+            res.append([n, n])
+    return b",".join(b"%d" % a if a == b else b"%d:%d" % (a, b) for a, b in res)
+
+FETCH_MACROS = {
+        b"ALL": [b"FLAGS", b"INTERNALDATE", b"RFC822.SIZE", b"ENVELOPE"],
+        b"FAST": [b"FLAGS", b"INTERNALDATE", b"RFC822.SIZE"],
+        b"FULL": [b"FLAGS", b"INTERNALDATE", b"RFC822.SIZE", b"ENVELOPE", b"BODY"],
+        }
+
+# Returned by a command that has already sent its tagged response
+SENT = object()
+
+class ImapError(Exception):
+    def __init__(self, status, text):
+        Exception.__init__(self, text)
+        self.status = status
+        self.text = text
+
+
+class SimHandler(socketserver.BaseRequestHandler):
+    """One client connection to the simulated server"""
+    def setup(self):
+        self.buf = b""
+        self.inflate = None
+        self.deflate = None
+        self.box = None
+        self.readonly = False
+        self.authenticated = False
+        # Whether the client waited for our previous response; that's when
+        # a new round trip starts
+        self.newFlight = True
+        self.out = []
+    def recv(self):
+        data = self.request.recv(65536)
+        if not data:
+            raise EOFError()
+        if self.inflate:
+            data = self.inflate.decompress(data)
+        self.buf += data
+    def readline(self):
+        self.newFlight = not self.buf
+        while b"\r\n" not in self.buf:
+            self.recv()
+        line, self.buf = self.buf.split(b"\r\n", 1)
+        return line
+    def readexact(self, count):
+        while len(self.buf) < count:
+            self.recv()
+        data, self.buf = self.buf[:count], self.buf[count:]
+        return data
+    def send(self, data):
+        if self.deflate:
+            data = self.deflate.compress(data) + self.deflate.flush(zlib.Z_SYNC_FLUSH)
+        self.request.sendall(data)
+    def flush(self):
+        if self.out:
+            if self.newFlight and self.server.latency:
+                time.sleep(self.server.latency)
+            self.send(b"".join(self.out))
+            self.out = []
+    def untagged(self, data):
+        self.out.append(b"* %s\r\n" % data)
+    def readCommand(self):
+        """Read a command line, with any literals it contains"""
+        line = self.readline()
+        literals = []
+        # The command up to the last literal; only what follows a literal
+        # can announce another one
+        head = b""
+        while True:
+            m = re.search(rb"\{(\d+)(\+?)\}$", line)
+            if not m:
+                return head + line, literals
+            if not m.group(2):
+                self.send(b"+ go ahead\r\n")
+            literals.append(self.readexact(int(m.group(1))))
+            head += line[:m.start()] + b"{%d}" % len(literals[-1])
+            line = self.readline()
+    def handle(self):
+        self.send(b"* OK [CAPABILITY %s] imapsim ready\r\n" % self.server.capabilities)
+        try:
+            while True:
+                line, literals = self.readCommand()
+                if self.server.lock is not None:
+                    with self.server.lock:
+                        go = self.command(line, literals)
+                else:
+                    go = self.command(line, literals)
+                self.flush()
+                if not go:
+                    return
+        except (EOFError, ConnectionError):
+            return
+    def command(self, line, literals):
+        parts = line.split(b" ", 2)
+        tag = parts[0]
+        if len(parts) < 2:
+            self.out.append(b"%s BAD missing command\r\n" % tag)
+            return True
+        verb = parts[1].upper()
+        args = tokenize(parts[2], literals) if len(parts) > 2 else []
+        uid = False
+        if verb == b"UID" and args:
+            uid = True
+            verb = args[0].upper()
+            args = args[1:]
+        handler = getattr(self, "cmd_" + verb.decode("ascii", "replace").replace("-", "_"), None)
+        if handler is None:
+            self.out.append(b"%s BAD unknown command\r\n" % tag)
+            return True
+        try:
+            res = handler(tag, args, uid) if uid or verb in (b"FETCH", b"STORE", b"SEARCH", b"COPY", b"MOVE", b"EXPUNGE") else handler(tag, args)
+        except ImapError as ev:
+            self.out.append(b"%s %s %s\r\n" % (tag, ev.status, ev.text.encode("utf-8")))
+            return True
+        except (IndexError, ValueError, KeyError) as ev:
+            self.out.append(b"%s BAD %s\r\n" % (tag, repr(ev).encode("utf-8")))
+            return True
+        if res is False:
+            return False
+        if res is SENT:
+            return True
+        if res is None:
+            res = b"OK done"
+        self.out.append(b"%s %s\r\n" % (tag, res))
+        return True
+    def needBox(self):
+        if self.box is None:
+            raise ImapError(b"BAD", "no mailbox selected")
+        return self.box
+    def getBox(self, name):
+        if isinstance(name, bytes):
+            name = name.decode("utf-8")
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        if name not in self.server.mailboxes:
+            raise ImapError(b"NO", "[NONEXISTENT] no such mailbox")
+        return self.server.mailboxes[name]
+    def messages(self, spec, uid):
+        """Return [(sequence number, Message)] for a sequence or UID set"""
+        box = self.needBox()
+        if uid:
+            maximum = box.messages[-1].uid if box.messages else 0
+            if spec.endswith(b":*") or spec == b"*":
+                # n:* always includes the last message
+                maximum = max(maximum, box.uidnext)
+            wanted = parseSet(spec, maximum) if box.messages else set()
+            return [(i + 1, m) for i, m in enumerate(box.messages) if m.uid in wanted]
+        wanted = parseSet(spec, len(box.messages))
+        return [(i, box.messages[i - 1]) for i in sorted(wanted) if 0 < i <= len(box.messages)]
+
+    # Any state
+
+    def cmd_CAPABILITY(self, tag, args):
+        self.untagged(b"CAPABILITY %s" % self.server.capabilities)
+    def cmd_NOOP(self, tag, args):
+        pass
+    def cmd_CHECK(self, tag, args):
+        pass
+    def cmd_ID(self, tag, args):
+        self.untagged(b'ID ("name" "imapsim")')
+    def cmd_ENABLE(self, tag, args):
+        self.untagged(b"ENABLED")
+    def cmd_LOGOUT(self, tag, args):
+        self.untagged(b"BYE logging out")
+        self.out.append(b"%s OK logged out\r\n" % tag)
+        return False
+    def cmd_LOGIN(self, tag, args):
+        self.authenticated = True
+        return b"OK [CAPABILITY %s] logged in" % self.server.capabilities
+    def cmd_AUTHENTICATE(self, tag, args):
+        if args[0].upper() != b"PLAIN":
+            raise ImapError(b"NO", "unsupported mechanism")
+        if len(args) < 2:
+            self.send(b"+ \r\n")
+            self.readline()
+        self.authenticated = True
+        return b"OK [CAPABILITY %s] logged in" % self.server.capabilities
+    def cmd_COMPRESS(self, tag, args):
+        if not self.server.compress or self.deflate:
+            raise ImapError(b"NO", "[COMPRESSIONACTIVE] not available")
+        self.out.append(b"%s OK compression active\r\n" % tag)
+        self.flush()
+        self.inflate = zlib.decompressobj(-15)
+        self.deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        if self.buf:
+            self.buf = self.inflate.decompress(self.buf)
+        return SENT
+
+    # Authenticated state
+
+    def cmd_NAMESPACE(self, tag, args):
+        self.untagged(b'NAMESPACE (("" "/")) NIL NIL')
+    def cmd_LIST(self, tag, args, lsub=False):
+        # LIST-EXTENDED (RFC 5258): selection options before the reference,
+        # a list of patterns, and return options after. Every mailbox counts
+        # as subscribed. Of the return options, only STATUS (RFC 5819) does
+        # anything; children are always reported.
+        if isinstance(args[0], list):
+            args = args[1:]
+        ref = args[0].decode("utf-8")
+        patterns = args[1] if isinstance(args[1], list) else [args[1]]
+        statusItems = None
+        if len(args) > 3 and args[2].upper() == b"RETURN":
+            returns = args[3]
+            for i, option in enumerate(returns):
+                if not isinstance(option, list) and option.upper() == b"STATUS":
+                    statusItems = returns[i + 1]
+        regex = re.compile("|".join("^" + re.escape(ref + p.decode("utf-8")).replace(r"\*", ".*").replace("%", "[^/]*") + "$" for p in patterns))
+        names = set(self.server.mailboxes)
+        parents = set()
+        for name in names:
+            while "/" in name:
+                name = name.rsplit("/", 1)[0]
+                parents.add(name)
+        verb = b"LSUB" if lsub else b"LIST"
+        if patterns == [b""]:
+            self.untagged(b'%s (\\Noselect) "/" ""' % verb)
+            return
+        for name in sorted(names | parents):
+            if not regex.match(name):
+                continue
+            attrs = []
+            if name not in names:
+                attrs.append(b"\\Noselect")
+            attrs.append(b"\\HasChildren" if name in parents else b"\\HasNoChildren")
+            self.untagged(b'%s (%s) "/" %s' % (verb, b" ".join(attrs), quoted(name)))
+            if statusItems is not None and name in names:
+                self.cmd_STATUS(tag, [name.encode("utf-8"), statusItems])
+    def cmd_LSUB(self, tag, args):
+        return self.cmd_LIST(tag, args, True)
+    def cmd_STATUS(self, tag, args):
+        box = self.getBox(args[0])
+        values = {
+                b"MESSAGES": len(box.messages),
+                b"RECENT": 0,
+                b"UIDNEXT": box.uidnext,
+                b"UIDVALIDITY": box.uidvalidity,
+                b"UNSEEN": sum(1 for m in box.messages if "\\Seen" not in m.flags),
+                }
+        items = b" ".join(b"%s %d" % (i.upper(), values[i.upper()]) for i in args[1])
+        self.untagged(b"STATUS %s (%s)" % (quoted(box.name), items))
+    def cmd_SELECT(self, tag, args, readonly=False):
+        box = self.getBox(args[0])
+        self.box = box
+        self.readonly = readonly
+        self.untagged(b"FLAGS (%s)" % " ".join(SYSTEM_FLAGS).encode("ascii"))
+        self.untagged(b"OK [PERMANENTFLAGS (%s \\*)] flags allowed" % " ".join(SYSTEM_FLAGS).encode("ascii"))
+        self.untagged(b"%d EXISTS" % len(box.messages))
+        self.untagged(b"0 RECENT")
+        self.untagged(b"OK [UIDVALIDITY %d] uids valid" % box.uidvalidity)
+        self.untagged(b"OK [UIDNEXT %d] predicted next uid" % box.uidnext)
+        return b"OK [READ-ONLY] examined" if readonly else b"OK [READ-WRITE] selected"
+    def cmd_EXAMINE(self, tag, args):
+        return self.cmd_SELECT(tag, args, True)
+    def cmd_CLOSE(self, tag, args):
+        if self.box is not None and not self.readonly:
+            self.expunge(None, quiet=True)
+        self.box = None
+    def cmd_UNSELECT(self, tag, args):
+        self.box = None
+    def cmd_IDLE(self, tag, args):
+        self.out.append(b"+ idling\r\n")
+        self.flush()
+        while self.readline().upper() != b"DONE":
+            pass
+    def cmd_APPEND(self, tag, args):
+        box = self.getBox(args[0])
+        flags = ()
+        when = datetime.datetime.now(datetime.timezone.utc)
+        for a in args[1:-1]:
+            if isinstance(a, list):
+                flags = [f.decode("ascii") for f in a]
+            else:
+                when = datetime.datetime.strptime(a.decode("ascii").strip(), "%d-%b-%Y %H:%M:%S %z")
+        msg = email.message_from_bytes(args[-1])
+        m = box.add(partFromEmail(msg), when, flags)
+        return b"OK [APPENDUID %d %d] appended" % (box.uidvalidity, m.uid)
+
+    # Selected state
+
+    def cmd_FETCH(self, tag, args, uid=False):
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        if len(items) == 1 and items[0].upper() in FETCH_MACROS:
+            items = FETCH_MACROS[items[0].upper()]
+        if uid and not any(i.upper() == b"UID" for i in items):
+            items = [b"UID"] + items
+        for seq, m in self.messages(args[0], uid):
+            res = []
+            seen = False
+            for item in items:
+                name = item.upper()
+                if name == b"UID":
+                    res.append(b"UID %d" % m.uid)
+                elif name == b"FLAGS":
+                    res.append(b"FLAGS (%s)" % " ".join(sorted(m.flags)).encode("ascii"))
+                elif name == b"INTERNALDATE":
+                    res.append(b'INTERNALDATE "%s"' % internaldate(m.internaldate))
+                elif name == b"RFC822.SIZE":
+                    res.append(b"RFC822.SIZE %d" % len(m.root.raw()))
+                elif name == b"ENVELOPE":
+                    res.append(b"ENVELOPE %s" % envelope(m.root))
+                elif name == b"BODYSTRUCTURE":
+                    res.append(b"BODYSTRUCTURE %s" % bodystructure(m.root))
+                elif name == b"BODY":
+                    res.append(b"BODY %s" % bodystructure(m.root, False))
+                elif name in (b"RFC822", b"RFC822.HEADER", b"RFC822.TEXT"):
+                    data = {b"RFC822": m.root.raw(), b"RFC822.HEADER": m.root.headerBytes(), b"RFC822.TEXT": m.root.bodyBytes()}[name]
+                    res.append(b"%s {%d}\r\n%s" % (name, len(data), data))
+                    seen = seen or name != b"RFC822.HEADER"
+                elif name.startswith(b"BODY[") or name.startswith(b"BODY.PEEK["):
+                    open_ = item.index(b"[")
+                    close = item.index(b"]")
+                    spec = item[open_ + 1:close]
+                    data = section(m.root, spec.decode("ascii"))
+                    key = b"BODY[%s]" % spec.upper()
+                    partial = item[close + 1:]
+                    if partial:
+                        start, _, length = partial.strip(b"<>").partition(b".")
+                        start = int(start)
+                        data = data[start:start + int(length)] if length else data[start:]
+                        key += b"<%d>" % start
+                    res.append(b"%s {%d}\r\n%s" % (key, len(data), data))
+                    seen = seen or not name.startswith(b"BODY.PEEK")
+                else:
+                    raise ImapError(b"BAD", "unknown fetch item")
+            if seen and not self.readonly and "\\Seen" not in m.flags:
+                m.flags.add("\\Seen")
+                if not any(i.upper() == b"FLAGS" for i in items):
+                    res.append(b"FLAGS (%s)" % " ".join(sorted(m.flags)).encode("ascii"))
+            self.untagged(b"%d FETCH (%s)" % (seq, b" ".join(res)))
+    def cmd_STORE(self, tag, args, uid=False):
+        if self.readonly:
+            raise ImapError(b"NO", "mailbox is read-only")
+        action = args[1].upper()
+        flags = args[2] if isinstance(args[2], list) else args[2:]
+        flags = set(f.decode("ascii") for f in flags)
+        silent = action.endswith(b".SILENT")
+        for seq, m in self.messages(args[0], uid):
+            if action.startswith(b"+"):
+                m.flags |= flags
+            elif action.startswith(b"-"):
+                m.flags -= flags
+            else:
+                m.flags = set(flags)
+            if not silent or uid:
+                res = b"FLAGS (%s)" % " ".join(sorted(m.flags)).encode("ascii")
+                if uid:
+                    res = b"UID %d %s" % (m.uid, res)
+                self.untagged(b"%d FETCH (%s)" % (seq, res))
+    def search(self, keys, box):
+        """Return a predicate for a list of search keys (all must match)"""
+        preds = []
+        keys = list(keys)
+        nmsg = len(box.messages)
+        def flag(name, want=True):
+            return lambda seq, m: (name in m.flags) == want
+        def text(header, value):
+            value = value.decode("utf-8").lower()
+            if header is None:
+                return lambda seq, m: value in m.root.raw().decode("utf-8", "replace").lower()
+            if header == "BODY":
+                return lambda seq, m: value in m.root.bodyBytes().decode("utf-8", "replace").lower()
+            return lambda seq, m: value in (m.root.header(header) or "").lower() if value else m.root.header(header) is not None
+        def date(op, value):
+            day = datetime.datetime.strptime(value.decode("ascii"), "%d-%b-%Y").date()
+            return lambda seq, m: op(m.internaldate.date(), day)
+        while keys:
+            key = keys.pop(0)
+            if isinstance(key, list):
+                preds.append(self.search(key, box))
+                continue
+            k = key.upper()
+            if k == b"ALL":
+                preds.append(lambda seq, m: True)
+            elif k in (b"ANSWERED", b"DELETED", b"DRAFT", b"FLAGGED", b"SEEN"):
+                preds.append(flag("\\" + k.decode("ascii").capitalize()))
+            elif k in (b"UNANSWERED", b"UNDELETED", b"UNDRAFT", b"UNFLAGGED", b"UNSEEN"):
+                preds.append(flag("\\" + k[2:].decode("ascii").capitalize(), False))
+            elif k in (b"NEW", b"RECENT"):
+                # Nothing is ever \Recent here
+                preds.append(lambda seq, m: False)
+            elif k == b"OLD":
+                preds.append(lambda seq, m: True)
+            elif k == b"KEYWORD":
+                preds.append(flag(keys.pop(0).decode("ascii")))
+            elif k == b"UNKEYWORD":
+                preds.append(flag(keys.pop(0).decode("ascii"), False))
+            elif k == b"NOT":
+                inner = self.search([keys.pop(0)], box)
+                preds.append(lambda seq, m, inner=inner: not inner(seq, m))
+            elif k == b"OR":
+                a = self.search([keys.pop(0)], box)
+                b = self.search([keys.pop(0)], box)
+                preds.append(lambda seq, m, a=a, b=b: a(seq, m) or b(seq, m))
+            elif k == b"UID":
+                spec = keys.pop(0)
+                uids = parseSet(spec, max(box.uidnext, 1))
+                preds.append(lambda seq, m, uids=uids: m.uid in uids)
+            elif k in (b"SUBJECT", b"FROM", b"TO", b"CC", b"BCC"):
+                preds.append(text(k.decode("ascii").capitalize(), keys.pop(0)))
+            elif k == b"HEADER":
+                name = keys.pop(0).decode("ascii")
+                preds.append(text(name, keys.pop(0)))
+            elif k == b"BODY":
+                preds.append(text("BODY", keys.pop(0)))
+            elif k == b"TEXT":
+                preds.append(text(None, keys.pop(0)))
+            elif k == b"LARGER":
+                size = int(keys.pop(0))
+                preds.append(lambda seq, m, size=size: len(m.root.raw()) > size)
+            elif k == b"SMALLER":
+                size = int(keys.pop(0))
+                preds.append(lambda seq, m, size=size: len(m.root.raw()) < size)
+            elif k == b"SINCE":
+                preds.append(date(lambda a, b: a >= b, keys.pop(0)))
+            elif k == b"BEFORE":
+                preds.append(date(lambda a, b: a < b, keys.pop(0)))
+            elif k == b"ON":
+                preds.append(date(lambda a, b: a == b, keys.pop(0)))
+            elif re.match(rb"^[0-9*:,]+$", k):
+                seqs = parseSet(k, nmsg)
+                preds.append(lambda seq, m, seqs=seqs: seq in seqs)
+            else:
+                raise ImapError(b"BAD", "unsupported search key {}".format(k.decode("ascii", "replace")))
+        return lambda seq, m: all(p(seq, m) for p in preds)
+    def cmd_SEARCH(self, tag, args, uid=False):
+        box = self.needBox()
+        returns = None
+        if args and args[0].upper() == b"RETURN":
+            returns = [r.upper() for r in args[1]] or [b"ALL"]
+            args = args[2:]
+        if args and args[0].upper() == b"CHARSET":
+            args = args[2:]
+        pred = self.search(args, box)
+        found = [m.uid if uid else seq for seq, m in enumerate(box.messages, 1) if pred(seq, m)]
+        if returns is None:
+            self.untagged(b"SEARCH" + b"".join(b" %d" % n for n in found))
+            return
+        res = b'ESEARCH (TAG "%s")' % tag
+        if uid:
+            res += b" UID"
+        if found and b"MIN" in returns:
+            res += b" MIN %d" % found[0]
+        if found and b"MAX" in returns:
+            res += b" MAX %d" % found[-1]
+        if b"COUNT" in returns:
+            res += b" COUNT %d" % len(found)
+        if found and b"ALL" in returns:
+            res += b" ALL %s" % compactSet(found)
+        self.untagged(res)
+    def expunge(self, uids, quiet=False):
+        box = self.needBox()
+        seq = 1
+        kept = []
+        for m in box.messages:
+            if "\\Deleted" in m.flags and (uids is None or m.uid in uids):
+                if not quiet:
+                    self.untagged(b"%d EXPUNGE" % seq)
+            else:
+                kept.append(m)
+                seq += 1
+        box.messages = kept
+    def cmd_EXPUNGE(self, tag, args, uid=False):
+        if self.readonly:
+            raise ImapError(b"NO", "mailbox is read-only")
+        uids = None
+        if uid:
+            uids = set(m.uid for _, m in self.messages(args[0], True))
+        self.expunge(uids)
+    def cmd_COPY(self, tag, args, uid=False, move=False):
+        target = self.getBox(args[1])
+        msgs = self.messages(args[0], uid)
+        src = []
+        dst = []
+        for seq, m in msgs:
+            new = target.add(m.root, m.internaldate, m.flags - {"\\Deleted"})
+            new.attachments = m.attachments
+            src.append(m.uid)
+            dst.append(new.uid)
+        code = b"[COPYUID %d %s %s]" % (target.uidvalidity, compactSet(src), compactSet(dst)) if src else b""
+        if move:
+            self.untagged(b"OK %s moved" % code)
+            for seq, m in reversed(msgs):
+                self.untagged(b"%d EXPUNGE" % seq)
+                self.box.messages.remove(m)
+            return b"OK done"
+        return b"OK %s copied" % code
+    def cmd_MOVE(self, tag, args, uid=False):
+        return self.cmd_COPY(tag, args, uid, True)
+
+
+class SimServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, mailboxes, latency=0, compress=True):
+        socketserver.ThreadingTCPServer.__init__(self, address, SimHandler)
+        self.mailboxes = mailboxes
+        # Seconds to wait before answering each round trip
+        self.latency = latency
+        self.compress = compress
+        self.capabilities = CAPABILITIES + (b" COMPRESS=DEFLATE" if compress else b"")
+        # Connections share the mailboxes
+        self.lock = threading.Lock()
+
+def startServer(server):
+    """Run server in a background thread; returns its port"""
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_address[1]
+
+def simServer(count, seed=1, port=0, latency=0, compress=True):
+    """Start a simulated server in the background. Returns (server, port)"""
+    server = SimServer(("127.0.0.1", port), makeMailboxes(count, seed), latency, compress)
+    return server, startServer(server)
+
+
+# Recording and replay
+
+REDACT = re.compile(rb"^(\S+ (?:LOGIN|AUTHENTICATE PLAIN)) .*$", re.I | re.S)
+COMPRESS = re.compile(rb"^(\S+) COMPRESS DEFLATE\r\n$", re.I)
+
+class RecordHandler(socketserver.BaseRequestHandler):
+    """Relays one client connection upstream, logging what passes"""
+    def handle(self):
+        server = self.server
+        with server.loglock:
+            conn = server.connections
+            server.connections += 1
+        upstream = socket.create_connection(server.upstream)
+        if server.tls:
+            upstream = ssl.create_default_context().wrap_socket(upstream, server_hostname=server.upstream[0])
+        client = self.request
+        sendlock = threading.Lock()
+        def log(direction, data, redacted=False):
+            rec = {"conn": conn, "t": round(time.time() - server.started, 6), "dir": direction, "data": data.decode("latin-1")}
+            if redacted:
+                rec["redacted"] = True
+            with server.loglock:
+                server.log.write(json.dumps(rec) + "\n")
+        def down():
+            try:
+                while True:
+                    data = upstream.recv(65536)
+                    if not data:
+                        break
+                    with sendlock:
+                        log("s", data)
+                        client.sendall(data)
+            except OSError:
+                pass
+            try:
+                client.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        thread = threading.Thread(target=down, daemon=True)
+        thread.start()
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                m = COMPRESS.match(data)
+                if m:
+                    with sendlock:
+                        log("c", data)
+                        reply = b"%s NO compression isn't recorded\r\n" % m.group(1)
+                        log("s", reply)
+                        client.sendall(reply)
+                    continue
+                m = REDACT.match(data)
+                if m:
+                    log("c", m.group(1) + b" <redacted>\r\n", True)
+                else:
+                    log("c", data)
+                upstream.sendall(data)
+        except OSError:
+            pass
+        try:
+            upstream.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        thread.join()
+        upstream.close()
+
+class RecordServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, upstream, tls, logfile):
+        socketserver.ThreadingTCPServer.__init__(self, address, RecordHandler)
+        self.upstream = upstream
+        self.tls = tls
+        self.log = open(logfile, "w", buffering=1)
+        self.loglock = threading.Lock()
+        self.connections = 0
+        self.started = time.time()
+        self.log.write(json.dumps({
+            "recorder": 1,
+            "upstream": "{}:{}".format(*upstream),
+            "tls": tls,
+            "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }) + "\n")
+    def server_close(self):
+        socketserver.ThreadingTCPServer.server_close(self)
+        self.log.close()
+
+def loadLog(path):
+    """Read a recorded log into a list of sessions.
+
+    Each session is a list of (direction, data, redacted, time) turns, with
+    consecutive chunks in the same direction merged.
+    """
+    sessions = {}
+    with open(path) as f:
+        for line in f:
+            rec = json.loads(line)
+            if "dir" not in rec:
+                continue
+            turns = sessions.setdefault(rec["conn"], [])
+            data = rec["data"].encode("latin-1")
+            redacted = rec.get("redacted", False)
+            if turns and turns[-1][0] == rec["dir"] and not redacted and not turns[-1][2]:
+                turns[-1] = (rec["dir"], turns[-1][1] + data, False, turns[-1][3])
+            else:
+                turns.append((rec["dir"], data, redacted, rec["t"]))
+    return [sessions[k] for k in sorted(sessions)]
+
+class ReplayHandler(socketserver.BaseRequestHandler):
+    """Plays one recorded session back to a client"""
+    def handle(self):
+        server = self.server
+        with server.lock:
+            n = server.connections
+            server.connections += 1
+        turns = server.sessions[n % len(server.sessions)]
+        sock = self.request
+        sock.settimeout(server.timeout)
+        buf = b""
+        last = None
+        try:
+            for i, (direction, data, redacted, when) in enumerate(turns):
+                if direction == "s":
+                    if server.realtime and last is not None:
+                        time.sleep(max(0, when - last))
+                    sock.sendall(data)
+                    last = when
+                    continue
+                if redacted:
+                    while b"\r\n" not in buf:
+                        more = sock.recv(65536)
+                        if not more:
+                            raise EOFError()
+                        buf += more
+                    got, buf = buf.split(b"\r\n", 1)
+                    expected = data.split(b" <redacted>")[0]
+                    got = got[:len(expected)]
+                else:
+                    while len(buf) < len(data):
+                        more = sock.recv(65536)
+                        if not more:
+                            raise EOFError()
+                        buf += more
+                    got, buf = buf[:len(data)], buf[len(data):]
+                    expected = data
+                if got.upper() != expected.upper():
+                    sys.stderr.write("replay: connection {} diverged at turn {}:\n  expected {!r}\n  got      {!r}\n".format(n, i, expected[:200], got[:200]))
+                    sock.sendall(b"* BYE replay diverged from the recording\r\n")
+                    return
+                last = when
+        except (EOFError, OSError) as ev:
+            sys.stderr.write("replay: connection {} ended early: {}\n".format(n, ev or "client closed"))
+
+class ReplayServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, address, logfile, realtime=False, timeout=10):
+        socketserver.ThreadingTCPServer.__init__(self, address, ReplayHandler)
+        self.sessions = loadLog(logfile)
+        if not self.sessions:
+            raise ValueError("no sessions recorded in {}".format(logfile))
+        self.realtime = realtime
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stand-in IMAP servers")
+    sub = parser.add_subparsers(dest="mode", required=True)
+    p = sub.add_parser("serve", help="serve a synthetic mailbox")
+    p.add_argument("--count", type=int, default=2000, help="messages in INBOX")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--port", type=int, default=1143)
+    p.add_argument("--latency", type=float, default=0, help="milliseconds added to each round trip")
+    p.add_argument("--no-compress", action="store_true", help="don't offer COMPRESS=DEFLATE")
+    p = sub.add_parser("record", help="relay to a real server, logging the traffic")
+    p.add_argument("--upstream", required=True, help="host:port of the real server")
+    p.add_argument("--tls", action="store_true", help="use TLS to the real server (e.g. port 993)")
+    p.add_argument("--log", required=True)
+    p.add_argument("--port", type=int, default=1143)
+    p = sub.add_parser("replay", help="serve a recorded log")
+    p.add_argument("--log", required=True)
+    p.add_argument("--port", type=int, default=1143)
+    p.add_argument("--realtime", action="store_true", help="keep the recorded delays between server responses")
+    args = parser.parse_args()
+    address = ("127.0.0.1", args.port)
+    if args.mode == "serve":
+        start = time.perf_counter()
+        server = SimServer(address, makeMailboxes(args.count, args.seed), args.latency / 1000.0, not args.no_compress)
+        print("Generated mailboxes in {:.2f}s:".format(time.perf_counter() - start))
+        for box in server.mailboxes.values():
+            print("  {:16} {:6} messages".format(box.name, len(box.messages)))
+    elif args.mode == "record":
+        host, _, port = args.upstream.rpartition(":")
+        server = RecordServer(address, (host, int(port)), args.tls, args.log)
+        print("Recording traffic to {} in {}".format(args.upstream, args.log))
+    else:
+        server = ReplayServer(address, args.log, args.realtime)
+        print("Replaying {} session(s) from {}".format(len(server.sessions), args.log))
+    print("Listening on {}:{}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
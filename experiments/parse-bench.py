@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# Microbenchmarks of the parsing core.
+#
+# Times processImapData, unpackStruct, unpackStructM, flattenStruct,
+# processHeaders, Envelope, dictifyList, getResultPart, MessageList, and
+# sanitize on fixed inputs: realistic FETCH responses and header blocks made
+# by imapsim.py's mailbox generator, plus nasty cases (deep and wide
+# multipart nesting, nested forwards, huge literals, many encoded words, long
+# References headers, control characters).
+#
+# For each case it reports operations per second (best of several timing
+# rounds) and, from tracemalloc, the peak memory allocated during one
+# operation and what the operation left allocated afterwards (including its
+# result). A case that raises is reported as an error rather than timed.
+#
+# Run from the top of the source tree:
+#
+#   python3 experiments/parse-bench.py [--time SECONDS] [--filter TEXT]
+#           [--output results.json] [--compare old.json [--threshold 1.2]]
+#
+# --compare exits non-zero if any case's operations per second dropped by
+# more than the threshold ratio.
+
+import os
+import sys
+import json
+import time
+import email
+import random
+import argparse
+import datetime
+import platform
+import tracemalloc
+import subprocess
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import imapsim
+
+def fetchResponse(items):
+    """The data of an untagged FETCH response, as the parser is given it"""
+    return b"(" + b" ".join(items) + b")"
+
+def deepMultipart(depth):
+    part = imapsim.textPart("innermost\n")
+    for i in range(depth):
+        part = imapsim.multipart("mixed", [imapsim.textPart("level {}\n".format(i)), part], "deep-{}".format(i))
+    return part
+
+def wideMultipart(width):
+    parts = [imapsim.textPart("part {}\n".format(i)) for i in range(width)]
+    return imapsim.multipart("mixed", parts, "wide")
+
+def nestedForwards(depth):
+    msg = imapsim.textPart("the original\n", headers=[("Subject", "original"), ("From", "a@example.com")])
+    for i in range(depth):
+        msg = imapsim.multipart("mixed", [imapsim.textPart("fwd {}\n".format(i)), imapsim.rfc822Part(msg)], "fwd-{}".format(i),
+                headers=[("Subject", "Fwd: level {}".format(i)), ("From", "b@example.com")])
+    return msg
+
+def encodedWords(count):
+    words = []
+    for i in range(count):
+        words.append(imapsim.encodeWord("ünïcödé {}".format(i)))
+    return " ".join(words)
+
+def buildCases(mailnex, options):
+    """Return [(name, function)]; each function does one operation"""
+    cases = []
+    gen = imapsim.Generator(1)
+    box = gen.mailbox("INBOX", 200)
+    msgs = box.messages
+
+    # FETCH responses
+    headers = [fetchResponse([
+        b"ENVELOPE " + imapsim.envelope(m.root),
+        b'INTERNALDATE "' + imapsim.internaldate(m.internaldate) + b'"',
+        b"FLAGS (" + " ".join(sorted(m.flags)).encode("ascii") + b")",
+        ]) for m in msgs[:50]]
+    structs = [fetchResponse([b"BODYSTRUCTURE " + imapsim.bodystructure(m.root)]) for m in msgs]
+    complexStructs = [s for s, m in zip(structs, msgs) if m.root.isMultipart()]
+    deep = fetchResponse([b"BODYSTRUCTURE " + imapsim.bodystructure(deepMultipart(40))])
+    wide = fetchResponse([b"BODYSTRUCTURE " + imapsim.bodystructure(wideMultipart(500))])
+    forwards = fetchResponse([b"BODYSTRUCTURE " + imapsim.bodystructure(nestedForwards(12))])
+    bigBody = random.Random(1).randbytes(4 * 1024 * 1024)
+    literal = fetchResponse([b"UID 42", b"BODY[] {%d}\r\n%s" % (len(bigBody), bigBody)])
+    manyLiterals = fetchResponse([b"UID 42"] + [b"BODY[%d] {%d}\r\n%s" % (i, 200, bigBody[:200]) for i in range(1, 500)])
+    quoted = fetchResponse([b'X-ITEM "%s"' % (b'esc\\"aped \\\\ text ' * 200)])
+
+    def parseAll(data):
+        def op():
+            for d in data:
+                mailnex.processImapData(d, options)
+        return op
+    cases.append(("processImapData envelopes x50", parseAll(headers)))
+    cases.append(("processImapData bodystructures x200", parseAll(structs)))
+    cases.append(("processImapData deep multipart (40)", parseAll([deep])))
+    cases.append(("processImapData wide multipart (500)", parseAll([wide])))
+    cases.append(("processImapData 4MiB literal", parseAll([literal])))
+    cases.append(("processImapData 500 small literals", parseAll([manyLiterals])))
+    cases.append(("processImapData escaped quoted string", parseAll([quoted])))
+
+    # Structures, pre-parsed. unpackStruct decodes some items in place, so
+    # every run after the first sees those already decoded.
+    def parsedStructs(data):
+        return [mailnex.getResultPart(b"BODYSTRUCTURE", mailnex.processImapData(d, options)[0]) for d in data]
+    def unpackAll(data):
+        parsed = parsedStructs(data)
+        def op():
+            for p in parsed:
+                mailnex.unpackStruct(p, options)
+        return op
+    cases.append(("unpackStruct multipart x{}".format(len(complexStructs)), unpackAll(complexStructs)))
+    cases.append(("unpackStruct deep multipart (40)", unpackAll([deep])))
+    cases.append(("unpackStruct wide multipart (500)", unpackAll([wide])))
+    cases.append(("unpackStruct nested forwards (12)", unpackAll([forwards])))
+    def flattenAll(data):
+        unpacked = [mailnex.unpackStruct(p, options) for p in parsedStructs(data)]
+        def op():
+            for u in unpacked:
+                mailnex.flattenStruct(u)
+        return op
+    cases.append(("flattenStruct multipart x{}".format(len(complexStructs)), flattenAll(complexStructs)))
+    cases.append(("flattenStruct wide multipart (500)", flattenAll([wide])))
+    cases.append(("flattenStruct nested forwards (12)", flattenAll([forwards])))
+    emails = [email.message_from_bytes(m.root.raw()) for m in msgs if m.root.isMultipart()]
+    wideEmail = email.message_from_bytes(wideMultipart(500).raw())
+    def unpackMAll(data):
+        def op():
+            for e in data:
+                mailnex.unpackStructM(e, options)
+        return op
+    cases.append(("unpackStructM multipart x{}".format(len(emails)), unpackMAll(emails)))
+    cases.append(("unpackStructM wide multipart (500)", unpackMAll([wideEmail])))
+
+    # Header blocks
+    blocks = [m.root.headerBytes() for m in msgs[:50]]
+    refs = " ".join("<{}.{}@example.com>".format(i, i * 7919) for i in range(500))
+    longRefs = (b"Message-ID: <x@example.com>\r\nReferences: " +
+            "\r\n ".join(refs[i:i + 70] for i in range(0, len(refs), 70)).encode("ascii") + b"\r\n\r\n")
+    words = encodedWords(200)
+    manyWords = (b"Subject: " + "\r\n ".join(words[i:i + 70] for i in range(0, len(words), 70)).encode("ascii") + b"\r\n\r\n")
+    manyReceived = b"".join(b"Received: from relay%d.example.net by mx.example.com; Mon, 1 Jan 2024 00:00:%02d +0000\r\n" % (i, i % 60) for i in range(300)) + b"\r\n"
+    def headersAll(data):
+        def op():
+            for b in data:
+                mailnex.processHeaders(b)
+        return op
+    cases.append(("processHeaders blocks x50", headersAll(blocks)))
+    cases.append(("processHeaders 500 references", headersAll([longRefs])))
+    cases.append(("processHeaders 200 encoded words", headersAll([manyWords])))
+    cases.append(("processHeaders 300 received", headersAll([manyReceived])))
+
+    # Key-value lists
+    params = mailnex.processImapData(b'("CHARSET" "utf-8" "FORMAT" "flowed" "DELSP" "yes")', options)[0]
+    bigParams = [b"KEY%d" % i if j == 0 else b"Value%d" % i for i in range(1000) for j in range(2)]
+    result = mailnex.processImapData(headers[0][:-1] + b" UID 17 RFC822.SIZE 12345 BODYSTRUCTURE NIL BODY[HEADER] NIL X-LAST 1)", options)[0]
+    cases.append(("dictifyList params", lambda: mailnex.dictifyList(params)))
+    cases.append(("dictifyList params preserveValue", lambda: mailnex.dictifyList(params, True)))
+    cases.append(("dictifyList 1000 pairs", lambda: mailnex.dictifyList(bigParams)))
+    cases.append(("getResultPart first of fetch", lambda: mailnex.getResultPart(b"ENVELOPE", result)))
+    cases.append(("getResultPart last of fetch", lambda: mailnex.getResultPart(b"X-LAST", result)))
+
+    # Envelopes, as the message cache holds them. Compare the retained
+    # memory of the two.
+    parsedEnvelopes = [mailnex.getResultPart(b"ENVELOPE", mailnex.processImapData(h, options)[0]) for h in headers]
+    cases.append(("envelopes x50 as parsed", lambda: [mailnex.getResultPart(b"ENVELOPE", mailnex.processImapData(h, options)[0]) for h in headers]))
+    cases.append(("envelopes x50 as Envelope", lambda: [mailnex.Envelope(*mailnex.getResultPart(b"ENVELOPE", mailnex.processImapData(h, options)[0])) for h in headers]))
+    def decodeEnvelopes():
+        for e in parsedEnvelopes:
+            e = mailnex.Envelope(*e)
+            e.subjectText
+            e.fromNames
+    cases.append(("Envelope decode x50", decodeEnvelopes))
+
+    # Message lists
+    shuffled = list(range(1, 2001))
+    random.Random(1).shuffle(shuffled)
+    sparse = list(range(1, 6000, 3))
+    full = mailnex.MessageList(range(1, 2001))
+    holes = mailnex.MessageList(sparse)
+    cases.append(("MessageList add 2000 in order", lambda: mailnex.MessageList(range(1, 2001))))
+    cases.append(("MessageList add 2000 shuffled", lambda: mailnex.MessageList(shuffled)))
+    cases.append(("MessageList add 2000 sparse", lambda: mailnex.MessageList(sparse)))
+    cases.append(("MessageList addRange 1-5000", lambda: mailnex.MessageList().addRange(1, 5000)))
+    cases.append(("MessageList imapListStr 2000 sparse", lambda: holes.imapListStr()))
+    cases.append(("MessageList iterate 2000", lambda: sum(full)))
+
+    # Terminal sanitizing
+    subject = "Re: [list] Weekly\tstatus\r\n  report \x1b[31mred\x1b[0m café \x07 done"
+    text = "".join(m.text for m in msgs[:20])
+    control = "".join(chr(i) for i in range(0, 0xa0)) * 50
+    cases.append(("sanitize subject", lambda: mailnex.sanitize(subject)))
+    cases.append(("sanitize subject no condense", lambda: mailnex.sanitize(subject, condense=False)))
+    cases.append(("sanitize subject caret", lambda: mailnex.sanitize(subject, replace=True)))
+    cases.append(("sanitize {}KB text".format(len(text) // 1024), lambda: mailnex.sanitize(text)))
+    cases.append(("sanitize control chars caret", lambda: mailnex.sanitize(control, replace=True)))
+    cases.append(("sanitize bytes subject", lambda: mailnex.sanitize(subject.encode("utf-8"))))
+    body = (text * (1024 * 1024 // len(text) + 1))[:1024 * 1024]
+    bodyBytes = body.encode("utf-8")
+    cases.append(("sanitize 1MiB body", lambda: mailnex.sanitize(body)))
+    cases.append(("sanitize 1MiB body no condense", lambda: mailnex.sanitize(body, condense=False)))
+    cases.append(("sanitize 1MiB body caret", lambda: mailnex.sanitize(body, replace=True)))
+    cases.append(("sanitize 1MiB body bytes", lambda: mailnex.sanitize(bodyBytes)))
+    return cases
+
+def measure(func, seconds):
+    """Return (ops/sec, peak bytes, retained bytes) for func"""
+    # Calibrate: enough calls per round to take about a tenth of the time
+    count = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(count):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed > seconds / 10 or count > 1 << 24:
+            break
+        count *= 2 if elapsed == 0 else max(2, min(10, int(seconds / 10 / elapsed) + 1))
+    best = elapsed / count
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        for _ in range(count):
+            func()
+        best = min(best, (time.perf_counter() - start) / count)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        res = func()
+        current, peak = tracemalloc.get_traced_memory()
+        del res
+    finally:
+        tracemalloc.stop()
+    return 1 / best if best else float("inf"), peak - before, current - before
+
+def gitCommit():
+    try:
+        res = subprocess.run(["git", "-C", TOP, "describe", "--always", "--dirty"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return res.stdout.decode().strip()
+
+def main():
+    parser = argparse.ArgumentParser(description="microbenchmarks of the parsing core")
+    parser.add_argument("--time", type=float, default=0.5, help="seconds of timing per case")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against earlier results")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+    args = parser.parse_args()
+
+    from mailnex import mailnex
+    options = mailnex.getOptionsSet()
+    cases = [(n, f) for n, f in buildCases(mailnex, options) if args.filter in n]
+    results = {}
+    print("{:42} {:>12} {:>12} {:>12} {:>12}".format("case", "ops/s", "us/op", "peak KiB", "retained B"))
+    for name, func in cases:
+        try:
+            func()
+        except Exception as ev:
+            results[name] = {"error": "{}: {}".format(type(ev).__name__, ev)}
+            print("{:42} error: {}".format(name, results[name]["error"]))
+            continue
+        ops, peak, retained = measure(func, args.time)
+        results[name] = {"ops": ops, "peak": peak, "retained": retained}
+        print("{:42} {:12.1f} {:12.2f} {:12.1f} {:12}".format(name, ops, 1e6 / ops, peak / 1024, retained))
+
+    out = {
+            "benchmark": "parse-bench",
+            "when": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": gitCommit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cases": results,
+            }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2)
+            f.write("\n")
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print("\nAgainst {} ({}, {}):".format(args.compare, old.get("when"), old.get("commit")))
+        for name, r in results.items():
+            o = old["cases"].get(name)
+            if "ops" not in r or not o or "ops" not in o:
+                continue
+            ratio = o["ops"] / r["ops"]
+            mark = ""
+            if ratio > args.threshold:
+                mark = "  REGRESSION"
+                failed = True
+            print("  {:42} {:12.1f} -> {:12.1f} ops/s  x{:.2f}{}".format(name, o["ops"], r["ops"], r["ops"] / o["ops"], mark))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Time the prompt's work per keystroke.
+#
+# Every key typed at the prompt reruns the lexer over the whole line (for
+# highlighting) and asks the completer for completions (for the completion
+# menu while typing). This types some command lines, one character at a
+# time, and times both for each keystroke, without a terminal.
+#
+# The lines are long ones, since the lexer's cost grows with the line: a
+# message list, a write to a long path, a set of a long headline, help, and
+# a line that isn't a command at all.
+#
+# Run from the top of the source tree:
+#
+#   python3 experiments/prompt-latency.py [--repeat N] [--budget MS]
+#
+# --budget exits non-zero if the 99th percentile keystroke took longer than
+# that many milliseconds.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+
+LINES = [
+        "headers 1-20,25,30-40 :u :f " + " ".join(str(i) for i in range(100, 400, 3)),
+        "write 1:200 " + "/home/someone/" + "/".join("directory{}".format(i) for i in range(40)) + "/messages.mbox",
+        'set headline="' + "%>%a%m %-18f %-16d %4l/%-5o %i%-S " * 8 + '"',
+        "help headers",
+        "help he",
+        "nosuchcommand " + "x" * 300,
+        ]
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def main():
+    parser = argparse.ArgumentParser(description="time the prompt's lexer and completer per keystroke")
+    parser.add_argument("--repeat", type=int, default=5, help="times to type each line")
+    parser.add_argument("--budget", type=float, help="fail if the p99 keystroke takes longer (milliseconds)")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="prompt-latency.")
+    # mailnex works out its cache and data paths on import; keep it out of
+    # the user's
+    for name in ("XDG_CACHE_HOME", "XDG_DATA_HOME", "XDG_CONFIG_HOME"):
+        os.environ[name] = os.path.join(scratch, name.lower())
+    from prompt_toolkit.document import Document
+    from prompt_toolkit.completion import CompleteEvent
+    from prompt_toolkit.lexers import PygmentsLexer
+    from mailnex import mailnex, cmdprompt
+
+    cmd = mailnex.Cmd(prompt="latency> ")
+    C = mailnex.Context()
+    C.settings = mailnex.getOptionsSet()
+    cmd.C = C
+    lexer = PygmentsLexer(cmdprompt.PromptLexerFactory(cmd))
+    event = CompleteEvent(text_inserted=True)
+
+    print("{:<16} {:>6} {:>10} {:>10} {:>10}".format("line", "keys", "p50", "p99", "max"))
+    every = []
+    for line in LINES:
+        times = []
+        for _ in range(args.repeat):
+            for end in range(1, len(line) + 1):
+                document = Document(line[:end])
+                start = time.perf_counter()
+                lexer.lex_document(document)(0)
+                list(cmd.completer.get_completions(document, event))
+                times.append(time.perf_counter() - start)
+        every.extend(times)
+        print("{:<16} {:6} {:>8.1f}us {:>8.1f}us {:>8.1f}us".format(
+            line[:16], len(line), percentile(times, 0.5) * 1e6,
+            percentile(times, 0.99) * 1e6, max(times) * 1e6))
+    p99 = percentile(every, 0.99)
+    print("{:<16} {:6} {:>8.1f}us {:>8.1f}us {:>8.1f}us".format(
+        "all", len(every), percentile(every, 0.5) * 1e6, p99 * 1e6, max(every) * 1e6))
+    if args.budget is not None and p99 * 1000 > args.budget:
+        print("p99 {:.2f}ms is over the budget of {}ms".format(p99 * 1000, args.budget))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
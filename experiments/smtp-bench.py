@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Benchmark the SMTP client against a local sink server.
+#
+# Starts a minimal SMTP server on localhost that accepts and discards
+# everything, then times sending a large message with:
+#
+#   * legacy    - the old way: one send() per line, recv(1024) per reply
+#   * data      - smtpClient with DATA (no server extensions)
+#   * pipeline  - smtpClient with PIPELINING
+#   * chunking  - smtpClient with PIPELINING and CHUNKING (BDAT)
+#
+# Run from the top of the source tree:
+#
+#   python3 experiments/smtp-bench.py [size-in-MB] [recipients]
+
+import os
+import sys
+import socket
+import socketserver
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from mailnex import smtp
+
+class SinkHandler(socketserver.BaseRequestHandler):
+    extensions = []
+    def handle(self):
+        sock = self.request
+        buf = b""
+        def readline():
+            nonlocal buf
+            while b"\r\n" not in buf:
+                data = sock.recv(65536)
+                if not data:
+                    raise EOFError()
+                buf += data
+            line, buf = buf.split(b"\r\n", 1)
+            return line
+        def readexact(count):
+            nonlocal buf
+            while len(buf) < count:
+                data = sock.recv(max(65536, count - len(buf)))
+                if not data:
+                    raise EOFError()
+                buf += data
+            data, buf = buf[:count], buf[count:]
+            return data
+        sock.sendall(b"220 sink ready\r\n")
+        try:
+            while True:
+                line = readline()
+                verb = line.split(b" ", 1)[0].upper()
+                if verb == b"EHLO":
+                    lines = [b"sink"] + self.extensions
+                    reply = b"".join(b"250-%s\r\n" % l for l in lines[:-1]) + b"250 %s\r\n" % lines[-1]
+                    sock.sendall(reply)
+                elif verb == b"DATA":
+                    sock.sendall(b"354 go ahead\r\n")
+                    # Only search what arrived since the last look (plus
+                    # enough before it for a terminator split across reads)
+                    end = buf.find(b"\r\n.\r\n")
+                    while end < 0:
+                        data = sock.recv(1024 * 1024)
+                        if not data:
+                            raise EOFError()
+                        start = max(0, len(buf) - 4)
+                        buf += data
+                        end = buf.find(b"\r\n.\r\n", start)
+                    buf = buf[end + 5:]
+                    sock.sendall(b"250 queued\r\n")
+                elif verb == b"BDAT":
+                    readexact(int(line.split()[1]))
+                    sock.sendall(b"250 ok\r\n")
+                elif verb == b"QUIT":
+                    sock.sendall(b"221 bye\r\n")
+                    return
+                else:
+                    sock.sendall(b"250 ok\r\n")
+        except EOFError:
+            return
+
+def startServer(extensions):
+    handler = type("Handler", (SinkHandler,), {'extensions': extensions})
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def legacySend(port, from_, to, message):
+    """Replica of the original smtpClient.sendmail loop"""
+    s = socket.create_connection(("127.0.0.1", port))
+    s.recv(1024)
+    s.send(b"EHLO bench\r\n")
+    s.recv(1024)
+    s.send(b"MAIL FROM:<%s>\r\n" % from_)
+    s.recv(1024)
+    for i in to:
+        s.send(b"RCPT TO:<%s>\r\n" % i)
+        s.recv(1024)
+    s.send(b"DATA\r\n")
+    s.recv(1024)
+    for line in message.split(b'\n'):
+        if line.endswith(b'\r'):
+            line = line[:-1]
+        if line.startswith(b"."):
+            line = b'.' + line
+        s.send(line + b'\r\n')
+    s.send(b'.\r\n')
+    s.recv(1024)
+    s.send(b"QUIT\r\n")
+    s.recv(1024)
+    s.close()
+
+def clientSend(port, from_, to, message):
+    c = smtp.smtpClient()
+    c.connect("127.0.0.1", port, smtp.SEC_NONE)
+    c.sendmail(from_, to, message)
+    c.quit()
+
+def makeMessage(size):
+    # Roughly what a base64 attachment looks like: 76 character lines, with
+    # the occasional line starting with a dot to exercise dot-stuffing.
+    line = b"QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9wcXJzdHV2d3h5ejAxMjM0\n"
+    dotline = b".dotted line that needs stuffing\n"
+    block = line * 99 + dotline
+    head = b"From: bench@example.com\nTo: sink@example.com\nSubject: bench\n\n"
+    return head + block * (size // len(block) + 1)
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    nrcpt = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    message = makeMessage(size * 1024 * 1024)
+    to = [b"rcpt%d@example.com" % i for i in range(nrcpt)]
+    cases = [
+            ("legacy", [], legacySend),
+            ("data", [], clientSend),
+            ("pipeline", [b"PIPELINING"], clientSend),
+            ("chunking", [b"PIPELINING", b"CHUNKING"], clientSend),
+            ]
+    print("message {:.1f} MB, {} recipients".format(len(message) / 1024 / 1024, nrcpt))
+    for name, extensions, func in cases:
+        server = startServer(extensions)
+        port = server.server_address[1]
+        start = time.perf_counter()
+        func(port, b"bench@example.com", to, message)
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+        print("{:10} {:8.3f}s {:8.1f} MB/s".format(name, elapsed, len(message) / 1024 / 1024 / elapsed))
+
+if __name__ == "__main__":
+    main()
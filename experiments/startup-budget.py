@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Check that starting mailnex stays within a time budget.
+#
+# Starts mailnex in fresh interpreters, up to the first time the command
+# prompt is drawn (with no configuration, so no folder is opened), and fails
+# if the best of several runs is over the budget, or if any module that
+# should only be loaded on first use got imported by then.
+#
+# Run from the top of the source tree:
+#
+#   python3 experiments/startup-budget.py [budget-seconds] [runs]
+#
+# Exits non-zero on failure, so it can be used as a regression check. For a
+# per-module breakdown of a failure, try:
+#
+#   python3 -X importtime -c 'import mailnex.mailnex' 2>&1 | sort -t'|' -k2 -n | tail
+#
+# or 'mailnex --startup-profile' for the time after the imports.
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+# Modules mailnex defers until they are needed
+DEFERRED = ["xapian", "gpg", "gpgme", "keyring", "dateutil", "mailcap", "magic", "pygments.lexers"]
+
+PROBE = """
+import os, sys, time, json
+start = time.perf_counter()
+from prompt_toolkit.application import create_app_session
+from prompt_toolkit.input import create_pipe_input
+from prompt_toolkit.output import DummyOutput
+import mailnex.mailnex
+
+def firstPrompt(app):
+    elapsed = time.perf_counter() - start
+    sys.stdout.write(json.dumps({"elapsed": elapsed, "loaded": [m for m in %r if m in sys.modules]}) + "\\n")
+    sys.stdout.flush()
+    # That's all we wanted; don't bother shutting down
+    os._exit(0)
+
+cmdSingle = mailnex.mailnex.Cmd.cmdSingle
+async def hooked(self):
+    self.cli.app.after_render += firstPrompt
+    return await cmdSingle(self)
+mailnex.mailnex.Cmd.cmdSingle = hooked
+sys.argv = ["mailnex"]
+inp = create_pipe_input()
+if hasattr(inp, "__enter__"):
+    # Newer prompt_toolkit gives a context manager
+    inp = inp.__enter__()
+with create_app_session(input=inp, output=DummyOutput()):
+    mailnex.mailnex.main()
+""" % (DEFERRED,)
+
+def probe(top, scratch):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = top + os.pathsep + env.get("PYTHONPATH", "")
+    # Keep the probe from creating directories in the user's home
+    env["XDG_CACHE_HOME"] = os.path.join(scratch, "cache")
+    env["XDG_DATA_HOME"] = os.path.join(scratch, "data")
+    # ...or reading the user's configuration
+    env["XDG_CONFIG_HOME"] = os.path.join(scratch, "config")
+    res = subprocess.run([sys.executable, "-c", PROBE], env=env, stdout=subprocess.PIPE, check=True)
+    # mailnex prints a few things of its own on the way
+    return json.loads([l for l in res.stdout.decode().splitlines() if l.startswith("{")][-1])
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    top = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    with tempfile.TemporaryDirectory() as scratch:
+        # The first run also warms the bytecode cache; don't count it
+        probe(top, scratch)
+        results = [probe(top, scratch) for _ in range(runs)]
+    times = sorted(r["elapsed"] for r in results)
+    loaded = sorted(set(m for r in results for m in r["loaded"]))
+    print("time to first prompt: best {:.3f}s, median {:.3f}s, budget {:.3f}s".format(
+        times[0], times[len(times) // 2], budget))
+    failed = False
+    if times[0] > budget:
+        print("FAIL: over budget")
+        failed = True
+    if loaded:
+        print("FAIL: deferred modules imported at startup: {}".format(", ".join(loaded)))
+        failed = True
+    if not failed:
+        print("ok")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
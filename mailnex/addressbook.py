@@ -0,0 +1,249 @@
+# Local address book, for completing recipients.
+#
+# Completing an address used to mean running the addresssearchcmd for every
+# completion, and waiting on it with the prompt blocked. Instead, we remember
+# the addresses in the envelopes of messages we fetch (From, To, and Cc) and
+# of messages we send, and complete from those without leaving the process.
+# The external command still runs, in the background, and whatever it finds
+# is added to the completions when it finishes (and remembered for next
+# time).
+#
+# Each address has a score: the number of times we've seen it, weighted by
+# how (sending to someone counts for much more than them being copied on a
+# message we received), and decayed by age so that people we corresponded
+# with recently come first.
+#
+# For lookup, every address is filed under its lower-cased address, its
+# name, and each word of its name, in one sorted list. Completing a prefix is
+# a bisect into that list and a walk along the keys starting with it.
+#
+# The book is kept as JSON in the data directory. It is loaded on first use
+# and saved when the program exits.
+
+import os
+import json
+import time
+import bisect
+import email.header
+import email.utils
+from . import trace
+
+# How much seeing an address counts for, by where it was seen
+FROM_WEIGHT = 1.0
+COPIED_WEIGHT = 0.25
+SENT_WEIGHT = 4.0
+EXTERNAL_WEIGHT = 0.0
+
+# Scores halve over this many seconds
+HALF_LIFE = 90 * 24 * 60 * 60
+
+# Message-IDs remembered, so that refetching a message doesn't count its
+# addresses again
+SEEN_LIMIT = 20000
+
+# Most keys looked at when completing a very short prefix
+SCAN_LIMIT = 5000
+
+def decodeName(name):
+    """Decode the name part of an IMAP envelope address"""
+    if name in (None, b'NIL'):
+        return ""
+    if b"=?" not in name:
+        return name.decode("utf-8", "replace").strip().strip('"')
+    try:
+        name = str(email.header.make_header(email.header.decode_header(name.decode("ascii"))))
+    except Exception:
+        name = name.decode("utf-8", "replace")
+    return name.strip().strip('"')
+
+def envelopeAddresses(field):
+    """Return (address, name) for each address of an IMAP envelope field.
+
+    Skips the markers of group syntax, which have no host.
+    """
+    res = []
+    if field in (None, b'NIL'):
+        return res
+    for addr in field:
+        name, adl, mailbox, host = addr
+        if mailbox in (None, b'NIL') or host in (None, b'NIL'):
+            continue
+        res.append(("{}@{}".format(mailbox.decode("utf-8", "replace"), host.decode("utf-8", "replace")), decodeName(name)))
+    return res
+
+def envelopeTime(date):
+    """Return the time of an IMAP envelope date, or None"""
+    if date in (None, b'NIL'):
+        return None
+    try:
+        parsed = email.utils.parsedate_tz(date.decode("ascii", "replace"))
+    except Exception:
+        return None
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+class Entry(object):
+    """One remembered address"""
+    __slots__ = ('address', 'name', 'score', 'last', 'seen', 'sent')
+    def __init__(self, address, name="", score=0.0, last=0.0, seen=0, sent=0):
+        self.address = address
+        self.name = name
+        # Score as of time 'last'
+        self.score = score
+        self.last = last
+        # Times seen in messages, and times we sent to it
+        self.seen = seen
+        self.sent = sent
+    def current(self, now):
+        """Return the score, decayed to time now"""
+        return self.score * 0.5 ** (max(0, now - self.last) / HALF_LIFE)
+    def keys(self):
+        res = {self.address.lower()}
+        name = self.name.lower()
+        if name:
+            res.add(name)
+            res.update(name.replace('"', ' ').replace(',', ' ').split())
+        return res
+
+class AddressBook(object):
+    """Addresses seen in messages, for completion"""
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.loaded = False
+        self.dirty = False
+        # Lower-cased address -> Entry
+        self.entries = {}
+        # Sorted (key, lower-cased address) pairs
+        self.keys = []
+        # Message-IDs already counted, oldest first
+        self.seen = {}
+    def load(self):
+        """Read the book from disk, if we haven't yet"""
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ev:
+            if trace.general:
+                trace.event("general", "addressbook: can't read {}: {}".format(self.path, ev))
+            return
+        for item in data.get("addresses", []):
+            entry = Entry(*item)
+            self.entries[entry.address.lower()] = entry
+        self.seen = dict.fromkeys(data.get("seen", []))
+        self._reindex()
+    def save(self):
+        """Write the book to disk if it changed"""
+        if not self.dirty:
+            return
+        data = {
+                "version": 1,
+                "addresses": [[e.address, e.name, e.score, e.last, e.seen, e.sent] for e in self.entries.values()],
+                "seen": list(self.seen),
+                }
+        # Write to a temporary file and rename, so that a second instance
+        # reading the file never sees half of it.
+        tmpname = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(tmpname, "w") as f:
+                json.dump(data, f)
+            os.rename(tmpname, self.path)
+        except OSError as ev:
+            if trace.general:
+                trace.event("general", "addressbook: can't write {}: {}".format(self.path, ev))
+            return
+        self.dirty = False
+    def _reindex(self):
+        self.keys = sorted((key, addr) for addr, entry in self.entries.items() for key in entry.keys())
+    def note(self, address, name, weight, when=None, sent=False):
+        """Count one sighting of an address"""
+        self.load()
+        now = time.time()
+        when = now if when is None else min(when, now)
+        lower = address.lower()
+        entry = self.entries.get(lower)
+        if entry is None:
+            entry = self.entries[lower] = Entry(address, name)
+            for key in entry.keys():
+                bisect.insort(self.keys, (key, lower))
+        elif name and name != entry.name:
+            # Keep the latest name people go by
+            old = entry.keys()
+            entry.name = name
+            for key in entry.keys() - old:
+                bisect.insort(self.keys, (key, lower))
+        if when >= entry.last:
+            entry.score = entry.current(when) + weight
+            entry.last = when
+        else:
+            # Older than what we have; decay it to our time instead
+            entry.score += weight * 0.5 ** ((entry.last - when) / HALF_LIFE)
+        if sent:
+            entry.sent += 1
+        elif weight:
+            entry.seen += 1
+        self.dirty = True
+    def addEnvelope(self, envelope, sent=False):
+        """Count the addresses of a message, given its IMAP envelope.
+
+        With sent, the message is one we sent (e.g. it is in the folder sent
+        messages are saved to), so its recipients count for much more.
+        Messages already counted (by Message-ID) are skipped.
+        """
+        self.load()
+        messageId = envelope[9]
+        if messageId not in (None, b'NIL'):
+            messageId = messageId.decode("utf-8", "replace")
+            if messageId in self.seen:
+                return
+            self.seen[messageId] = None
+            if len(self.seen) > SEEN_LIMIT:
+                del self.seen[next(iter(self.seen))]
+        when = envelopeTime(envelope[0])
+        if sent:
+            for field in (envelope[5], envelope[6]):
+                for address, name in envelopeAddresses(field):
+                    self.note(address, name, SENT_WEIGHT, when, sent=True)
+        else:
+            for address, name in envelopeAddresses(envelope[2]):
+                self.note(address, name, FROM_WEIGHT, when)
+            for field in (envelope[5], envelope[6]):
+                for address, name in envelopeAddresses(field):
+                    self.note(address, name, COPIED_WEIGHT, when)
+        self.dirty = True
+    def addSent(self, recipients):
+        """Count the (name, address) pairs of a message we are sending"""
+        for name, address in recipients:
+            if address:
+                self.note(address, name, SENT_WEIGHT, sent=True)
+    def addExternal(self, results):
+        """Remember (address, name) pairs found by the addresssearchcmd"""
+        for address, name in results:
+            if address:
+                self.note(address, name, EXTERNAL_WEIGHT)
+    def search(self, text, limit=10):
+        """Return the best Entry objects for a completion prefix"""
+        self.load()
+        text = text.strip().lower()
+        now = time.time()
+        found = set()
+        pos = bisect.bisect_left(self.keys, (text,))
+        end = min(len(self.keys), pos + SCAN_LIMIT)
+        while pos < end:
+            key, addr = self.keys[pos]
+            if not key.startswith(text):
+                break
+            found.add(addr)
+            pos += 1
+        entries = [self.entries[addr] for addr in found]
+        entries.sort(key=lambda e: (-e.current(now), e.address.lower()))
+        return entries[:limit]
+    def __len__(self):
+        self.load()
+        return len(self.entries)
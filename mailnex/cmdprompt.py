@@ -1,4 +1,5 @@
 import cmd
+import bisect
 import inspect
 import prompt_toolkit
 
@@ -7,10 +8,8 @@ from pygments.lexer import Lexer
 from pygments.token import *
 from prompt_toolkit.lexers import PygmentsLexer
 from pygments.token import Token
-from pygments.styles.tango import TangoStyle
 from prompt_toolkit.styles import style_from_pygments_cls
 from prompt_toolkit.shortcuts import set_title
-from pygments.lexers import HtmlLexer
 #from prompt_toolkit.key_binding.manager import KeyBindingManager
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.keys import Keys
@@ -41,20 +40,21 @@ def PromptLexerFactory(cmd_obj):
             if len(data) == 0:
                 return []
             if len(data) > 0:
-                if u"do_{}".format(command) in dir(self.cmd):
+                if command in self.cmd.commandSet:
                     res.append((0, Generic.Inserted, command))
                 else:
                     res.append((0, Token.Text, text))
                     return res
             if len(data) > 1:
-                if u"lex_{}".format(command) in dir(self.cmd):
+                lexer = self.cmd.lexers.get(command)
+                if lexer is not None:
                     # TODO: require each command to add the space?
                     # Looks simpler, codewise, to do it here. But, since
                     # this generates its own token, does Pygments waste
                     # terminal bandwidth sending extra codes for the one
                     # space?
                     res.append((len(data) + 1, Token.Text, " "))
-                    getattr(self.cmd, "lex_{}".format(command))(len(data) + 1, text, rest, res)
+                    lexer(len(data) + 1, text, rest, res)
                 else:
                     res.append((len(data) + 1, Token.Text, " " + rest))
             return res
@@ -105,9 +105,9 @@ class Completer(prompt_toolkit.completion.Completer):
             return
         start_words = document.current_line.split(None,1)
         command = start_words[0]
-        symbol = u"compl_{}".format(command)
-        if symbol in dir(self.cmd):
-            gen = getattr(self.cmd, symbol)(document, complete_event)
+        completer = self.cmd.completers.get(command)
+        if completer is not None:
+            gen = completer(document, complete_event)
             yield from gen
 
 class CmdPrompt(cmd.Cmd):
@@ -134,6 +134,7 @@ class CmdPrompt(cmd.Cmd):
         return self.title
     def __init__(self, prompt=None, histfile=None, eventloop=None):
         cmd.Cmd.__init__(self)
+        self.refreshCommands()
         self.title = u"mailnex"
         self.completer = Completer(self)
         # ttyBusy tracks times when printing is a Bad Idea
@@ -190,13 +191,51 @@ class CmdPrompt(cmd.Cmd):
         # For example, 1 line for command prompt, 7 lines for completion menu,
         # 1 line for toolbar.
         self.ui_lines = 9
-        self.status = {'unread': None}
+        self.status = {'unread': None, 'folders': []}
         self.cli.run_in_terminal = run_in_terminal
+    def refreshCommands(self):
+        """Build the tables of commands, help topics, lexers, and completers.
+
+        The lexer runs on every keystroke, so it looks things up here rather
+        than searching dir() each time. Commands set on the instance update
+        the tables automatically; call this after adding them any other way
+        (e.g. to the class).
+        """
+        names = dir(self)
+        # Sorted command names (without 'do_'), for completion by prefix
+        self.commandNames = sorted(n[3:] for n in names if n.startswith("do_"))
+        self.commandSet = frozenset(self.commandNames)
+        # Commands and other help_ topics
+        self.helpTopics = sorted(self.commandSet.union(n[5:] for n in names if n.startswith("help_")))
+        self.helpTopicSet = frozenset(self.helpTopics)
+        # Command name -> bound lex_ and compl_ methods
+        self.lexers = dict((n[4:], getattr(self, n)) for n in names if n.startswith("lex_"))
+        self.completers = dict((n[6:], getattr(self, n)) for n in names if n.startswith("compl_"))
+    def __setattr__(self, name, value):
+        cmd.Cmd.__setattr__(self, name, value)
+        if name.startswith(("do_", "help_", "lex_", "compl_")) and "commandSet" in self.__dict__:
+            self.refreshCommands()
+    def completenames(self, text, *ignored):
+        """Return the commands starting with text"""
+        names = self.commandNames
+        res = []
+        i = bisect.bisect_left(names, text)
+        while i < len(names) and names[i].startswith(text):
+            res.append(names[i])
+            i += 1
+        return res
     def toolbar(self, cli=None):
-        return [
+        res = [
                 ('class:bottom-toolbar', " Unread: "),
                 ('class:heading', str(self.status['unread'])),
                 ]
+        # Watched folders, as name: unread (+new)
+        for box, unread, new in self.status['folders']:
+            res.append(('class:bottom-toolbar', "  {}: ".format(box)))
+            res.append(('class:heading', str(unread)))
+            if new:
+                res.append(('class:bottom-toolbar', " (+{})".format(new)))
+        return res
 
     def setPrompt(self, newprompt):
         """Set the prompt string"""
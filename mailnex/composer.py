@@ -1,28 +1,36 @@
 from __future__ import print_function
 from __future__ import unicode_literals
-import magic
 import email.mime
 import email.mime.base
 import email.mime.text
 import email.mime.multipart
 import string
 import tempfile
+import shutil
+import base64
+import re
+import uuid
 from . import cmdprompt
+from . import lazy
 from .exceptions import MailnexException
 from .pathcompleter import *
 import inspect
 
-haveGpg = False
-haveGpgme = False
-try:
-    import gpg
-    haveGpg = True
-except ImportError:
-    try:
-        import gpgme
-        haveGpgme = True
-    except ImportError:
-        pass
+# Attachments are read and encoded this much at a time. This is a multiple of
+# 57 bytes, so that each block base64 encodes to whole 76 character lines.
+ATTACH_BLOCK = 57 * 16384
+
+# Bytes that can go into a message unencoded.
+# Note: string.printable would be better, but it includes vertical tab and
+# form-feed, which I'm not certain should be included in emails, so we'll
+# construct our own without it for now.
+printableBytes = (string.digits + string.ascii_letters + string.punctuation + ' \t\r\n').encode('ascii')
+
+# libmagic is only needed once something gets attached
+magic = lazy.LazyModule("magic")
+
+haveGpg = lazy.available("gpg")
+haveGpgme = not haveGpg and lazy.available("gpgme")
 
 
 def attachFile(attachList, filename, pos=None, replace=False):
@@ -526,34 +534,108 @@ class editorCmds(object):
     # contents), and to add/edit arbitrary message parts. Should be
     # able to mark parts for signing, encryption, compression, etc.
 
-def doAttachments(editor, m):
+def sniffFile(path):
+    """Work out the mime type of a file, and whether it needs encoding.
+
+    Only the first block is given to libmagic (which by default doesn't look
+    any further than that anyway). The whole file is checked for
+    non-printable bytes, but a block at a time and stopping at the first
+    one.
+
+    Returns a tuple of (mimetype, binary).
+    """
+    binary = False
+    with open(path, "rb") as f:
+        data = f.read(ATTACH_BLOCK)
+        mtype = magic.from_buffer(data, mime=True)
+        while data:
+            # Deleting all the printable bytes leaves nothing behind for text
+            if data.translate(None, printableBytes):
+                binary = True
+                break
+            data = f.read(ATTACH_BLOCK)
+    return mtype, binary
+
+def encodeFile(path, binary):
+    """Yield the content of a file a block at a time, base64 encoded if binary"""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(ATTACH_BLOCK)
+            if not data:
+                break
+            if binary:
+                # Blocks are a multiple of 57 bytes, so this is the same as
+                # encoding the whole file in one go.
+                data = base64.encodebytes(data)
+            yield data
+
+class FileAttachment(email.mime.base.MIMEBase):
+    """An attachment that stays in its file until the message is written out.
+
+    The payload is just a placeholder line. Flattening the message gives the
+    headers and structure (which are small) and streamMessage fills in the
+    file content while sending.
+
+    Note that the generator can't check multipart boundaries against content
+    it hasn't seen. Base64 lines can never look like a boundary; a printable
+    file would have to contain the randomly chosen boundary itself.
+    """
+    def __init__(self, path, mtype, binary):
+        email.mime.base.MIMEBase.__init__(self, *mtype.split("/"))
+        self.path = path
+        self.binary = binary
+        self.token = "mailnex-attachment-{}".format(uuid.uuid4().hex)
+        self.set_payload(self.token)
+        if binary:
+            self['Content-Transfer-Encoding'] = 'base64'
+
+def streamMessage(text, m):
+    """Yield a flattened message as bytes, filling in FileAttachment content.
+
+    text is the message m as flattened by a Generator.
+    """
+    attachments = {part.token: part for part in m.walk() if isinstance(part, FileAttachment)}
+    if not attachments:
+        yield text.encode('ascii')
+        return
+    pos = 0
+    for match in re.finditer("|".join(attachments), text):
+        yield text[pos:match.start()].encode('ascii')
+        part = attachments[match.group()]
+        yield from encodeFile(part.path, part.binary)
+        pos = match.end()
+    yield text[pos:].encode('ascii')
+
+def doAttachments(editor, m, stream=True):
     """Given an editor instance and a message, apply the attachment list of the editor to the message.
 
     Returns a message consisting of the given message with added attachments.
+
+    With stream set, attachments are left in their files, and the message
+    must be written out with streamMessage. Otherwise, the attachments are
+    read into the message.
     """
     for attach in editor.attachlist:
         try:
-            with open(attach, "rb") as f:
-                data = f.read()
-                mtype = magic.from_buffer(data, mime=True)
+            mtype, binary = sniffFile(attach)
+            # TODO: Allow the user to override the detected mime type
+            # TODO: Allow user to override the encoding (e.g. force base64 or quopri)
+            if stream:
+                entity = FileAttachment(attach, mtype, binary)
+            else:
+                entity = email.mime.base.MIMEBase(*mtype.split("/"))
+                data = b"".join(encodeFile(attach, binary))
+                if binary:
+                    entity.set_payload(data.decode('ascii'))
+                    entity['Content-Transfer-Encoding'] = 'base64'
+                else:
+                    entity.set_payload(data)
         except KeyboardInterrupt:
             print("Aborting read of %s" % attach)
             raise MailnexException("read aborted")
         except Exception as err:
             print("Error reading file %s for attachment" % attach)
             raise err
-        # TODO: Allow the user to override the detected mime type
-        entity = email.mime.base.MIMEBase(*mtype.split("/"))
-        entity.set_payload(data)
-
-        # Note: string.printable would be better, but it includes vertical
-        # tab and form-feed, which I'm not certain should be included in
-        # emails, so we'll construct our own without it for now.
-        printable = string.digits + string.ascii_letters + string.punctuation + ' \t\r\n'
-        printable = printable.encode('ascii')
-        if not all(c in printable for c in data):
-            # TODO: Allow user to override this (e.g. force base64 or quopri)
-            email.encoders.encode_base64(entity)
         entity.add_header('Content-Disposition', 'attachment', filename=attach.split(os.sep)[-1])
         if not isinstance(m, email.mime.multipart.MIMEMultipart):
             # Convert into multipart/mixed
@@ -582,6 +664,10 @@ def doAttachments(editor, m):
             n.attach(o)
             m = n
         m.attach(entity)
+    return m
+
+def cleanupAttachments(editor):
+    """Remove attachments the editor created, once the message is sent or abandoned"""
     if editor.tmpdir:
         shutil.rmtree(editor.tmpdir)
-    return m
+        editor.tmpdir = None
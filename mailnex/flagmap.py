@@ -0,0 +1,177 @@
+# Flags of every message in the selected folder, by sequence number.
+#
+# Moving to the next interesting page (Z), the unread count, and the :u and
+# :f message specifiers all used to ask the server to search the folder each
+# time. Instead, we learn the flags we care about once, when the folder is
+# opened (a few searches sent with the SELECT, in the same round trip), and
+# keep them up to date from the untagged EXISTS, EXPUNGE, and FETCH
+# responses the server sends anyway.
+#
+# The flags are one byte per message in a bytearray, one bit per flag; byte
+# 0 is unused so that sequence numbers index directly. Questions about the
+# folder are asked with a predicate: a translate table mapping each flag byte
+# to 1 if the message matches and 0 if not. Translating the whole array and
+# counting or finding the ones is done in C, so even folders of hundreds of
+# thousands of messages are answered in about a millisecond, and the Python
+# side of the work grows with the number of answers (e.g. pages) rather than
+# the size of the folder.
+#
+# A position map for virtual folders (global number to position in the
+# virtual folder) goes alongside, so answers can be given in either
+# numbering without list.index().
+
+SEEN = 1
+FLAGGED = 2
+RECENT = 4
+DELETED = 8
+ANSWERED = 16
+DRAFT = 32
+
+# Flag names (as upper cased in FETCH responses) to bits
+BITS = {
+        b'\\SEEN': SEEN,
+        b'\\FLAGGED': FLAGGED,
+        b'\\RECENT': RECENT,
+        b'\\DELETED': DELETED,
+        b'\\ANSWERED': ANSWERED,
+        b'\\DRAFT': DRAFT,
+        }
+
+# Bits to flag names, as we send them
+NAMES = {
+        SEEN: b'\\Seen',
+        FLAGGED: b'\\Flagged',
+        RECENT: b'\\Recent',
+        DELETED: b'\\Deleted',
+        ANSWERED: b'\\Answered',
+        DRAFT: b'\\Draft',
+        }
+
+# Searches that tell us the flags when the folder is opened: the search key,
+# its flag bit, and whether matching means the flag is set (UNSEEN is asked
+# rather than SEEN because it is usually the far shorter answer).
+SEARCHES = [
+        (b"UNSEEN", SEEN, False),
+        (b"FLAGGED", FLAGGED, True),
+        (b"RECENT", RECENT, True),
+        (b"DELETED", DELETED, True),
+        ]
+
+def predicate(func):
+    """Return a translate table for func(flag byte) -> bool"""
+    return bytes(1 if func(i) else 0 for i in range(256))
+
+IS_UNSEEN = predicate(lambda f: not f & SEEN)
+IS_FLAGGED = predicate(lambda f: f & FLAGGED)
+# "New" is recent and not yet seen, as in the IMAP NEW search key
+IS_NEW = predicate(lambda f: f & RECENT and not f & SEEN)
+IS_INTERESTING = predicate(lambda f: f & FLAGGED or (f & RECENT and not f & SEEN))
+IS_DELETED = predicate(lambda f: f & DELETED)
+
+def flagBits(flags):
+    """Return the bits for a list of flags from a FETCH response"""
+    res = 0
+    for flag in flags:
+        res |= BITS.get(flag.upper(), 0)
+    return res
+
+def flagNames(bits):
+    """Return the list of flags for some bits, the inverse of flagBits"""
+    return [name for bit, name in sorted(NAMES.items()) if bits & bit]
+
+class FlagMap(object):
+    """Flags of the messages of a folder"""
+    def __init__(self):
+        object.__init__(self)
+        self.flags = bytearray(1)
+        # Whether the flags have been learned since the folder was opened
+        self.loaded = False
+    def load(self, exists, results):
+        """Set the flags from the ranges matched by each of SEARCHES"""
+        size = exists + 1
+        combined = 0
+        for (key, bit, matchSets), ranges in zip(SEARCHES, results):
+            # Build each flag as a byte per message, then shift it into
+            # place; with every byte 0 or 1 nothing carries between them.
+            fill, other = (b'\x01', b'\x00') if matchSets else (b'\x00', b'\x01')
+            flag = bytearray(other * size)
+            for first, last in ranges:
+                last = min(last, exists)
+                if first <= last:
+                    flag[first:last + 1] = fill * (last - first + 1)
+            flag[0] = 0
+            combined |= int.from_bytes(flag, "little") << (bit.bit_length() - 1)
+        self.flags = bytearray(combined.to_bytes(size, "little"))
+        self.loaded = True
+    def __len__(self):
+        return len(self.flags) - 1
+    def set(self, seq, flags):
+        """Record the flags of a message from a FETCH response.
+
+        Returns the (old, new) bits, so that callers can keep counts up to
+        date (e.g. IS_UNSEEN[new] - IS_UNSEEN[old]) without recounting.
+        """
+        if seq >= len(self.flags):
+            self.exists(seq)
+        old = self.flags[seq]
+        new = self.flags[seq] = flagBits(flags)
+        return old, new
+    def get(self, seq):
+        return self.flags[seq]
+    def exists(self, count):
+        """The folder now has count messages.
+
+        New messages are taken to be recent and unseen, until a FETCH says
+        otherwise.
+        """
+        if count + 1 > len(self.flags):
+            self.flags.extend(bytes((RECENT,)) * (count + 1 - len(self.flags)))
+        else:
+            del self.flags[count + 1:]
+    def expunge(self, seq):
+        """Message seq is gone; those after it move down.
+
+        Returns the bits it had, or None if we didn't know of it.
+        """
+        if not 0 < seq < len(self.flags):
+            return None
+        old = self.flags[seq]
+        del self.flags[seq]
+        return old
+    def count(self, pred):
+        """Return the number of messages matching the predicate"""
+        return self.flags.translate(pred).count(b'\x01', 1)
+    def first(self, pred):
+        """Return the first message matching the predicate, or None"""
+        pos = self.flags.translate(pred).find(b'\x01', 1)
+        return pos if pos > 0 else None
+    def matching(self, pred):
+        """Return the messages matching the predicate, in order"""
+        found = self.flags.translate(pred)
+        res = []
+        pos = found.find(b'\x01', 1)
+        while pos > 0:
+            res.append(pos)
+            pos = found.find(b'\x01', pos + 1)
+        return res
+    def pages(self, pred, rows, positions=None):
+        """Return the sorted page numbers with a message matching the predicate.
+
+        Pages are rows messages long, numbered from 0. With positions (see
+        positionMap), pages are of the virtual folder.
+        """
+        if positions is not None:
+            return sorted(set((positions[seq] - 1) // rows for seq in self.matching(pred) if seq in positions))
+        found = self.flags.translate(pred)
+        res = []
+        pos = found.find(b'\x01', 1)
+        while pos > 0:
+            page = (pos - 1) // rows
+            res.append(page)
+            # Skip the rest of this page
+            pos = found.find(b'\x01', (page + 1) * rows + 1)
+        return res
+
+def positionMap(virtfolder):
+    """Return {global message number: virtual folder position (from 1)}"""
+    return dict((seq, pos) for pos, seq in enumerate(virtfolder, 1))
@@ -0,0 +1,192 @@
+# Cached folder tree of each account, for the folders command and completion.
+#
+# The folders command used to send a LIST every time, and some servers
+# (e.g. uwimapd) answer even a one level LIST with a full recursive descent
+# that can take a very long time. Instead, the tree of each account is kept
+# here, with each folder's attributes and the hierarchy delimiter, and saved
+# in the cache directory so that it is there straight away next time.
+# Listing folders and completing 'folder +<Tab>' are then answered from it
+# without touching the network; the tree is refreshed in the background when
+# it gets old, or on demand (folders -r).
+#
+# A refresh lists a level at a time, every folder of a level in one round
+# trip (one LIST-EXTENDED command with a pattern per parent, or pipelined
+# LISTs), and only descends into folders that may have children. With the
+# CHILDREN extension (or LIST-EXTENDED's CHILDREN return option) that is
+# just the folders that do. The depth and number of folders are limited, so
+# that symbolic link loops on the server can't keep us busy forever.
+#
+# Folder names are kept as the server gives them.
+
+import os
+import json
+import time
+import bisect
+from . import trace
+
+# Most levels below the top that a refresh descends
+MAX_DEPTH = 8
+
+# Most folders a refresh collects
+MAX_FOLDERS = 20000
+
+# Seconds after which a tree is refreshed in the background when used
+MAX_AGE = 60 * 60
+
+def accountName(key):
+    """Return the name a tree is saved under, for an account key"""
+    proto, user, host, port = key
+    return "{}://{}@{}:{}".format(proto, user or "", host, port)
+
+class FolderTree(object):
+    """The folders of one account"""
+    def __init__(self, key, delimiter=None, folders=None, updated=0):
+        object.__init__(self)
+        # Account (as imappool.accountKey)
+        self.key = tuple(key)
+        # Hierarchy delimiter (str), or None if the server has no hierarchy
+        self.delimiter = delimiter
+        # Folder name -> list of attributes (e.g. '\\HasChildren')
+        self.folders = folders or {}
+        # Sorted folder names, for completion by prefix
+        self.names = sorted(self.folders)
+        # When the tree was listed (time.time())
+        self.updated = updated
+    def age(self):
+        """Return seconds since the tree was listed"""
+        return time.time() - self.updated
+    def _attrs(self, name):
+        return set(a.lower() for a in self.folders.get(name, ()))
+    def selectable(self, name):
+        attrs = self._attrs(name)
+        return name in self.folders and '\\noselect' not in attrs and '\\nonexistent' not in attrs
+    def hasChildren(self, name):
+        """Return whether the folder has subfolders"""
+        if not self.delimiter:
+            return False
+        attrs = self._attrs(name)
+        if '\\haschildren' in attrs:
+            return True
+        if '\\hasnochildren' in attrs or '\\noinferiors' in attrs:
+            return False
+        # No hint from the server; go by what we found
+        prefix = name + self.delimiter
+        i = bisect.bisect_left(self.names, prefix)
+        return i < len(self.names) and self.names[i].startswith(prefix)
+    def complete(self, text):
+        """Return the folder names starting with text, one level at a time.
+
+        Folders below the level text is at aren't included; complete their
+        parent (plus delimiter) to get to them.
+        """
+        res = []
+        i = bisect.bisect_left(self.names, text)
+        while i < len(self.names) and self.names[i].startswith(text):
+            name = self.names[i]
+            if not self.delimiter or self.delimiter not in name[len(text):]:
+                res.append(name)
+            i += 1
+        return res
+    def children(self, parent=""):
+        """Return the folders one level below parent ("" for the top level)"""
+        if not parent:
+            return self.complete("")
+        if not self.delimiter:
+            return []
+        return self.complete(parent + self.delimiter)
+
+class FolderCache(object):
+    """Folder trees of every account, kept in a file"""
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.loaded = False
+        # accountName -> FolderTree
+        self.trees = {}
+    def load(self):
+        """Read the trees from disk, if we haven't yet"""
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ev:
+            if trace.general:
+                trace.event("general", "foldertree: can't read {}: {}".format(self.path, ev))
+            return
+        for item in data.get("accounts", []):
+            tree = FolderTree(item["key"], item["delimiter"], item["folders"], item["updated"])
+            self.trees[accountName(tree.key)] = tree
+    def save(self):
+        """Write the trees to disk"""
+        data = {
+                "version": 1,
+                "accounts": [{
+                    "key": list(tree.key),
+                    "delimiter": tree.delimiter,
+                    "folders": tree.folders,
+                    "updated": tree.updated,
+                    } for tree in self.trees.values()],
+                }
+        # Write to a temporary file and rename, so that a second instance
+        # reading the file never sees half of it.
+        tmpname = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(tmpname, "w") as f:
+                json.dump(data, f)
+            os.rename(tmpname, self.path)
+        except OSError as ev:
+            if trace.general:
+                trace.event("general", "foldertree: can't write {}: {}".format(self.path, ev))
+    def get(self, key):
+        """Return the tree of an account, or None.
+
+        A key without a user (e.g. from a URL without one) matches a tree of
+        the same server under any user, and the other way around.
+        """
+        self.load()
+        tree = self.trees.get(accountName(key))
+        if tree is not None:
+            return tree
+        proto, user, host, port = key
+        for tree in self.trees.values():
+            tproto, tuser, thost, tport = tree.key
+            if (tproto, thost, tport) == (proto, host, port) and (not user or not tuser):
+                return tree
+        return None
+    def put(self, tree):
+        """Keep a freshly listed tree, and save"""
+        self.load()
+        self.trees[accountName(tree.key)] = tree
+        self.save()
+
+def scan(conn, key, depth=MAX_DEPTH):
+    """List the folders of a connection's account into a FolderTree.
+
+    key is the account the connection is to (as imappool.accountKey).
+    """
+    folders = {}
+    delimiter = None
+    patterns = [b"%"]
+    level = 0
+    while patterns and level <= depth and len(folders) < MAX_FOLDERS:
+        below = []
+        for attrs, delim, name in conn.listMailboxes(patterns):
+            name = name.decode("utf-8", "replace")
+            if name in folders:
+                continue
+            attrs = [a.decode("ascii", "replace") for a in attrs]
+            folders[name] = attrs
+            if not delim:
+                continue
+            delimiter = delim.decode("utf-8", "replace")
+            lower = set(a.lower() for a in attrs)
+            if '\\hasnochildren' in lower or '\\noinferiors' in lower or '\\nonexistent' in lower:
+                continue
+            below.append(name.encode("utf-8") + delim + b"%")
+        patterns = below
+        level += 1
+    return FolderTree(key, delimiter, folders, time.time())
@@ -1,6 +1,11 @@
 import re
 import ssl
 import socket
+import zlib
+import base64
+import time
+from . import trace
+from . import metrics
 # An attempt at our own imap lib.
 # Goals: 
 #   * Be runnable either in its own thread or via an eventloop
@@ -43,6 +48,24 @@ re_continue = re.compile(rb'\+ (OK|NO|BAD|PREAUTH|BYE) (\[[^]]*\])? ?(.*)')
 re_numdat = re.compile(rb'\* (\d+) ([a-zA-Z]+) ?(.*)', re.DOTALL)
 re_untagdat = re.compile(rb'\* ([a-zA-Z]+) ?(.*)', re.DOTALL)
 
+# TLS contexts by CA file, and the last TLS session seen for each (host, port).
+# Handing the old session to a new connection lets the server skip most of the
+# handshake. Sessions can only be resumed with the context that made them, so
+# contexts are shared between connections too.
+tlsContexts = {}
+tlsSessions = {}
+
+def commandName(cmd):
+    """Return the name a command is counted under in the session metrics.
+
+    This is the command's first word, or its first two for UID commands.
+    """
+    words = cmd.split(b" ", 2)
+    name = words[0].upper()
+    if name == b"UID" and len(words) > 1:
+        name = b"UID " + words[1].upper()
+    return name.decode("ascii", "replace")
+
 class imap4Exception(Exception):
     """Root exception for all exceptions raised by this imap4 module"""
 class imap4NoConnect(imap4Exception):
@@ -131,8 +154,37 @@ class imap4ClientConnection(object):
     #   STARTTLS
     #   LOGINDISABLED
     #   AUTH=PLAIN
+    #  RFC4978 (IMAP COMPRESS)
+    #   COMPRESS=DEFLATE
+    #  RFC4959 (IMAP SASL-IR)
+    #   SASL-IR
     #
     #
+
+    # Totals over all connections, for profiling commands that may use more
+    # than one: bytes on the wire, round trips, and seconds spent waiting on
+    # the server.
+    totalIn = 0
+    totalOut = 0
+    totalRoundTrips = 0
+    totalWait = 0.0
+    # The same, leaving out connections used by background tasks (see
+    # 'background'), for charging commands with what they cost
+    foregroundIn = 0
+    foregroundOut = 0
+    foregroundRoundTrips = 0
+    foregroundWait = 0.0
+    # (host, port) of every server connected to this session, for counting
+    # reconnects
+    seenServers = set()
+    # Commands leave IDLE, but don't return to it; that waits until no
+    # command has been sent for idleQuiet seconds, so that a burst of
+    # commands costs one DONE and one IDLE rather than one of each per
+    # command. IDLE is restarted after idleRestart seconds, as servers may
+    # drop a client after 30 minutes without a command.
+    idleQuiet = 2.0
+    idleRestart = 28 * 60
+
     def __init__(self):
         object.__init__(self)
         self.tag = 0
@@ -142,9 +194,44 @@ class imap4ClientConnection(object):
         self.maxlinelen = 50 * 1024 * 1024
         self.cb_fetch = None
         self.cb_search = None
-        self.debug = False
         self.ca_certs = None
+        # Whether IDLE is in progress on the wire, and whether the user of
+        # the connection wants it (see idleDue() and idleTick()).
         self.idling = False
+        self.idleWanted = False
+        # Whether background tasks rather than commands are using the
+        # connection (set by imappool); its traffic isn't charged to the
+        # command running meanwhile.
+        self.background = False
+        # When IDLE was last entered, and when the last command finished
+        # (time.monotonic())
+        self.idleSince = 0.0
+        self.lastCommand = 0.0
+        # Stream compression (RFC 4978). When active, everything on the wire
+        # goes through these zlib objects, and decompressed data that hasn't
+        # been consumed by the line reader waits in inbuf.
+        self.compressor = None
+        self.decompressor = None
+        self.inbuf = b""
+        self.inpos = 0
+        # Byte counters. 'wire' is what actually crossed the socket, 'data' is
+        # what the IMAP layer saw. They only differ when compression is on.
+        self.wireIn = 0
+        self.wireOut = 0
+        self.dataIn = 0
+        self.dataOut = 0
+        # Round trips: reads that had to wait for the server to answer
+        # something we sent. serverWait is the total time spent in those
+        # reads.
+        self.roundTrips = 0
+        self.serverWait = 0.0
+        self.awaiting = False
+        # Commands awaiting their tagged response, by tag, as (name, time
+        # sent), for the session metrics
+        self.pending = {}
+        # Times IDLE was entered on this connection
+        self.idleStarts = 0
+        self.hostname = None
         # Callbacks dictionary
         self.cbs = {}
     def close(self):
@@ -186,8 +273,8 @@ class imap4ClientConnection(object):
             pass
         elif codename == b'CAPABILITY':
             caps = codes[1:]
-            if self.debug:
-                print("Capabilities:", caps)
+            if trace.imap:
+                trace.event("imap", "Capabilities:", caps)
             self.caps = caps
         elif codename == b"BADCHARSET":
             pass
@@ -227,6 +314,16 @@ class imap4ClientConnection(object):
             pass
             # Also VANISHED, but that shouldn't happen unless we explicitly
             # enable QRESYNC
+        # RFC 4978 COMPRESS additions
+        elif codename == b"COMPRESSIONACTIVE":
+            # Server already compresses this layer (e.g. TLS compression or a
+            # previous COMPRESS command). Nothing for us to do; compress()
+            # will see the failed command.
+            pass
+        # RFC 4315 UIDPLUS additions
+        elif codename == b"APPENDUID":
+            # We don't keep track of where appended messages went (yet)
+            pass
         # RFC5530 section 6 list
         #   2060
         #       * NEWNAME
@@ -238,7 +335,6 @@ class imap4ClientConnection(object):
         #       * UNKNOWN-CTE
         #   4315
         #       * UIDNOTSTICKY
-        #       * APPENDUID
         #       * COPYUID
         #   4467
         #       * URLMECH
@@ -247,8 +343,6 @@ class imap4ClientConnection(object):
         #       * BADURL
         #   4551
         #       * MODIFIED
-        #   4978
-        #       * COMPRESSIONACTIVE
         #   5182
         #       * NOTSAVED
         #   5255
@@ -296,58 +390,223 @@ class imap4ClientConnection(object):
 
         Caller is responsible for calling doIdleData() when the socket is ready to receive.
 
+        Commands sent while idling leave idle mode; the caller should call
+        idleTick() when idleDue() says to, to return to it (and to restart it
+        before the server gives up on us).
+
         Raises an exception if connection doesn't support IDLE capability;
         caller should then poll with NOOP commands to get updates.
         """
         if not b'IDLE' in self.caps:
             raise Exception("IMAP connection lacks IDLE capability")
+        self.idleWanted = True
+        if self.idling:
+            return
         self.tag += 1
         tagstr = b"T%d"%(self.tag)
         cmd = b"%s idle\r\n"%(tagstr)
-        if self.debug:
-            print("Sending command: {}".format(repr(cmd)))
-        self.socket.send(cmd)
+        if trace.imap:
+            trace.event("imap", "Sending command: {}".format(repr(cmd)))
+        # The tagged response only comes when we leave IDLE, so there is no
+        # response time worth recording.
+        metrics.count("imap_commands_total", command="IDLE", server=self.hostname)
+        if self.idleStarts:
+            metrics.count("imap_idle_restarts_total", server=self.hostname)
+        self.idleStarts += 1
+        self._send(cmd)
         self.idling = True
+        self.idleSince = time.monotonic()
         while True:
             line = self.readFullLine()
-            if self.debug:
-                print("doIdle recvline: {}".format(repr(line)))
+            if trace.imap:
+                trace.event("imap", "doIdle recvline: {}".format(repr(line)))
             if not line.startswith(b"+ "):
-                line = b""
-                linelen = 0
+                # Updates that came in since the last command
                 # TODO: timeout? limit number of lines we'll wait for?
+                if line.startswith(b"* "):
+                    self.processUntagged(line[:-2])
                 continue
             break
 
     def doIdleData(self):
-        # TODO: START: common code for get a line from the IMAP connection
-        line = self.readFullLine()
-        if self.debug:
-            print("doIdleData recvline: {}".format(repr(line)))
-        # strip off ending cr/lf
-        line = line[:-2]
-        self.processUntagged(line)
+        while True:
+            # TODO: START: common code for get a line from the IMAP connection
+            line = self.readFullLine()
+            if trace.imap:
+                trace.event("imap", "doIdleData recvline: {}".format(repr(line)))
+            # strip off ending cr/lf
+            line = line[:-2]
+            self.processUntagged(line)
+            # The caller only knows to call us when the socket is readable.
+            # Data we (or the SSL layer) have already pulled off the socket
+            # won't wake them up again, so drain it here.
+            if not self.hasPendingData():
+                break
 
     def stopIdle(self):
-        """Leave idle mode.
+        """Leave idle mode, and don't return to it.
 
         Caller should not call doIdleData any more after calling this.
 
         See also doIdle() and doIdleData()
         """
+        self._leaveIdle()
+        self.idleWanted = False
+
+    def _leaveIdle(self):
+        """Leave IDLE (if in it) to send a command, keeping idleWanted"""
         if self.idling:
-            self.socket.send(b"done\r\n")
+            if trace.imap:
+                trace.event("imap", "Sending: done (to stop idling)")
+            self._send(b"done\r\n")
+            self.idling = False
             self.processUntilTag(b"T%d"%(self.tag))
-        self.idling = False
+
+    def idleDue(self):
+        """Return seconds until idleTick() has something to do, or None.
+
+        None means idle mode isn't wanted.
+        """
+        if not self.idleWanted:
+            return None
+        now = time.monotonic()
+        if self.idling:
+            return max(0, self.idleSince + self.idleRestart - now)
+        return max(0, self.lastCommand + self.idleQuiet - now)
+
+    def idleTick(self):
+        """Return to IDLE after a quiet spell, or restart a long running IDLE"""
+        due = self.idleDue()
+        if due is None or due > 0:
+            return
+        # Leaving and entering again gives the server a command, which
+        # resets its inactivity timer.
+        self._leaveIdle()
+        self.doIdle()
+
+    def _started(self, tagstr, cmd):
+        """Note a command about to be sent, for the session metrics"""
+        name = commandName(cmd)
+        metrics.count("imap_commands_total", command=name, server=self.hostname)
+        self.pending[tagstr] = (name, time.perf_counter())
+
+    def _finished(self, tagstr):
+        """Note the tagged response to a command, for the session metrics"""
+        sent = self.pending.pop(tagstr, None)
+        if sent is not None:
+            metrics.observe("imap_response_seconds", time.perf_counter() - sent[1], command=sent[0], server=self.hostname)
+
+    def _send(self, data):
+        """Send data to the server, compressing it if COMPRESS is active"""
+        self.dataOut += len(data)
+        if self.compressor:
+            # Each command must reach the server as a whole, so flush the
+            # deflate stream every time.
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wireOut += len(data)
+        imap4ClientConnection.totalOut += len(data)
+        if not self.background:
+            imap4ClientConnection.foregroundOut += len(data)
+        self.awaiting = True
+        self.socket.sendall(data)
+
+    def _sockRecv(self, count):
+        if not self.awaiting:
+            data = self.socket.recv(count)
+        else:
+            # First read since sending; this is where we wait on the server
+            start = time.perf_counter()
+            data = self.socket.recv(count)
+            wait = time.perf_counter() - start
+            self.awaiting = False
+            self.roundTrips += 1
+            self.serverWait += wait
+            imap4ClientConnection.totalRoundTrips += 1
+            imap4ClientConnection.totalWait += wait
+            if not self.background:
+                imap4ClientConnection.foregroundRoundTrips += 1
+                imap4ClientConnection.foregroundWait += wait
+        imap4ClientConnection.totalIn += len(data)
+        if not self.background:
+            imap4ClientConnection.foregroundIn += len(data)
+        return data
+
+    def _recv(self, count):
+        """Receive up to count bytes from the server.
+
+        When COMPRESS is active, reads whatever the socket has, decompresses
+        it, and hands out data from the decompressed buffer.
+        """
+        if not self.decompressor:
+            data = self._sockRecv(count)
+            self.wireIn += len(data)
+            self.dataIn += len(data)
+            return data
+        while not self.inbuf:
+            raw = self._sockRecv(16384)
+            if raw == b"":
+                return raw
+            self.wireIn += len(raw)
+            self.inbuf = self.decompressor.decompress(raw)
+            self.inpos = 0
+        # readLine asks for one byte at a time; walk an offset rather than
+        # re-slicing the whole buffer on every call.
+        data = self.inbuf[self.inpos:self.inpos + count]
+        self.inpos += len(data)
+        if self.inpos >= len(self.inbuf):
+            self.inbuf = b""
+            self.inpos = 0
+        self.dataIn += len(data)
+        return data
+
+    def hasPendingData(self):
+        """Return True if data has been read from the socket but not yet processed."""
+        if self.inbuf:
+            return True
+        if self.isTls() and self.socket.pending():
+            return True
+        return False
+
+    def compress(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        """Enable DEFLATE stream compression (RFC 4978).
+
+        Should be done after authentication. Raises an exception if the
+        server doesn't support it or refuses (e.g. because compression is
+        already active).
+        """
+        if self.compressor:
+            raise imap4Exception("Compression already active")
+        if not self.caps or not b'COMPRESS=DEFLATE' in self.caps:
+            raise imap4Exception("IMAP connection lacks COMPRESS=DEFLATE capability")
+        res, code, string = self.doSimpleCommand(b"COMPRESS DEFLATE")
+        if res != b'OK':
+            raise imap4Exception("Failed to enable compression: %s %s" % (res, string))
+        # Raw deflate, no zlib header (negative window bits), per the RFC.
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+
+    def isCompressed(self):
+        return self.compressor is not None
+
+    def compressionRatio(self):
+        """Return (inbound, outbound) ratio of IMAP data to wire data.
+
+        A ratio of 4.0 means four bytes of IMAP data took one byte on the
+        wire. Ratios are 1.0 when nothing has been transferred.
+        """
+        rin = self.dataIn / self.wireIn if self.wireIn else 1.0
+        rout = self.dataOut / self.wireOut if self.wireOut else 1.0
+        return rin, rout
 
     def readLine(self):
         """Read a simple line from the IMAP socket"""
         line = b""
         linelen = 0
         while True:
-            data = self.socket.recv(1)
+            data = self._recv(1)
             thislen = len(data)
             if thislen == 0:
+                metrics.count("imap_connections_lost_total", server=self.hostname)
                 self.close()
                 raise imap4Exception("Server connection lost? 0 length read occured")
             line += data
@@ -360,8 +619,8 @@ class imap4ClientConnection(object):
                 # care of it?
                 raise imap4Exception("Server response too long (at %i, which exceeds maxlinelen %i)" % (len(line), self.maxlinelen))
             if line.endswith(b'\r\n'):
-                if self.debug:
-                    print("readLine: {}".format(repr(line)))
+                if trace.imap:
+                    trace.event("imap", "readLine: {}".format(repr(line)))
                 return line
 
     def readFullLine(self):
@@ -381,13 +640,14 @@ class imap4ClientConnection(object):
             # to read like this.
             if segment != -1 and line.endswith(b'}\r\n') and line[segment + 1 : -3].isdigit():
                 count = int(line[segment + 1 : -3],10)
+                metrics.observe("imap_literal_bytes", count, server=self.hostname)
                 # NOTE: The count is the number of bytes to read after the
                 # initial CRLF. We put the CRLF back into the stream so
                 # that higher parsers keep the correct format.
 
                 # Read the rest of the literal
                 while count:
-                    partial = self.socket.recv(count)
+                    partial = self._recv(count)
                     if partial == b"":
                         # TODO: Might have been SSL layer stuff. Figure
                         # out how to check if the socket is actually dead.
@@ -403,38 +663,30 @@ class imap4ClientConnection(object):
 
         Does not support doing concurrent outstanding commands.
         Does not support continuation commands (receipt of a continuation response will raise
-        and exception)"""
-        if self.idling:
-            if self.debug:
-                print("Sending: done (to stop idling)")
-            self.socket.send(b"done\r\n")
-            self.processUntilTag(b"T%d"%(self.tag))
+        and exception)
+
+        Leaves IDLE if in it; see idleTick() for returning."""
+        self._leaveIdle()
         # TODO: Allow tags to be templated or something.
         try:
             self.tag += 1
             tagstr = b"T%i" % self.tag
             imapcmd = b"%s %s\r\n" % (tagstr, cmd)
-            if self.debug:
-                print("Sending command: {}".format(repr(imapcmd)))
-            self.socket.send(imapcmd)
+            if trace.imap:
+                trace.event("imap", "Sending command: {}".format(repr(imapcmd)))
+            self._started(tagstr, cmd)
+            self._send(imapcmd)
             result = self.processUntilTag(tagstr)
         finally:
-            if self.idling:
-                # TODO: maybe only return to idling after a delay?
-                # Could use a timer?
-                # If we go back to idling immediately, there's a lot
-                # of back-and-forth when the program using this lib
-                # does back-to-back simple commands, wasting bandwidth
-                # and time.
-                self.doIdle()
+            self.lastCommand = time.monotonic()
         return result
 
     def processUntilTag(self, tagstr):
         while True:
             line = self.readFullLine()
             if line.endswith(b'\r\n'):
-                if self.debug:
-                    print("processUntilTag recvline: {}".format(repr(line)))
+                if trace.imap:
+                    trace.event("imap", "processUntilTag recvline: {}".format(repr(line)))
                 # Strip the line ending off
                 line = line[:-2]
                 # We got a whole line. Process it.
@@ -483,13 +735,14 @@ class imap4ClientConnection(object):
                     tag, status, code, string = a.groups()
                     if code:
                         self.processCodes(status, code, string)
-                    if self.debug:
-                        print("tag",line)
+                    if trace.imap:
+                        trace.event("imap", "tag",line)
                     if tag != tagstr:
                         # Log a warning
                         print("Unexpected tag %s received; was waiting for %s" % (tag, tagstr))
                         # Keep waiting for *our* tag
                         continue
+                    self._finished(tagstr)
                     if status.upper() != b'OK':
                         # TODO: Use our own exception class
                         # Ideally, we'd have one kind of exception for NO and
@@ -510,15 +763,15 @@ class imap4ClientConnection(object):
         #       Can also be results, e.g. * FLAGS (\Answered \Seen)
         #       or value results, e.g. * 6347 EXISTS
         #                              * 0 RECENT
-        if self.debug:
-            print("processUntagged", line)
+        if trace.imap:
+            trace.event("imap", "processUntagged", line)
         # Start by looking for response-cond-state
         r = re.match(re_untagged, line)
         if r is not None:
             status, code, string = r.groups()
             # TODO, look for content to cache and/or callback
-            if self.debug:
-                print("response cond-state",status,code,string)
+            if trace.imap:
+                trace.event("imap", "response cond-state",status,code,string)
             if code:
                 self.processCodes(status, code, string)
         else:
@@ -529,35 +782,35 @@ class imap4ClientConnection(object):
             r = re.match(re_numdat, line)
             if r is not None:
                 num, typ, data = r.groups()
-                if self.debug:
-                    print("response numdat", num, typ, data)
+                if trace.imap:
+                    trace.event("imap", "response numdat", num, typ, data)
                 # message-data
                 if typ.upper() == b"FETCH":
-                    if self.debug:
-                        print("FETCH for %s" % num, data)
+                    if trace.imap:
+                        trace.event("imap", "FETCH for %s" % num, data)
                     if self.cb_fetch:
-                        if self.debug:
-                            print("Calling fetch callback", self.cb_fetch)
+                        if trace.imap:
+                            trace.event("imap", "Calling fetch callback", self.cb_fetch)
                         self.cb_fetch(num, data)
                     if "fetch" in self.cbs:
-                        if self.debug:
-                            print("Calling fetch cbs", self.cbs)
+                        if trace.imap:
+                            trace.event("imap", "Calling fetch cbs", self.cbs)
                         self.cbs["fetch"](num, data)
                 elif typ.upper() == b"EXPUNGE":
-                    if self.debug:
-                        print("EXPUNGE for %s" % num)
+                    if trace.imap:
+                        trace.event("imap", "EXPUNGE for %s" % num)
                     if "expunge" in self.cbs:
                         self.cbs['expunge'](num, data)
                 # numerical mailbox-data
                 elif typ.upper() == b"EXISTS":
-                    if self.debug:
-                        print("Exists: %s" % num)
+                    if trace.imap:
+                        trace.event("imap", "Exists: %s" % num)
                     self.exists = int(num, 10)
                     if "exists" in self.cbs:
                         self.cbs["exists"](int(num, 10))
                 elif typ.upper() == b"RECENT":
-                    if self.debug:
-                        print("Recent: %s" % num)
+                    if trace.imap:
+                        trace.event("imap", "Recent: %s" % num)
                     self.recent = int(num, 10)
                 else:
                     print("uknown numerical '%s'" % typ.upper(), line)
@@ -588,8 +841,8 @@ class imap4ClientConnection(object):
                         if self.cb_search:
                             self.cb_search(typ, data)
                     elif typ.upper() == b"STATUS":
-                        # TODO: callback
-                        pass
+                        if "status" in self.cbs:
+                            self.cbs["status"](data)
                     # message-data
                     # (none)
                     else:
@@ -623,18 +876,13 @@ class imap4ClientConnection(object):
         # TODO: should we iterate through targets in order, randomly, or
         # randomly by address family (that is, try IPv6 first, then IPv4, then
         # whatever is left)?
+        self.port = port
         for i in targets:
             print("Trying", i[4][0],i[3]) # address, canonical name (if available)
             s = socket.socket(*i[:3])
             if useSsl:
                 oldSock = s
-                if (self.ca_certs):
-                    # TODO: this appears to *add* the given certs file to
-                    # the default set instead of replacing it
-                    context = ssl.create_default_context(cafile=self.ca_certs)
-                else:
-                    context = ssl.create_default_context()
-                s = context.wrap_socket(s, server_hostname=host)
+                s = self.tlsContext().wrap_socket(s, server_hostname=host, session=tlsSessions.get((host, port)))
             else:
                 oldSock = None
             try:
@@ -653,6 +901,10 @@ class imap4ClientConnection(object):
             # no route, etc.
             # May be difficult due to multiple connection attempts.
             raise imap4NoConnect("unable to connect")
+        metrics.count("imap_connects_total", server=host)
+        if (host, port) in imap4ClientConnection.seenServers:
+            metrics.count("imap_reconnects_total", server=host)
+        imap4ClientConnection.seenServers.add((host, port))
         return
 
     def _negotiate(self, s, host):
@@ -704,6 +956,28 @@ class imap4ClientConnection(object):
         if isinstance(self.socket, ssl.SSLSocket):
             return True
         return False
+    def tlsContext(self):
+        """Get the (shared) TLS context for our CA settings"""
+        if not self.ca_certs in tlsContexts:
+            if (self.ca_certs):
+                # TODO: This appears to *add* the given certs file to the
+                # default set instead of replacing it. What if the user wants
+                # *only* the given ca? How do we have the user convey that to
+                # us? How do we convey that to the ssl library?
+                tlsContexts[self.ca_certs] = ssl.create_default_context(cafile=self.ca_certs)
+            else:
+                tlsContexts[self.ca_certs] = ssl.create_default_context()
+        return tlsContexts[self.ca_certs]
+    def rememberTlsSession(self):
+        """Save the TLS session for resumption by later connections.
+
+        With TLS 1.3 the server sends session tickets after the handshake, so
+        this is best done after some traffic (e.g. after login).
+        """
+        if self.isTls() and self.socket.session:
+            tlsSessions[(self.hostname, self.port)] = self.socket.session
+    def tlsResumed(self):
+        return self.isTls() and self.socket.session_reused
     def starttls(self):
         if self.state != STATE_UNAUTH:
             raise imap4Exception("Bad client state for command")
@@ -716,15 +990,10 @@ class imap4ClientConnection(object):
         # TODO: Support client certificate
         self.origsocket = self.socket
         # Based on information from https://mail.python.org/pipermail/python-dev/2013-November/130649.html
-        if (self.ca_certs):
-            # TODO: This appears to *add* the given certs file to the
-            # default set instead of replacing it. What if the user wants
-            # *only* the given ca? How do we have the user convey that to
-            # us? How do we convey that to the ssl library?
-            context = ssl.create_default_context(cafile=self.ca_certs)
-        else:
-            context = ssl.create_default_context()
-        self.socket = context.wrap_socket(self.socket, server_hostname=self.hostname)
+        self.socket = self.tlsContext().wrap_socket(self.socket, server_hostname=self.hostname, session=tlsSessions.get((self.hostname, self.port)))
+        # RFC 3501 says to forget what we knew about the server's capabilities
+        # once TLS is up; they may be different now.
+        self.caps = None
     def login(self, username, password):
         #self.socket.send("T%i LOGIN \"%s\" \"%s\"\r\n" % (self.tag, username, password))
         #self.tag += 1
@@ -735,17 +1004,210 @@ class imap4ClientConnection(object):
         if type(password)==type(str()):
             password=password.encode("utf8")
 
-        res, code, string = self.doSimpleCommand(b"LOGIN \"%s\" \"%s\"" % (username, password))
+        oldcaps = self.caps
+        if self.caps and b'SASL-IR' in self.caps and b'AUTH=PLAIN' in self.caps:
+            # AUTHENTICATE PLAIN with the credentials included in the command
+            # costs the same round trip as LOGIN, but works on servers with
+            # LOGINDISABLED and doesn't need quoting of the password.
+            try:
+                res, code, string = self.doSimpleCommand(b"AUTHENTICATE PLAIN %s" % base64.b64encode(b"\0%s\0%s" % (username, password)))
+            except imap4Exception as ev:
+                # BAD means the server didn't like the command itself (e.g.
+                # our capability information was stale). Anything else is a
+                # real login failure.
+                if getattr(ev, 'imap_status', None) != b'BAD':
+                    raise
+                res, code, string = self.doSimpleCommand(b"LOGIN \"%s\" \"%s\"" % (username, password))
+        else:
+            res, code, string = self.doSimpleCommand(b"LOGIN \"%s\" \"%s\"" % (username, password))
         if (res == b'OK'):
             self.state = STATE_AUTH
+            if self.caps is oldcaps:
+                # Server didn't tell us its capabilities as part of the login.
+                # They may differ once authenticated, so we don't know them.
+                self.caps = None
+            self.rememberTlsSession()
+    def logout(self):
+        if self.state == STATE_NOCON or self.state == STATE_LOGOUT:
+            return
+        res, code, string = self.doSimpleCommand(b"LOGOUT")
+        self.state = STATE_LOGOUT
     def select(self, box = None):
         if box is None:
             box = b"INBOX"
         if type(box)==type(str()):
             box = box.encode("utf8")
+        self.unseen = None
         res, code, string = self.doSimpleCommand(b"SELECT %s" % box)
         if res != b'OK':
             raise imap4Exception("Failed to select box")
+    def selectEsearch(self, box, returnset, charset, query):
+        """SELECT a box and run an ESEARCH in it without waiting in between.
+
+        Both commands are sent together, saving a round trip. Returns the
+        esearch results like esearch() does. If the SELECT fails, the search
+        fails too, and the SELECT error is raised.
+        """
+        if box is None:
+            box = b"INBOX"
+        if type(box)==type(str()):
+            box = box.encode("utf8")
+        returnset = returnset.encode("ascii")
+        charset = charset.encode("ascii")
+        query = query.encode("ascii") # TODO: Encode based on charset?
+        searchres = {}
+        self.unseen = None
+        oldsearch = self.cb_search
+        self.cb_search = self._esearchCB(searchres)
+        try:
+            results = self.pipeline([
+                b"SELECT %s" % box,
+                b"SEARCH RETURN (%s) CHARSET %s %s" % (returnset, charset, query),
+                ])
+        finally:
+            self.cb_search = oldsearch
+        if isinstance(results[0], Exception):
+            raise imap4Exception("Failed to select box")
+        if isinstance(results[1], Exception):
+            raise results[1]
+        return searchres
+    def selectSearches(self, box, charset, queries):
+        """SELECT a box and run several searches in it, in one round trip.
+
+        Returns, for each query, the matching message numbers as a sorted
+        list of (first, last) ranges. With ESEARCH, the results are asked
+        for as sequence sets, which stay short however many messages match.
+        """
+        if box is None:
+            box = b"INBOX"
+        if type(box)==type(str()):
+            box = box.encode("utf8")
+        charset = charset.encode("ascii")
+        esearch = b'ESEARCH' in self.caps
+        cmds = [b"SELECT %s" % box]
+        for query in queries:
+            if esearch:
+                cmds.append(b"SEARCH RETURN (ALL) CHARSET %s %s" % (charset, query))
+            else:
+                cmds.append(b"SEARCH CHARSET %s %s" % (charset, query))
+        # Each search gets exactly one untagged result, in order
+        found = []
+        def cb(typ, data):
+            if typ == b"ESEARCH":
+                _,_,data = data.partition(b")")
+                data = data.split()
+                seqset = dict(zip(data[0::2], data[1::2])).get(b"ALL", b"")
+                found.append(sequenceRanges(seqset))
+            else:
+                found.append(numberRanges(map(int, data.split())))
+        self.unseen = None
+        oldsearch = self.cb_search
+        self.cb_search = cb
+        try:
+            results = self.pipeline(cmds)
+        finally:
+            self.cb_search = oldsearch
+        if isinstance(results[0], Exception):
+            raise imap4Exception("Failed to select box")
+        for r in results[1:]:
+            if isinstance(r, Exception):
+                raise r
+        if len(found) != len(queries):
+            raise imap4Exception("Expected {} search results, got {}".format(len(queries), len(found)))
+        return found
+    def pipeline(self, cmds):
+        """Send several commands at once, then collect all their responses.
+
+        Returns a list with the (status, code, string) result for each
+        command, or the exception its tagged response raised. Untagged
+        responses go through the usual callbacks.
+
+        Only use this for commands that make sense to run back to back
+        without looking at the previous result first.
+        """
+        self._leaveIdle()
+        tags = []
+        data = b""
+        for cmd in cmds:
+            self.tag += 1
+            tagstr = b"T%i" % self.tag
+            tags.append(tagstr)
+            self._started(tagstr, cmd)
+            data += b"%s %s\r\n" % (tagstr, cmd)
+        if trace.imap:
+            trace.event("imap", "Sending pipelined commands: {}".format(repr(data)))
+        self._send(data)
+        results = []
+        try:
+            for tagstr in tags:
+                try:
+                    results.append(self.processUntilTag(tagstr))
+                except imap4Exception as ev:
+                    if not hasattr(ev, 'imap_status'):
+                        # Not a tagged failure; the connection is in trouble
+                        raise
+                    results.append(ev)
+        finally:
+            self.lastCommand = time.monotonic()
+        return results
+    def append(self, box, flags, message, size):
+        """Add a message to a box.
+
+        flags is the parenthesized flag list (bytes), or None. message is an
+        iterable of bytes blocks with CRLF line endings, adding up to size
+        bytes. With LITERAL+, the message follows the command without waiting
+        for the server to invite it.
+        """
+        if type(box)==type(str()):
+            box = box.encode("utf8")
+        box = b'"%s"' % box.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+        self._leaveIdle()
+        try:
+            self.tag += 1
+            tagstr = b"T%i" % self.tag
+            nonsync = self.caps and b'LITERAL+' in self.caps
+            imapcmd = b"%s APPEND %s %s{%d%s}\r\n" % (
+                    tagstr,
+                    box,
+                    flags + b" " if flags else b"",
+                    size,
+                    b"+" if nonsync else b"",
+                    )
+            if trace.imap:
+                trace.event("imap", "Sending command: {}".format(repr(imapcmd)))
+            self._started(tagstr, b"APPEND")
+            self._send(imapcmd)
+            if not nonsync:
+                # Wait for the go ahead. A tagged reply instead means the
+                # server doesn't want the message (e.g. no such box).
+                while True:
+                    line = self.readFullLine()
+                    if line.startswith(b"+"):
+                        break
+                    if line.startswith(tagstr):
+                        a = re.match(re_tagged, line[:-2])
+                        tag, status, code, string = a.groups()
+                        if code:
+                            self.processCodes(status, code, string)
+                        self._finished(tagstr)
+                        e = imap4Exception("IMAP error: %s" % string)
+                        e.imap_status = status
+                        e.imap_code = code
+                        e.imap_string = string
+                        raise e
+                    self.processUntagged(line[:-2])
+            sent = 0
+            for chunk in message:
+                self._send(chunk)
+                sent += len(chunk)
+            if sent != size:
+                # Nothing we can do to recover the protocol state
+                self.close()
+                raise imap4Exception("Message was %i bytes, expected %i" % (sent, size))
+            self._send(b"\r\n")
+            return self.processUntilTag(tagstr)
+        finally:
+            self.lastCommand = time.monotonic()
     def getheaders(self, message):
         res, code, string = self.doSimpleCommand(b"fetch %s (BODY.PEEK[HEADER])" % message)
         if res != b'OK':
@@ -763,11 +1225,11 @@ class imap4ClientConnection(object):
         oldcb = self.cb_fetch
         fetchlist = []
         def fetch_cb(message, data):
-            if self.debug:
-                print("imap:fetch:fetch_cb",message,data)
+            if trace.imap:
+                trace.event("imap", "imap:fetch:fetch_cb",message,data)
             fetchlist.append((message, data))
-            if self.debug:
-                print("imap:fetch:fetch_cb returning")
+            if trace.imap:
+                trace.event("imap", "imap:fetch:fetch_cb returning")
         self.cb_fetch = fetch_cb
         if type(message)==type(str()):
             message = message.encode("utf8")
@@ -828,24 +1290,204 @@ class imap4ClientConnection(object):
         if res != b"OK":
             raise imap4Exception("Failed to do search: %s %s" % (res, string))
         return searchres
-    def esearch(self, returnset, charset, query):
-        searchres = {}
-        returnset = returnset.encode("ascii")
-        charset = charset.encode("ascii")
-        query = query.encode("ascii") # TODO: Encode based on charset?
+    def status(self, box, items):
+        """Return a mailbox's STATUS items (e.g. b"MESSAGES UNSEEN") as a dict.
+
+        Keys are the item names as bytes, values are ints.
+        """
+        if type(items)==type(str()):
+            items = items.encode("ascii")
+        res = {}
+        def cb(data):
+            res.update(parseStatus(data)[1])
+        old = self.cbs.get("status")
+        self.cbs["status"] = cb
+        try:
+            result, code, string = self.doSimpleCommand(b"STATUS %s (%s)" % (quoteMailbox(box), items))
+        finally:
+            if old is None:
+                del self.cbs["status"]
+            else:
+                self.cbs["status"] = old
+        if result != b"OK":
+            raise imap4Exception("Failed to get status: %s %s" % (result, string))
+        return res
+    def statusMany(self, boxes, items):
+        """Return {box: {item: value}} for several mailboxes in one round trip.
+
+        Uses LIST-STATUS (RFC 5819) if the server has it, and pipelined
+        STATUS commands if not. Boxes the server wouldn't report on are left
+        out. Box names in the result are str.
+        """
+        if type(items)==type(str()):
+            items = items.encode("ascii")
+        res = {}
+        old = self.cbs.get("status")
+        def cb(data):
+            box, values = parseStatus(data)
+            res[box.decode("utf8", "replace")] = values
+            # Whoever was listening (e.g. for NOTIFY) wants to know too
+            if old is not None:
+                old(data)
+        self.cbs["status"] = cb
+        try:
+            if self.caps and b'LIST-STATUS' in self.caps:
+                result, code, string = self.doSimpleCommand(b'LIST "" (%s) RETURN (STATUS (%s))' % (
+                    b" ".join(quoteMailbox(box) for box in boxes), items))
+                if result != b"OK":
+                    raise imap4Exception("Failed to get status: %s %s" % (result, string))
+            else:
+                self.pipeline([b"STATUS %s (%s)" % (quoteMailbox(box), items) for box in boxes])
+        finally:
+            if old is None:
+                del self.cbs["status"]
+            else:
+                self.cbs["status"] = old
+        return res
+    def listMailboxes(self, patterns, ref=b""):
+        """Return (attributes, delimiter, name) of the mailboxes matching any pattern.
+
+        One round trip however many patterns: a single LIST-EXTENDED (RFC
+        5258) command if the server has it, asking for the children
+        attributes too, and pipelined LIST commands if not. Attributes are a
+        list of bytes (e.g. b'\\HasChildren'); the delimiter is bytes, or
+        None if the server has no hierarchy; the name is bytes.
+        """
+        res = []
+        def cb(line):
+            res.append(parseList(line[7:]))
+        old = self.cbs.get("list")
+        self.cbs["list"] = cb
+        try:
+            if self.caps and b'LIST-EXTENDED' in self.caps:
+                result, code, string = self.doSimpleCommand(b'LIST %s (%s) RETURN (CHILDREN)' % (
+                    quoteMailbox(ref), b" ".join(quoteMailbox(p) for p in patterns)))
+                if result != b"OK":
+                    raise imap4Exception("Failed to list mailboxes: %s %s" % (result, string))
+            else:
+                for result in self.pipeline([b"LIST %s %s" % (quoteMailbox(ref), quoteMailbox(p)) for p in patterns]):
+                    if isinstance(result, Exception):
+                        raise result
+        finally:
+            if old is None:
+                del self.cbs["list"]
+            else:
+                self.cbs["list"] = old
+        return res
+    def notify(self, boxes, events=b"MessageNew MessageExpunge FlagChange"):
+        """Ask to be told when the given boxes change (RFC 5465 NOTIFY).
+
+        Changes arrive as untagged STATUS responses, through the "status"
+        callback, whenever the connection reads; set up something to call
+        doIdleData() when the socket is readable. The server also sends the
+        status of each box straight away.
+        """
+        result, code, string = self.doSimpleCommand(b"NOTIFY SET STATUS (mailboxes %s) (%s)" % (
+            b" ".join(quoteMailbox(box) for box in boxes), events))
+        if result != b"OK":
+            raise imap4Exception("Failed to set notifications: %s %s" % (result, string))
+    def notifyNone(self):
+        """Stop NOTIFY notifications"""
+        result, code, string = self.doSimpleCommand(b"NOTIFY NONE")
+        if result != b"OK":
+            raise imap4Exception("Failed to stop notifications: %s %s" % (result, string))
+    def _esearchCB(self, searchres):
         def cb(typ, data):
             assert(typ == b"ESEARCH")
             # TODO: Should process as imap data, but processImapData is in mailnex instead of here in imap4
             assert(data.startswith(b'(TAG "')) # TODO we need to know what tag was sent, but that's in doSimple
-            _,data = data.split(b") ")
+            # A search with no matches may have nothing after the tag
+            _,_,data = data.partition(b")")
             data = data.split()
             for k,v in zip(data[0::2], data[1::2]):
                 searchres[k.decode('ascii')] = v.decode('ascii') # Presumes there are no duplicate keys, otherwise we'd need to decide to append or replace
+        return cb
+    def esearch(self, returnset, charset, query):
+        searchres = {}
+        returnset = returnset.encode("ascii")
+        charset = charset.encode("ascii")
+        query = query.encode("ascii") # TODO: Encode based on charset?
         oldsearch = self.cb_search
-        self.cb_search = cb
+        self.cb_search = self._esearchCB(searchres)
         res, code, string = self.doSimpleCommand(b"SEARCH RETURN (%s) CHARSET %s %s" % (returnset, charset, query))
         self.cb_search = oldsearch
         if res != b"OK":
             raise imap4Exception("Failed to do search: %s %s" % (res, string))
         return searchres
 
+
+def quoteMailbox(box):
+    """Return a mailbox name as an IMAP quoted string"""
+    if type(box)==type(str()):
+        box = box.encode("utf8")
+    return b'"%s"' % box.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+
+def parseList(data):
+    """Split the data of an untagged LIST response into (attributes, delimiter, name)
+
+    Any extended data after the name (RFC 5258) is dropped.
+    """
+    m = re.match(rb'\(([^)]*)\) (NIL|"(?:\\.|[^"\\])") (.*)$', data, re.S)
+    if m is None:
+        raise imap4Exception("Bad LIST response: %r" % data)
+    attrs, delim, name = m.groups()
+    delim = None if delim == b"NIL" else re.sub(rb"\\(.)", rb"\1", delim[1:-1])
+    lit = re.match(rb"\{(\d+)\+?\}\r\n", name)
+    if lit:
+        name = name[lit.end():lit.end() + int(lit.group(1))]
+    elif name.startswith(b'"'):
+        name = re.match(rb'"((?:\\.|[^"\\])*)"', name).group(1)
+        name = re.sub(rb"\\(.)", rb"\1", name)
+    else:
+        name = name.split(b" ", 1)[0]
+    return attrs.split(), delim, name
+
+def parseStatus(data):
+    """Split the data of an untagged STATUS response into (mailbox, {item: value})"""
+    start = data.rindex(b"(")
+    box = data[:start].strip()
+    if box.startswith(b'"') and box.endswith(b'"'):
+        box = box[1:-1].replace(b'\\"', b'"').replace(b'\\\\', b'\\')
+    items = data[start + 1:data.rindex(b")")].split()
+    return box, dict((k.upper(), int(v)) for k, v in zip(items[0::2], items[1::2]))
+
+def numberRanges(numbers):
+    """Collapse message numbers into a sorted list of (first, last) ranges"""
+    res = []
+    for n in sorted(numbers):
+        if res and n <= res[-1][1] + 1:
+            res[-1][1] = max(res[-1][1], n)
+        else:
+            res.append([n, n])
+    return [tuple(r) for r in res]
+
+def sequenceRanges(seqset):
+    """Return the (first, last) ranges of an IMAP sequence set (no '*')"""
+    res = []
+    for part in seqset.split(b","):
+        if not part:
+            continue
+        first, _, last = part.partition(b":")
+        first = int(first)
+        last = int(last) if last else first
+        res.append((min(first, last), max(first, last)))
+    res.sort()
+    # Merge overlaps, which servers needn't avoid
+    merged = []
+    for first, last in res:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+def _metrics():
+    """Session metrics kept as connection class totals"""
+    c = imap4ClientConnection
+    return [
+            ("imap_bytes_received_total", {}, c.totalIn),
+            ("imap_bytes_sent_total", {}, c.totalOut),
+            ("imap_round_trips_total", {}, c.totalRoundTrips),
+            ("imap_server_wait_seconds_total", {}, c.totalWait),
+            ]
+metrics.sources.append(_metrics)
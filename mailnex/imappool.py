@@ -0,0 +1,145 @@
+# Pool of authenticated IMAP connections.
+#
+# Getting an IMAP connection ready costs several round trips (greeting,
+# STARTTLS, TLS handshake, login) and possibly a password prompt. The pool
+# keeps connections we're done with around, per account, so that going back
+# to an account we've recently used only costs a NOOP and a SELECT.
+#
+# An account is identified the same way do_folder decides whether a connection
+# can be reused: protocol, user, host, and port. Each connection remembers
+# which box it last had selected (mailnexBox), and lease() prefers a
+# connection that already has the requested box.
+#
+# Connections are 'leased' to a user (interactive commands, the IDLE watcher,
+# indexing, prefetching, ...). A leased connection belongs to whoever leased
+# it until it is released back to the pool. Only released connections are
+# kept alive by the pool.
+
+import time
+from . import imap4
+
+# Servers are allowed to drop connections after 30 minutes of inactivity.
+# Poke pooled connections a bit before that.
+KEEPALIVE_INTERVAL = 60 * 25
+
+# Purposes of connections used by background tasks rather than commands.
+# Their traffic isn't charged to commands by the profiler.
+BACKGROUND = ("folders", "watch", "journal", "record")
+
+def accountKey(conn):
+    """Return the account identifier for a connection."""
+    return (conn.mailnexProto, conn.mailnexUser, conn.mailnexHost, conn.mailnexPort)
+
+class ConnectionPool(object):
+    """Per-account pool of authenticated IMAP connections.
+
+    size is the number of unleased connections kept per account. Extra
+    connections are logged out, oldest first.
+    """
+    def __init__(self, size=2, debug=False):
+        object.__init__(self)
+        self.size = size
+        self.debug = debug
+        # Unleased connections, least recently used first
+        self.idle = []
+        # Leased connections, mapped to what they are being used for
+        self.leased = {}
+    def lease(self, key, box=None, purpose="interactive"):
+        """Lease a pooled connection for the given account.
+
+        Returns None if the pool doesn't have one. A connection whose last
+        selected box matches 'box' is preferred. Connections that fail a NOOP
+        are dropped.
+        """
+        candidates = [c for c in self.idle if accountKey(c) == key]
+        # Most recently used first, but a box match beats everything
+        candidates.reverse()
+        candidates.sort(key=lambda c: c.mailnexBox != box)
+        for c in candidates:
+            self.idle.remove(c)
+            c.background = purpose in BACKGROUND
+            try:
+                c.doSimpleCommand(b"NOOP")
+            except (imap4.imap4Exception, OSError) as ev:
+                if self.debug:
+                    print("pool: dropping dead connection to {}: {}".format(c.mailnexHost, ev))
+                self._discard(c)
+                continue
+            self.leased[c] = purpose
+            return c
+        return None
+    def add(self, conn, purpose="interactive"):
+        """Register a freshly made connection as leased."""
+        conn.background = purpose in BACKGROUND
+        self.leased[conn] = purpose
+    def release(self, conn):
+        """Return a leased connection to the pool."""
+        self.leased.pop(conn, None)
+        if conn.state == imap4.STATE_NOCON or conn.state == imap4.STATE_LOGOUT:
+            # Nothing worth keeping
+            return
+        conn.stopIdle()
+        # Whatever was watching this connection isn't any more. In particular,
+        # keepalive NOOPs mustn't feed updates into the current folder view.
+        for name in list(conn.cbs):
+            conn.clearCB(name)
+        conn.cb_fetch = None
+        conn.cb_search = None
+        conn.poolReleased = time.time()
+        self.idle.append(conn)
+        self.trim(accountKey(conn))
+    def forget(self, conn):
+        """Stop tracking a leased connection (e.g. because it died)."""
+        self.leased.pop(conn, None)
+    def trim(self, key=None):
+        """Logout unleased connections over the size limit.
+
+        With a key, only trim that account; otherwise trim all accounts.
+        """
+        counts = {}
+        # Walk newest to oldest so that the oldest are the ones dropped
+        for c in list(reversed(self.idle)):
+            k = accountKey(c)
+            if key is not None and k != key:
+                continue
+            counts[k] = counts.get(k, 0) + 1
+            if counts[k] > self.size:
+                self.idle.remove(c)
+                self._discard(c)
+    def keepalive(self):
+        """NOOP unleased connections that have been quiet for a while.
+
+        Cheap to call often; only connections near the server's inactivity
+        timeout are touched.
+        """
+        now = time.time()
+        for c in list(self.idle):
+            if now - c.poolReleased < KEEPALIVE_INTERVAL:
+                continue
+            try:
+                c.doSimpleCommand(b"NOOP")
+                c.poolReleased = now
+            except (imap4.imap4Exception, OSError):
+                self.idle.remove(c)
+                self._discard(c)
+    def closeAll(self):
+        """Logout and close all unleased connections."""
+        while self.idle:
+            self._discard(self.idle.pop())
+    def _discard(self, conn):
+        try:
+            conn.logout()
+        except (imap4.imap4Exception, OSError):
+            pass
+        conn.close()
+    def __iter__(self):
+        """Iterate over (connection, purpose) for all connections known to the pool.
+
+        Unleased connections have a purpose of None.
+        """
+        for c, purpose in self.leased.items():
+            yield c, purpose
+        for c in self.idle:
+            yield c, None
+    def __len__(self):
+        return len(self.leased) + len(self.idle)
@@ -0,0 +1,149 @@
+# Changes to messages waiting to be made on the server.
+#
+# With the 'offline' setting (e.g. on a train), marking messages read,
+# flagged, or deleted, and expunging, don't go to the server. They are
+# written here instead, made to the folder as we know it, and made on the
+# server once we are back online, by a background task (or when quitting).
+#
+# Entries name messages by UID, with the UIDVALIDITY of their folder, so
+# that they still mean the same messages however the folder changed in the
+# meantime. When the UIDVALIDITY is different, the UIDs mean nothing any
+# more and the entries are dropped (and the user told). Messages that have
+# gone are skipped by the server. Flags are only ever added or removed, never
+# set outright, so flags changed by other clients meanwhile are kept; where
+# both changed the same flag, ours wins. Expunges only remove the messages
+# we deleted (UID EXPUNGE), if the server has UIDPLUS.
+#
+# Replaying coalesces: within the changes between two expunges, only the
+# last change to each flag of each message counts, and messages getting the
+# same change are sent as one UID STORE of ranges. A day's triage of
+# thousands of messages, one command at a time, is a handful of commands,
+# sent together in one round trip.
+#
+# The journal is a file of JSON lines in the data directory. Entries are
+# appended (and synced) as they are made, so a crash doesn't lose them; the
+# file is rewritten when entries are done.
+
+import os
+import json
+import time
+from . import imap4
+from . import trace
+
+def rangesToSet(ranges):
+    """Return an IMAP sequence set (bytes) for (first, last) ranges"""
+    return b",".join(b"%d" % first if first == last else b"%d:%d" % (first, last) for first, last in ranges)
+
+def commands(entries, uidplus=True):
+    """Return the IMAP commands (bytes) making the changes of some entries.
+
+    The entries must all be for the same folder, and in the order they were
+    made.
+    """
+    res = []
+    # (flag, UID) -> '+' or '-', for the changes since the last expunge
+    changes = {}
+    def flush():
+        # Group the messages by the change they get
+        groups = {}
+        for (flag, uid), change in changes.items():
+            groups.setdefault((change, flag), []).append(uid)
+        for (change, flag), uids in sorted(groups.items()):
+            res.append(b"UID STORE %s %sFLAGS.SILENT (%s)" % (
+                rangesToSet(imap4.numberRanges(uids)), change.encode("ascii"), flag.encode("ascii")))
+        changes.clear()
+    for entry in entries:
+        if entry["op"] == "expunge":
+            flush()
+            if uidplus:
+                res.append(b"UID EXPUNGE %s" % rangesToSet(entry["uids"]))
+            else:
+                res.append(b"EXPUNGE")
+            continue
+        change = entry["op"][0]
+        for first, last in entry["uids"]:
+            for uid in range(first, last + 1):
+                changes[(entry["flag"], uid)] = change
+    flush()
+    return res
+
+class Journal(object):
+    """Changes made offline, waiting to be made on the server"""
+    def __init__(self, path):
+        object.__init__(self)
+        self.path = path
+        self.loaded = False
+        # Entries, oldest first. Each is a dict of:
+        #   account     - the account (as imappool.accountKey), as a list
+        #   box         - the folder
+        #   uidvalidity - UIDVALIDITY of the folder
+        #   op          - "+FLAGS", "-FLAGS", or "expunge"
+        #   flag        - the flag added or removed (str), or None
+        #   uids        - the messages, as [first, last] UID ranges
+        #   time        - when the change was made
+        self.entries = []
+    def load(self):
+        """Read the journal from disk, if we haven't yet"""
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        self.entries.append(json.loads(line))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ev:
+            if trace.general:
+                trace.event("general", "journal: can't read {}: {}".format(self.path, ev))
+    def add(self, account, box, uidvalidity, op, uids, flag=None):
+        """Record a change to the messages with the given UIDs"""
+        self.load()
+        entry = {
+                "account": list(account),
+                "box": box,
+                "uidvalidity": uidvalidity,
+                "op": op,
+                "flag": flag,
+                "uids": [list(r) for r in imap4.numberRanges(uids)],
+                "time": time.time(),
+                }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries.append(entry)
+    def folders(self):
+        """Return the (account, box) pairs with changes waiting, oldest first"""
+        self.load()
+        res = []
+        for entry in self.entries:
+            target = (tuple(entry["account"]), entry["box"])
+            if target not in res:
+                res.append(target)
+        return res
+    def pending(self, account, box):
+        """Return the entries for a folder, oldest first"""
+        self.load()
+        return [e for e in self.entries if tuple(e["account"]) == tuple(account) and e["box"] == box]
+    def remove(self, entries):
+        """Forget entries that have been made (or dropped)"""
+        done = set(id(e) for e in entries)
+        self.entries = [e for e in self.entries if id(e) not in done]
+        # Write to a temporary file and rename, so that a crash leaves
+        # either the old journal or the new one.
+        tmpname = "{}.{}".format(self.path, os.getpid())
+        try:
+            with open(tmpname, "w") as f:
+                for entry in self.entries:
+                    f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpname, self.path)
+        except OSError as ev:
+            if trace.general:
+                trace.event("general", "journal: can't write {}: {}".format(self.path, ev))
+    def __len__(self):
+        self.load()
+        return len(self.entries)
@@ -0,0 +1,144 @@
+# Index of the gpg keyring.
+#
+# Looking up keys with ctx.keylist(pattern) makes gpg scan the whole keyring
+# each time. Sending a signed and encrypted message does that once for the
+# signer and once per recipient, and showing a signature does it again for
+# the signer's fingerprint; with a large keyring each scan takes a noticeable
+# fraction of a second.
+#
+# Instead, we list the keyring once and index the keys by email address and
+# fingerprint. The index is rebuilt when any of the keyring files change
+# (importing a key, changing trust, ...), which we notice by their size and
+# modification time.
+#
+# The index may be used from worker threads (signature checking runs outside
+# the event loop), so building and reading it is done under a lock.
+
+import os
+import string
+import threading
+import email.utils
+
+# Files (and directories) in the gpg home whose change means the keyring
+# changed. Not all exist for every gpg version; missing ones are fine.
+KEYRING_FILES = (
+        "pubring.kbx",
+        "pubring.gpg",
+        "secring.gpg",
+        "trustdb.gpg",
+        "private-keys-v1.d",
+        )
+
+def gpgHome():
+    """Return the directory gpg keeps its keyring in"""
+    return os.environ.get("GNUPGHOME") or os.path.expanduser("~/.gnupg")
+
+def usable(key):
+    """Return whether key is neither expired, revoked, disabled, nor invalid"""
+    return not (key.expired or key.revoked or key.disabled or key.invalid)
+
+def isKeyId(pattern):
+    """Return whether pattern looks like a key ID or fingerprint"""
+    if pattern.lower().startswith("0x"):
+        pattern = pattern[2:]
+    return len(pattern) in (8, 16, 32, 40) and all(c in string.hexdigits for c in pattern)
+
+class KeyIndex(object):
+    """Keys of the gpg keyring, indexed by email address and fingerprint.
+
+    Methods take a gpg (or gpgme) Context to list the keyring with, in case
+    the index needs (re)building.
+    """
+    def __init__(self, home=None, debug=False):
+        object.__init__(self)
+        self.home = home if home else gpgHome()
+        self.debug = debug
+        self.lock = threading.Lock()
+        # Keyring file sizes and times when the index was built, or None if
+        # it hasn't been
+        self.stamp = None
+        # Public and secret keys, in keyring order
+        self.public = []
+        self.secret = []
+        # Lower-cased email address -> list of keys with that address
+        self.publicByEmail = {}
+        self.secretByEmail = {}
+        # Fingerprint (of the primary key or any subkey) -> public key
+        self.byFpr = {}
+    def currentStamp(self):
+        """Return the state of the keyring files on disk"""
+        res = []
+        for name in KEYRING_FILES:
+            try:
+                st = os.stat(os.sep.join((self.home, name)))
+            except OSError:
+                res.append(None)
+                continue
+            res.append((st.st_size, st.st_mtime_ns))
+        return tuple(res)
+    def _refresh(self, ctx):
+        stamp = self.currentStamp()
+        if stamp == self.stamp:
+            return
+        if self.debug:
+            print("keyindex: listing keyring in", self.home)
+        self.public = list(ctx.keylist(None, False))
+        self.secret = list(ctx.keylist(None, True))
+        self.publicByEmail = self._byEmail(self.public)
+        self.secretByEmail = self._byEmail(self.secret)
+        self.byFpr = {}
+        for key in self.public:
+            for sub in key.subkeys:
+                self.byFpr[sub.fpr.upper()] = key
+        self.stamp = stamp
+    def _byEmail(self, keys):
+        res = {}
+        for key in keys:
+            seen = set()
+            for uid in key.uids:
+                addr = (uid.email or "").lower()
+                if addr and addr not in seen:
+                    seen.add(addr)
+                    res.setdefault(addr, []).append(key)
+        return res
+    def _match(self, keys, byEmail, pattern):
+        """Find keys for pattern, much like gpg's own matching.
+
+        pattern can be a key ID or fingerprint, something with an email
+        address in it ("Name <addr>" or just "addr"), or a substring of a user
+        ID.
+        """
+        pattern = pattern.strip()
+        if isKeyId(pattern):
+            keyid = pattern.upper()
+            if keyid.startswith("0X"):
+                keyid = keyid[2:]
+            return [k for k in keys if any(s.fpr.upper().endswith(keyid) for s in k.subkeys)]
+        addr = email.utils.parseaddr(pattern)[1].lower()
+        if "@" in addr:
+            return list(byEmail.get(addr, []))
+        pattern = pattern.lower()
+        return [k for k in keys if any(pattern in u.uid.lower() for u in k.uids)]
+    def refresh(self, ctx):
+        """Rebuild the index if the keyring changed since it was built"""
+        with self.lock:
+            self._refresh(ctx)
+    def byFingerprint(self, ctx, fpr):
+        """Return the public key with the given (sub)key fingerprint, or None"""
+        with self.lock:
+            self._refresh(ctx)
+            return self.byFpr.get(fpr.upper())
+    def encryptionKeys(self, ctx, address):
+        """Return the usable keys that can encrypt to address"""
+        with self.lock:
+            self._refresh(ctx)
+            return [k for k in self._match(self.public, self.publicByEmail, address) if k.can_encrypt and usable(k)]
+    def signingKeys(self, ctx, identity):
+        """Return the usable secret keys matching identity that can sign.
+
+        identity is as for the pgpkey setting: a key ID, an address, or part
+        of a user ID.
+        """
+        with self.lock:
+            self._refresh(ctx)
+            return [k for k in self._match(self.secret, self.secretByEmail, identity) if k.can_sign and usable(k)]
@@ -0,0 +1,84 @@
+# Deferred imports.
+#
+# Several of the modules mailnex can use are slow to import (xapian, gpg,
+# keyring with its backend discovery, libmagic, ...) and only needed by a few
+# commands. Importing them all up front makes every start wait for them.
+#
+# LazyModule stands in for a module and imports it on first attribute access.
+# available() says whether a module could be imported, without importing it,
+# for the haveXapian/haveGpg style checks.
+#
+# Time spent importing is recorded (see startupTimes), so that --startup-profile
+# can show what got loaded before the first prompt and what it cost.
+
+import sys
+import time
+import importlib
+import importlib.util
+
+# (label, seconds) for each deferred import performed, in order
+importTimes = []
+
+# (label, time.perf_counter()) marks made during startup
+startupTimes = []
+
+def mark(label):
+    """Note that startup reached the named point"""
+    startupTimes.append((label, time.perf_counter()))
+
+def available(name):
+    """Return whether module 'name' can be imported, without importing it"""
+    if name in sys.modules:
+        return sys.modules[name] is not None
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+class LazyModule(object):
+    """Placeholder for a module that is imported when first used.
+
+    submodules are imported along with the module, for code that expects
+    'import a.b' to have happened (e.g. dateutil.parser).
+    """
+    def __init__(self, name, submodules=()):
+        object.__init__(self)
+        self.__dict__['_lazyName'] = name
+        self.__dict__['_lazySubmodules'] = submodules
+        self.__dict__['_lazyModule'] = None
+    def _lazyLoad(self):
+        module = self.__dict__['_lazyModule']
+        if module is None:
+            name = self.__dict__['_lazyName']
+            start = time.perf_counter()
+            module = importlib.import_module(name)
+            for sub in self.__dict__['_lazySubmodules']:
+                importlib.import_module("{}.{}".format(name, sub))
+            importTimes.append((name, time.perf_counter() - start))
+            self.__dict__['_lazyModule'] = module
+        return module
+    def __getattr__(self, attr):
+        return getattr(self._lazyLoad(), attr)
+    def __setattr__(self, attr, value):
+        setattr(self._lazyLoad(), attr, value)
+    def __repr__(self):
+        if self.__dict__['_lazyModule'] is None:
+            return "<lazy module '{}' (not loaded)>".format(self.__dict__['_lazyName'])
+        return repr(self.__dict__['_lazyModule'])
+
+def report(out=None):
+    """Print the startup marks and deferred imports"""
+    if out is None:
+        out = sys.stdout
+    if not startupTimes:
+        return
+    base = startupTimes[0][1]
+    prev = base
+    out.write("Startup profile (seconds):\n")
+    for label, when in startupTimes:
+        out.write("  {:8.4f} {:+8.4f}  {}\n".format(when - base, when - prev, label))
+        prev = when
+    if importTimes:
+        out.write("Deferred imports loaded during startup:\n")
+        for label, spent in importTimes:
+            out.write("  {:8.4f}  {}\n".format(spent, label))
@@ -106,17 +106,29 @@
 import os
 import sys
 import re
+# Deferred imports, and the startup profile
+from . import lazy
+lazy.mark("interpreter and package")
 import anyio
 from . decorators import *
 from . exceptions import MailnexException
 # xapian search engine
-try:
-    import xapian
-    haveXapian = True
-except ImportError:
-    haveXapian = False
+haveXapian = lazy.available("xapian")
+xapian = lazy.LazyModule("xapian")
 # various email helpers
 from . import imap4
+from . import imappool
+from . import smtp
+from . import outbox
+from . import keyindex
+from . import addressbook
+from . import trace
+from . import profiler
+from . import metrics
+from . import flagmap
+from . import watcher
+from . import foldertree
+from . import journal
 import email
 import email.utils
 import email.mime.text
@@ -126,21 +138,24 @@ import quopri
 import mailbox
 # password prompter
 import getpass
-# Password manager
-import keyring
+# Password manager. Finding its backends takes a while, and we often don't
+# need it (e.g. the pool has a connection, or there's no password at all).
+keyring = lazy.LazyModule("keyring")
 # Configuration and other directory management
 import xdg.BaseDirectory
+lazy.mark("core imports")
 # shell helper
 from . import cmdprompt
+lazy.mark("prompt_toolkit and pygments")
 from . import printfStyle
 from .pathcompleter import *
 from . import composer
 # Date handler
-import dateutil.parser
+dateutil = lazy.LazyModule("dateutil", ("parser", "tz"))
 # Color and other terminal stuffs
 import blessings
 # Ability to launch external viewers
-import mailcap
+mailcap = lazy.LazyModule("mailcap")
 # Interpret mailcap command strings and other similar lines as shells do
 # (quoting arguments and such)
 import shlex
@@ -155,19 +170,19 @@ import io
 from io import BytesIO
 from io import StringIO
 import codecs
-haveGpg = False
-haveGpgme = False
-try:
-    import gpg
-    haveGpg = True
-except ImportError:
-#if 1:
-    try:
-        import gpgme
-        haveGpgme = True
-        print("Warning: Using python-gpgme is deprecated. Please install python-gpg instead.")
-    except ImportError:
-        pass
+import json
+import hashlib
+import collections
+import bisect
+import signal
+# gpg is only loaded when there's something to sign, encrypt, decrypt, or
+# verify
+haveGpg = lazy.available("gpg")
+haveGpgme = not haveGpg and lazy.available("gpgme")
+gpg = lazy.LazyModule("gpg")
+gpgme = lazy.LazyModule("gpgme")
+if haveGpgme:
+    print("Warning: Using python-gpgme is deprecated. Please install python-gpg instead.")
 
 try:
     import urlparse
@@ -175,11 +190,44 @@ except ImportError:
     # Python 3 moved this
     from urllib import parse as urlparse
 from prompt_toolkit.completion import Completer, Completion
+lazy.mark("remaining imports")
 
 confFile = xdg.BaseDirectory.load_first_config("linsam.homelinux.com","mailnex","mailnex.conf")
 cacheDir = xdg.BaseDirectory.save_cache_path("linsam.homelinux.com","mailnex")
 defDbFile = os.sep.join((cacheDir, "searchdb"))
 histFile = os.sep.join((cacheDir, "histfile"))
+capsFile = os.sep.join((cacheDir, "capabilities"))
+foldersFile = os.sep.join((cacheDir, "folders.json"))
+dataDir = xdg.BaseDirectory.save_data_path("linsam.homelinux.com","mailnex")
+outboxDir = os.sep.join((dataDir, "outbox"))
+addressBookFile = os.sep.join((dataDir, "addressbook.json"))
+journalFile = os.sep.join((dataDir, "journal.jsonl"))
+
+# Most seconds between looks at whether the connection should go back to
+# IDLE (see idleRunner)
+IDLE_CHECK = 1
+
+# Seconds to wait after the unread count goes stale before counting again,
+# so that a burst of changes costs one count
+UNREAD_DELAY = 1
+
+# Most seconds between looks at whether the watched folders or account
+# changed (see watchRunner)
+WATCH_CHECK = 5
+
+# Seconds between NOOPs on a connection waiting for NOTIFY responses, to
+# keep servers from logging it out for inactivity
+WATCH_KEEPALIVE = 25 * 60
+
+# Seconds before trying again to list the folders of an account we couldn't
+# (e.g. for want of a password we can have without asking)
+FOLDERS_RETRY = 5 * 60
+
+# Seconds between looks at whether we are back online with offline changes
+# to make (see journalRunner) or folders to list (see folderRunner), and
+# before trying again to make them on an account where it failed
+JOURNAL_CHECK = 10
+JOURNAL_RETRY = 60
 
 # Enums
 ATTR_NEW = 0
@@ -209,10 +257,45 @@ class Context(object):
         # The IMAP (or whatever) connection instance. Should be the
         # abstraction for the message store
         self.connection = None
+        # Pool of other authenticated connections we might want again
+        # (imappool.ConnectionPool)
+        self.pool = None
+        # Whether the unread count needs asking the server for, and an
+        # anyio.Event that wakes up the background task that does it
+        self.unreadPending = False
+        self.unreadWake = None
+        # Counts of the folders in the watchfolders setting
+        # (watcher.FolderWatcher), if any
+        self.watcher = None
+        # Cached folder trees of the accounts (foldertree.FolderCache), the
+        # accounts whose trees want listing, and an anyio.Event that wakes
+        # up the background task that does it
+        self.folderCache = None
+        self.folderPending = set()
+        self.folderWake = None
+        # Changes made offline, waiting to be made on the server
+        # (journal.Journal), and an anyio.Event that wakes up the background
+        # task that makes them
+        self.journal = None
+        self.journalWake = None
+        # Whether messages of the current folder were expunged offline, so
+        # that our message numbers don't match the server's until the folder
+        # is opened again (see expungeLocally)
+        self.renumbered = False
+        # Messages waiting to be sent (outbox.Outbox), and an anyio.Event
+        # that wakes up the background sender
+        self.outbox = None
+        self.outboxWake = None
+        # Logged in SMTP sessions kept for the next message
+        # (smtp.SessionCache)
+        self.smtpSessions = None
         # list of messages from the last command
         self.lastList = None
         # list of messages making up the current virtual folder, if any
         self.virtfolder = None
+        # (virtfolder, its length, flagmap.positionMap of it), rebuilt when
+        # the virtual folder changes
+        self.virtfolderPositions = None
         # Extra info on messages in virtual folder. Used by things like thread
         # views. TODO: Ought to be collapsed into the virtfolder list
         # directly, but that will require some refactoring.
@@ -244,10 +327,25 @@ class Context(object):
         # Instance of blessings.Terminal or equivalent terminal formatting
         # package.
         self.t = None
+        # Flags of the messages of the current folder (flagmap.FlagMap)
+        self.flags = flagmap.FlagMap()
         # Message cache. Currently the key is the submessage identifier, and
         # the value is the text content. E.G. mime headers for message 123
         # part 4 would be key '123.4.MIME'
         self.cache = {}
+        # Results of decrypting and verifying message parts, so that viewing
+        # a message again doesn't mean running gpg again. Keyed by (box, UID,
+        # part, content digest); least recently used first.
+        self.cryptoCache = collections.OrderedDict()
+        # State of the keyring when the cryptoCache results were made
+        self.cryptoStamp = None
+        # Index of the gpg keyring (keyindex.KeyIndex)
+        self.keyIndex = None
+        # Addresses seen in messages, for completing recipients
+        # (addressbook.AddressBook)
+        self.addressBook = None
+        # Per-command timing for the session (profiler.Profiler)
+        self.profiler = None
         # Last IMAP criteria search. Used when specifying '()' as a message
         # list
         self.lastCriSearch = "()"
@@ -329,6 +427,47 @@ def getResultPart(part, data):
     # weird like returning a class or something.
     raise mailnexPartNotFound("Part %s not found" % part)
 
+# Tables for sanitize(), built once.
+#
+# ASCII control chars are 0-0x1f and 0x7f, called C0. ISO 6429 has
+# additional, C1. However, we leave gaps for whitespace generating chars,
+# which are handled by the condense option. We leave BS, Del, VT, and FF for
+# regular removal here. VT and FF could arguably go either way (strip or
+# condense).
+sanitizeStrip = [i for i in list(range(0, 0x20)) + [0x7f] + list(range(0x80, 0xa0))
+        if i not in (
+            0x9, # HTAB (horizontal tab)
+            0xa, # LF (line feed or Unix EOL (end of line)
+            0xd, # CR (carriage return. Part of Windows and Network new line (CR-LF))
+            0x85, # NEL (next line)
+            )]
+# str.translate tables: one deleting the control characters, one replacing
+# them.
+#
+# For replacing, there are two common(ish) styles. We can do caret notation,
+# which is most common in terminal programs, or we can use Unicode Control
+# Pictures, which is more common in GUIS like in web browsers. The latter
+# assumes a unicode terminal and font support, but that has gotten somewhat
+# more common. Still, a user toggle would probably be nice.
+# The Unicode Control Pictures block is 0x2400 to 0x243f. It includes
+# characters for 0x00 to 0x1f, 0x7f, and a couple of C1 characters.
+#
+# Caret notation puts '^' before the character 0x40 above the control
+# character ('@' for NUL, 'A' for 0x01, ...). High (C1) characters have no
+# standard display; we use '^^' followed by 'A' for the first (0x80), and
+# DEL, counted as one before C1, comes out as '^^@'.
+sanitizeDelete = dict.fromkeys(sanitizeStrip)
+sanitizeCaret = dict((i, "^" + chr(0x40 + i) if i < 0x20 else "^^" + chr(ord('A') + i - 0x80)) for i in sanitizeStrip)
+# For condensing, the same tables also turn each space generating character
+# into a plain space; runs of spaces are then squeezed by the regex.
+def makeSanitizeTable(condense, replace):
+    table = dict(sanitizeCaret if replace else sanitizeDelete)
+    if condense:
+        table.update(dict.fromkeys([0x9, 0xa, 0xd, 0x85], " "))
+    return table
+sanitizeTables = dict(((c, r), makeSanitizeTable(c, r)) for c in (False, True) for r in (False, True))
+re_sanitizeSpace = re.compile("  +")
+
 def sanitize(data, condense=True, replace=False):
     """Remove control characters and (optionally) condense space.
 
@@ -338,71 +477,22 @@ def sanitize(data, condense=True, replace=False):
     without fear of inline codes corrupting the view.
 
     Condensing the space is also useful for preventing tabs and newlines from
-    disrupting something expected to fit on a single line.
-    """
+    disrupting something expected to fit on a single line. Each run of tabs,
+    line breaks, and spaces becomes a single space; removed control characters
+    don't break up a run.
 
-    # TODO: these ought to be calculated just once during module load, not
-    # every time this function is called...
-
-    # ASCII control chars are 0-0x1f and 0x7f, called C0
-    c0 = list(range(0, 0x20)) + [0x7f]
-    # ISO 6429 has additional, C1
-    c1 = list(range(0x80,0xa0))
-    # However, we'll leave gaps for whitespace generating chars, which will be
-    # handled by the condense option
-    # We will leave BS, Del, VT, and FF for regular removal here. VT and FF
-    # could arguably go either way (strip or condense).
-    c0.remove(0x9) # HTAB (horizontal tab)
-    c0.remove(0xa) # LF (line feed or Unix EOL (end of line)
-    c0.remove(0xd) # CR (carriage return. Part of Windows and Network new line (CR-LF))
-    c1.remove(0x85) # NEL (next line)
-    stripChars = list(map(chr, c0 + c1))
-    condenseChars = list(map(chr, [0x9, 0xa, 0xd, 0x20, 0x85]))
+    With replace, control characters are shown in caret notation (e.g. '^['
+    for escape) instead of being removed.
 
-    res = []
-    lastChar = None
-    for i in data:
-        if condense and i in condenseChars:
-            # TODO: This probably doesn't work if we were given a bytes()
-            if lastChar != ' ':
-                res.append(' ')
-                lastChar = ' '
-            continue
-        if i in stripChars:
-            if replace:
-                # Two common(ish) styles. We can do caret notation, which is
-                # most common in terminal programs, or we can use Unicode
-                # Control Pictures, which is more common in GUIS like in web
-                # browsers. The latter assumes a unicode terminal and font
-                # support, but that has gotten somewhat more common. Still, a
-                # user toggle would probably be nice.
-                # The Unicode Control Pictures block is 0x2400 to 0x243f. It
-                # includes characters for 0x00 to 0x1f, 0x7f, and a couple of
-                # C1 characters.
-                res.append('^')
-                # Note: in ASCII and Unicode, '@' comes just before 'A', so
-                # calling it out separately is wasteful, unless we aren't
-                # assuming character encodings, but we are assuming, otherwise
-                # we wouldn't be hardcoding the range of control characters.
-                if ord(i) == 0:
-                    res.append('@')
-                elif ord(i) < 0x20:
-                    res.append(unichr(ord('A') + ord(i) - 1))
-                else:
-                    # Must be a high (C1) character. This display is
-                    # non-standard. We'll use '^^A' to refer to the first.
-                    res.append('^')
-                    res.append(unichr(ord('A') + ord(i) - 0x80))
-            laseChar = None
-            continue
-        res.append(i)
-        lastChar = i
-    def normalize_int_to_char(a):
-        # If we were given a bytes() we now have an array of ints. If we were given a str() we have an array of str(). Normalize to str
-        if isinstance(a, int):
-            a = chr(a)
-        return a
-    return "".join(map(normalize_int_to_char,res))
+    data can be str or bytes; bytes are taken a byte per character (as
+    latin-1). Returns str.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('latin-1')
+    data = data.translate(sanitizeTables[(bool(condense), bool(replace))])
+    if condense:
+        data = re_sanitizeSpace.sub(" ", data)
+    return data
 
 class MessageList(object):
     """Acts like a set, but automatically collapses ranges.
@@ -487,7 +577,48 @@ class MessageList(object):
     __iter__ = iterate
 
 
+def decodeHeaderBytes(value):
+    """Decode a raw header value, including any RFC 2047 encoded words"""
+    if b"=?" not in value:
+        return value.decode("utf-8", "replace")
+    try:
+        return str(email.header.make_header(email.header.decode_header(value.decode("ascii"))))
+    except Exception as ev:
+        if trace.general:
+            trace.event("general", "header decode error", ev)
+        return value.decode("utf-8", "replace")
+
+# Addresses of envelopes, shared between Envelope objects. The same few
+# people send and receive most messages in a folder, so most envelopes can
+# point at an address tuple that is already held rather than at their own
+# copy.
+sharedAddresses = {}
+SHARED_ADDRESSES_LIMIT = 100000
+
+def _envelopeField(field):
+    """Return an envelope address field as a shared tuple of tuples"""
+    if field is None or field == b'NIL':
+        return None
+    if len(sharedAddresses) > SHARED_ADDRESSES_LIMIT:
+        sharedAddresses.clear()
+    res = tuple(tuple(None if x == b'NIL' else x for x in addr) for addr in field)
+    try:
+        return sharedAddresses.setdefault(res, res)
+    except TypeError:
+        # A source route given as a list; rare enough not to share
+        return res
+
 class Envelope(object):
+    """A message's IMAP ENVELOPE, as kept in the message cache.
+
+    Fields are the raw bytes from the server (None for NIL), with the
+    address fields as tuples of (name, adl, mailbox, host) tuples shared
+    between envelopes. Decoding into text (which is the expensive part) is
+    done by subjectText and fromNames, on first use, and remembered.
+
+    Indexing it gives the fields in protocol order, like the list the parser
+    returns.
+    """
     # Envelope fields:
     #   0 - date
     #   1 - subject
@@ -505,12 +636,47 @@ class Envelope(object):
     #   name, and host name.
     #   Unless it is a group name; see page 77 of RFC 3501 for
     #   details.
+    fields = ('date', 'subject', 'from_', 'sender', 'replyTo', 'to', 'cc', 'bcc', 'inReplyTo', 'messageId')
+    __slots__ = fields + ('_subject', '_froms')
     def __init__(self, date, subject, from_, sender, replyTo, to, cc, bcc, inReplyTo, messageId):
-        # Assign each of our arguments to attributes of the same name
-        for i in "date subject from_ sender replyTo to cc bcc inReplyTo messageId".split():
-            setattr(self, i, locals()[i])
+        self.date = None if date == b'NIL' else date
+        self.subject = None if subject == b'NIL' else subject
+        self.from_ = _envelopeField(from_)
+        self.sender = _envelopeField(sender)
+        self.replyTo = _envelopeField(replyTo)
+        self.to = _envelopeField(to)
+        self.cc = _envelopeField(cc)
+        self.bcc = _envelopeField(bcc)
+        self.inReplyTo = None if inReplyTo == b'NIL' else inReplyTo
+        self.messageId = None if messageId == b'NIL' else messageId
+        self._subject = None
+        self._froms = None
+    @property
+    def subjectText(self):
+        """The subject, decoded"""
+        if self._subject is None:
+            self._subject = "" if self.subject is None else decodeHeaderBytes(self.subject)
+        return self._subject
+    @property
+    def fromNames(self):
+        """The senders, decoded; each is the name, or the address if unnamed"""
+        if self._froms is None:
+            res = []
+            for name, adl, mailbox, host in self.from_ or ():
+                if name is not None:
+                    res.append(decodeHeaderBytes(name))
+                else:
+                    res.append(decodeHeaderBytes(b"%s@%s" % (mailbox or b"", host or b"")))
+            self._froms = res
+        return self._froms
+    def __getitem__(self, index):
+        return getattr(self, self.fields[index])
+    def __len__(self):
+        return len(self.fields)
+    def __repr__(self):
+        return "<Envelope {!r} {!r}>".format(self.messageId, self.subject)
     def print(self):
-        for i in "date subject from_ sender replyTo to cc bcc inReplyTo messageId".split():
+        for i in self.fields:
             print("%s: %s" % (i, getattr(self, i)))
 
 
@@ -844,6 +1010,7 @@ def processImapData(text, options):
     """
 
 
+    started = time.perf_counter()
     curlist=[]
     lset=[]
     lset.append(curlist)
@@ -856,13 +1023,13 @@ def processImapData(text, options):
     literalSizeString = b""
     pos = -1
     last = len(text) - 1
-    if options.debug.parse:
-        print(" length:", last)
+    if trace.parse:
+        trace.event("parse", " length:", last)
     while pos < last:
         pos += 1
         c = text[pos:pos+1]
-        if options.debug.parse:
-            print(" Processing {} @ {}; inquote {} inspace {} inbrace {} wasquoted {} literalSize {} curtext is".format(repr(c), pos, inquote, inspace, inbrace, wasquoted, repr(literalSizeString), repr(curtext)))
+        if trace.parse:
+            trace.event("parse", "char", char=c, pos=pos, inquote=inquote, inspace=inspace, inbrace=inbrace, wasquoted=wasquoted, literalSize=literalSizeString, curtext=curtext)
         if c == b'\\' and inquote:
             # Backslash *should* only precede a doublequote or a backslash,
             # but we'll let it escape anything
@@ -871,13 +1038,13 @@ def processImapData(text, options):
             continue
         if c == b' ' or c == b'\t':
             if inquote:
-                if options.debug.parse:
-                    print(" keep space, we are quoted")
+                if trace.parse:
+                    trace.event("parse", " keep space, we are quoted")
                 curtext.append(c)
                 continue
             if not inspace:
-                if options.debug.parse:
-                    print(" End of token. Append completed word to list:", curtext)
+                if trace.parse:
+                    trace.event("parse", " End of token. Append completed word to list:", curtext)
                 inspace = True
                 thisStr = b"".join(curtext)
                 if not wasquoted and thisStr.lower() == b'nil':
@@ -893,19 +1060,19 @@ def processImapData(text, options):
                 literalSizeString += c
                 continue
             # Got close curly brace; process the literal
-            if options.debug.parse:
-                print("Literal size find:",literalSizeString)
+            if trace.parse:
+                trace.event("parse", "Literal size find:",literalSizeString)
             inbrace = False
             if literalSizeString.isdigit():
                 literalRemain = int(literalSizeString)
-                if options.debug.parse:
-                    print("Start literal. %i remain" % literalRemain)
-                    print("skipping", repr(text[pos:pos+3]))
+                if trace.parse:
+                    trace.event("parse", "Start literal. %i remain" % literalRemain)
+                    trace.event("parse", "skipping", repr(text[pos:pos+3]))
                 pos += 2
                 curtext.append(text[pos+1:pos+literalRemain+1])
                 pos += literalRemain
-                if options.debug.parse:
-                    print("Finished literal remain:", curtext)
+                if trace.parse:
+                    trace.event("parse", "Finished literal remain:", curtext)
                 continue
             raise Exception("Invalid literal size %s" % repr(literalSizeString))
         if inspace and c == b'{':
@@ -917,39 +1084,39 @@ def processImapData(text, options):
         if c == b'"':
             if inquote:
                 # TODO: Does ending a quote terminate an atom?
-                if options.debug.parse:
-                    print(" Leaving quote")
+                if trace.parse:
+                    trace.event("parse", " Leaving quote")
                 inquote = False
                 wasquoted = True
             else:
                 # TODO: Are we allowed to start a quote mid-atom?
-                if options.debug.parse:
-                    print(" Entering quote")
+                if trace.parse:
+                    trace.event("parse", " Entering quote")
                 inquote = True
             continue
         if c == b'(':
             if inquote:
-                if options.debug.parse:
-                    print(" keep paren, we are quoted")
+                if trace.parse:
+                    trace.event("parse", " keep paren, we are quoted")
                 curtext.append(c)
                 continue
             if len(curtext):
                 raise Exception("Need space before open paren?")
-            if options.debug.parse:
-                print(" start new list")
+            if trace.parse:
+                trace.event("parse", " start new list")
             curlist=[]
             lset.append(curlist)
             inspace = True
             continue
         if c == b')':
             if inquote:
-                if options.debug.parse:
-                    print(" keep paren, we are quoted")
+                if trace.parse:
+                    trace.event("parse", " keep paren, we are quoted")
                 curtext.append(c)
                 continue
             if len(curtext):
-                if options.debug.parse:
-                    print(" finish atom before finishing list", curtext)
+                if trace.parse:
+                    trace.event("parse", " finish atom before finishing list", curtext)
                 thisStr = b"".join(curtext)
                 if not wasquoted and thisStr.lower() == b'nil':
                     curlist.append(None)
@@ -962,13 +1129,13 @@ def processImapData(text, options):
             if len(lset) < 1:
                 raise Exception("Malformed input. Unbalanced parenthesis: too many close parenthesis")
             curlist = lset[-1]
-            if options.debug.parse:
-                print(" finish list", t)
+            if trace.parse:
+                trace.event("parse", " finish list", t)
             curlist.append(t)
             inspace = True
             continue
-        if options.debug.parse:
-            print(" normal character")
+        if trace.parse:
+            trace.event("parse", " normal character")
         curtext.append(c)
     if inquote:
         raise Exception("Malformed input. Reached end without a closing quote")
@@ -982,10 +1149,11 @@ def processImapData(text, options):
             curlist.append(thisStr)
     if len(lset) > 1:
         raise Exception("Malformed input. Unbalanced parentheses: Not enough close parenthesis")
-    if options.debug.parse:
-        print("lset", lset)
-        print("cur", curlist)
-        print("leftover", curtext)
+    if trace.parse:
+        trace.event("parse", "lset", lset)
+        trace.event("parse", "cur", curlist)
+        trace.event("parse", "leftover", curtext)
+    profiler.parseTime += time.perf_counter() - started
     return curlist
 
 def processHeaders(text):
@@ -1049,7 +1217,7 @@ def encodeEmail(fullmail):
     return email.utils.formataddr(p2)
 
 #password = getPassword("smtp", user, host, port)
-def getPassword(settings, protocol, user, host, port):
+def getPassword(settings, protocol, user, host, port, interactive=True):
     """Attempt to lookup a password for plain/login authentication.
 
     Will walk through agent-shell-lookup settings, keyrings, and finally
@@ -1063,6 +1231,9 @@ def getPassword(settings, protocol, user, host, port):
     interactively, and at some point, based on the user not indicating that
     they don't want to be prompted), and password is the string of the actual
     password.
+
+    If interactive is False, the user isn't prompted; password is None if it
+    couldn't be found otherwise.
     """
     agentCmd = None
     # NOTE: When updating how passwords or other auth is looked
@@ -1075,18 +1246,18 @@ def getPassword(settings, protocol, user, host, port):
             "agent-shell-lookup",
             ]
     for l in lookups:
-        if settings.debug.general:
-            print("Checking for", l)
+        if trace.general:
+            trace.event("general", "Checking for", l)
         if l in settings:
             agentCmd = getattr(settings, l).value
-            if settings.debug.general:
-                print(" Found it", agentCmd)
+            if trace.general:
+                trace.event("general", " Found it", agentCmd)
             break
     cantSave = False
     if agentCmd and agentCmd != "":
         cmdarr = ["/bin/sh", "-c", agentCmd]
-        if settings.debug.general:
-            print(" Running", cmdarr)
+        if trace.general:
+            trace.event("general", " Running", cmdarr)
         s = subprocess.Popen(cmdarr, stdout=subprocess.PIPE)
         pass_ = s.stdout.read(4096)
         s.stdout.close()
@@ -1125,6 +1296,8 @@ def getPassword(settings, protocol, user, host, port):
                 print("Warning: Couldn't use password manager: {}".format(repr(ev)))
                 cantSave = True
     prompt_to_save = False
+    if not pass_ and not interactive:
+        return None, False, None
     if not pass_:
         pass_ = getpass.getpass()
         if not cantSave:
@@ -1132,6 +1305,92 @@ def getPassword(settings, protocol, user, host, port):
         method = "interactive"
     return method, prompt_to_save, pass_
 
+async def externalAddressSearch(cmd, text):
+    """Run the addresssearchcmd for text.
+
+    Returns up to 9 results, each a list of the address, the name, and
+    optionally an identifier (e.g. name of address book). Failures give no
+    results.
+    """
+    try:
+        proc = await anyio.run_process(cmd.split() + [text], check=False, stderr=subprocess.DEVNULL)
+    except Exception:
+        # TODO: Log that we failed? Don't want to spam the screen
+        return []
+    if proc.returncode != 0:
+        return []
+    results = []
+    # Skip header line
+    for line in proc.stdout.decode('utf-8', 'replace').splitlines()[1:10]:
+        line = line.strip()
+        if line == "":
+            break
+        res = line.split('\t')
+        if len(res) > 1:
+            results.append(res)
+    return results
+
+def loadHostCaps(host, port):
+    """Get the remembered capabilities for an IMAP server.
+
+    Returns a dictionary with 'login' (capabilities before authentication)
+    and/or 'auth' (after authentication) lists, if known."""
+    try:
+        with open(capsFile) as f:
+            allcaps = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    hostcaps = allcaps.get("{}:{}".format(host, port), {})
+    return {k: [x.encode('ascii') for x in v] for k, v in hostcaps.items()}
+
+def saveHostCaps(host, port, hostcaps):
+    """Remember the capabilities of an IMAP server for next time."""
+    try:
+        with open(capsFile) as f:
+            allcaps = json.load(f)
+    except (OSError, ValueError):
+        allcaps = {}
+    allcaps["{}:{}".format(host, port)] = {k: [x.decode('ascii') for x in v] for k, v in hostcaps.items()}
+    # Write to a temporary file and rename, so that a second instance reading
+    # the file never sees half of it.
+    tmpname = "{}.{}".format(capsFile, os.getpid())
+    try:
+        with open(tmpname, "w") as f:
+            json.dump(allcaps, f)
+        os.rename(tmpname, capsFile)
+    except OSError:
+        # Not being able to cache isn't worth complaining about
+        pass
+
+def teeChunks(chunks, f):
+    """Pass blocks of data through, writing a copy of them to file f"""
+    for chunk in chunks:
+        f.write(chunk)
+        yield chunk
+
+def urlAccount(url):
+    """Return (account, box) for an IMAP URL, or None if it isn't one.
+
+    account is as used by the connection pool.
+    """
+    url = urlparse.urlparse(url)
+    ports = {'imap': 143, 'imaps': 993, 'imap+plain': 143}
+    if url.scheme not in ports:
+        return None
+    # TODO: Handle percent escaping
+    return (url.scheme, url.username, url.hostname, url.port or ports[url.scheme]), url.path.lstrip("/")
+
+def appendFile(c, box, path):
+    """APPEND the message in file path to box over IMAP connection c.
+
+    The file can have any line endings; they're converted to CRLF on the way.
+    """
+    with open(path, "rb") as f:
+        # IMAP wants the size up front, which we only know after conversion
+        size = sum(len(chunk) for chunk in smtp.canonicalChunks(smtp.iterChunks(f), False))
+        f.seek(0)
+        c.append(box, b"(\\Seen)", smtp.canonicalChunks(smtp.iterChunks(f), False), size)
+
 def normalizeSize(value, bi=False):
     """Given an integer value, normalize it to an SI prefix magnatude, and return as a float,string tuple
 
@@ -1164,7 +1423,21 @@ def normalizeSize(value, bi=False):
         unit += 'i'
     return (res, unit)
 
-def sigresToStringGpg(ctx, sig):
+def keyUid(ctx, fpr, keyIndex=None):
+    """Return the first user ID of the key with fingerprint fpr.
+
+    Returns None if there isn't exactly one such key. Looks in keyIndex
+    (keyindex.KeyIndex), if given, rather than asking gpg.
+    """
+    if keyIndex is not None:
+        key = keyIndex.byFingerprint(ctx, fpr)
+        return key.uids[0].uid if key is not None else None
+    keys = []
+    for k in ctx.keylist(fpr, False):
+        keys.append(k)
+    return keys[0].uids[0].uid if len(keys) == 1 else None
+
+def sigresToStringGpg(ctx, sig, keyIndex=None):
     if sig.summary & gpg.constants.SIGSUM_VALID:
         sigres = "\033[32mvalid\033[0m"
     else:
@@ -1204,16 +1477,13 @@ def sigresToStringGpg(ctx, sig):
         sigres += "(\033[32mf\033[0m)"
     if sig.validity == gpg.constants.VALIDITY_ULTIMATE:
         sigres += "(\033[34mu\033[0m)"
-    keys = []
-    for k in ctx.keylist(sig.fpr, False):
-        keys.append(k)
-    if len(keys) != 1:
+    uid = keyUid(ctx, sig.fpr, keyIndex)
+    if uid is None:
         # TODO: What if we get multiple matches for
         # the FPR? For now, we'll show the FPR raw if
         # we can't find it or find it isn't unique
         sigres += " from %s" % sig.fpr
     else:
-        key = keys[0]
         # TODO: Some kind of check between from and
         # the sig. Some notes:
         #   * The message isn't strictly bad if the
@@ -1233,9 +1503,9 @@ def sigresToStringGpg(ctx, sig):
         #     well as subject and date, into the
         #     signed portion to allow verification
         #     that those headers weren't tampered.
-        sigres += " from %s %s" % (sig.fpr[-8:], key.uids[0].uid)
+        sigres += " from %s %s" % (sig.fpr[-8:], uid)
     return sigres
-def sigresToString(ctx, sig):
+def sigresToString(ctx, sig, keyIndex=None):
     if sig.summary & gpgme.SIGSUM_VALID:
         sigres = "\033[32mvalid\033[0m"
     else:
@@ -1275,16 +1545,13 @@ def sigresToString(ctx, sig):
         sigres += "(\033[32mf\033[0m)"
     if sig.validity == gpgme.VALIDITY_ULTIMATE:
         sigres += "(\033[34mu\033[0m)"
-    keys = []
-    for k in ctx.keylist(sig.fpr, False):
-        keys.append(k)
-    if len(keys) != 1:
+    uid = keyUid(ctx, sig.fpr, keyIndex)
+    if uid is None:
         # TODO: What if we get multiple matches for
         # the FPR? For now, we'll show the FPR raw if
         # we can't find it or find it isn't unique
         sigres += " from %s" % sig.fpr
     else:
-        key = keys[0]
         # TODO: Some kind of check between from and
         # the sig. Some notes:
         #   * The message isn't strictly bad if the
@@ -1304,9 +1571,140 @@ def sigresToString(ctx, sig):
         #     well as subject and date, into the
         #     signed portion to allow verification
         #     that those headers weren't tampered.
-        sigres += " from %s %s" % (sig.fpr[-8:], key.uids[0].uid)
+        sigres += " from %s %s" % (sig.fpr[-8:], uid)
     return sigres
 
+async def runInterruptible(func, *args):
+    """Run blocking func(*args) in a worker thread, giving up on it at Ctrl-C.
+
+    Returns a tuple of whether func finished and what it returned. Exceptions
+    from func are passed on. An abandoned func keeps running in its thread;
+    whatever it eventually returns is dropped.
+    """
+    ret = None
+    done = False
+    error = None
+    async def work():
+        nonlocal ret, done, error
+        try:
+            ret = await anyio.to_thread.run_sync(func, *args, abandon_on_cancel=True)
+            done = True
+        except Exception as ev:
+            error = ev
+        tg.cancel_scope.cancel()
+    # Closing the receiver resets SIGINT to the interpreter's default rather
+    # than whatever the event loop had; put that back ourselves.
+    oldHandler = signal.getsignal(signal.SIGINT)
+    try:
+        with anyio.open_signal_receiver(signal.SIGINT) as signals:
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(work)
+                async for _ in signals:
+                    tg.cancel_scope.cancel()
+                    break
+    finally:
+        signal.signal(signal.SIGINT, oldHandler)
+    if error is not None:
+        raise error
+    return done, ret
+
+# Number of decrypt/verify results kept in Context.cryptoCache
+CRYPTO_CACHE_SIZE = 500
+
+# The following run gpg on message data. They block (gpg may well be waiting
+# on the user to enter a passphrase), so they are meant to be run in a worker
+# thread. Each returns a tuple of its result and whether the result may be
+# cached. Results involving a key we don't have aren't cached, so that
+# importing the key is noticed on the next view.
+
+def verifyGpg(messageData, sigData, keyIndex=None):
+    """Verify a detached signature using the gpg module.
+
+    The result is the signature string for display, or None.
+    """
+    ctx = gpg.Context()
+    try:
+        _, ret = ctx.verify(messageData, signature=sigData)
+        ret = ret.signatures
+    except gpg.errors.BadSignatures as ev:
+        ret=ev.result # or '_, ret = ev.results'
+        ret=ret.signatures
+    sigres = None
+    cacheable = True
+    for sig in ret:
+        # TODO: Handle displaying multiple signatures
+        sigres = sigresToStringGpg(ctx, sig, keyIndex)
+        if sig.summary & gpg.constants.SIGSUM_KEY_MISSING:
+            cacheable = False
+    return sigres, cacheable
+
+def verifyGpgme(messageData, sigData, keyIndex=None):
+    """Verify a detached signature using the deprecated gpgme module.
+
+    The result is the signature string for display, or None.
+    """
+    ctx = gpgme.Context()
+    msgdat = io.BytesIO(messageData)
+    sigdat = io.BytesIO(sigData)
+    ret = ctx.verify(sigdat, msgdat, None)
+    sigres = None
+    cacheable = True
+    for sig in ret:
+        # TODO: Handle displaying multiple signatures
+        sigres = sigresToString(ctx, sig, keyIndex)
+        if sig.summary & gpgme.SIGSUM_KEY_MISSING:
+            cacheable = False
+    return sigres, cacheable
+
+def decryptGpg(message, keyIndex=None):
+    """Decrypt (and verify, if signed) a message using the gpg module.
+
+    The result is a tuple of the plaintext and signature string, or None if
+    decryption failed.
+    """
+    ctx = gpg.Context()
+    try:
+        result, decrypt_info, verify_info = ctx.decrypt(message, verify=True)
+    except gpg.errors.GPGMEError:
+        # Could be the user cancelling the passphrase prompt; try again next
+        # time.
+        return None, False
+    except gpg.errors.BadSignatures as ev:
+        # We handle displaying bad signatures
+        # ourselves. Extract the values we wanted
+        # anyways.
+        result, decrypt_info, verify_info = ev.results
+    sigres = None
+    cacheable = True
+    for sig in verify_info.signatures:
+        # TODO: Handle displaying multiple signatures
+        sigres = sigresToStringGpg(ctx, sig, keyIndex)
+        if sig.summary & gpg.constants.SIGSUM_KEY_MISSING:
+            cacheable = False
+    return (result, sigres), cacheable
+
+def decryptGpgme(message, keyIndex=None):
+    """Decrypt (and verify, if signed) a message using the deprecated gpgme module.
+
+    The result is a tuple of the plaintext and signature string, or None if
+    decryption failed.
+    """
+    ctx = gpgme.Context()
+    msgdat = io.BytesIO(message)
+    result = io.BytesIO()
+    try:
+        ret = ctx.decrypt_verify(msgdat, result)
+    except gpgme.GpgmeError:
+        return None, False
+    sigres = None
+    cacheable = True
+    for sig in ret:
+        # TODO: Handle displaying multiple signatures
+        sigres = sigresToString(ctx, sig, keyIndex)
+        if sig.summary & gpgme.SIGSUM_KEY_MISSING:
+            cacheable = False
+    return (result.getvalue(), sigres), cacheable
+
 def scanSec(mtas, headers):
     # TODO: clean this up? Process headers using mail library first?
 
@@ -1393,7 +1791,7 @@ def enumerateKeys(keys):
 class Cmd(cmdprompt.CmdPrompt):
     def __init__(self, *args, **kwargs):
         cmdprompt.CmdPrompt.__init__(self, *args, **kwargs)
-        self.__dict__['do_='] = self.equals
+        setattr(self, 'do_=', self.equals)
         # Allow the equals symbol to show up in commands, which allows a
         # command to be named '='. Alternatively, we could handle it in the
         # default handler.
@@ -1696,12 +2094,13 @@ class Cmd(cmdprompt.CmdPrompt):
             data = self.C.connection.search("UTF-8", subcri)
             # Store original criteria for future recall
             self.C.lastCriSearch = cri
-            if self.C.settings.debug.general:
-                print(data)
+            if trace.general:
+                trace.event("general", data)
             data = map(int, data)
             if self.C.virtfolder:
                 # Convert back to virtual indices
-                data = map(lambda x: self.C.virtfolder.index(x) + 1, data)
+                positions = self.virtPositions()
+                data = (positions[x] for x in data if x in positions)
             for msg in data: messages.add(msg)
         for i in args:
             if i.startswith('('):
@@ -1728,31 +2127,22 @@ class Cmd(cmdprompt.CmdPrompt):
                 messages = MessageList()
                 if i.startswith(":"):
                     i = i[1:]
-                    if i == 'u':
-                        if self.C.virtfolder:
-                            r = MessageList(self.C.virtfolder).imapListStr() + " "
-                        else:
-                            r = ""
-                        data = self.C.connection.search("UTF-8", "{}unseen".format(r))
-                        if self.C.settings.debug.general:
-                            print(data)
-                        data = map(int, data)
-                        if self.C.virtfolder:
-                            # Convert back to virtual indices
-                            data = map(lambda x: self.C.virtfolder.index(x) + 1, data)
-                        for msg in data: messages.add(msg)
-                    elif i == 'f':
-                        if self.C.virtfolder:
-                            r = MessageList(self.C.virtfolder).imapListStr() + " "
+                    if i in ('u', 'f'):
+                        pred, key = (flagmap.IS_UNSEEN, "unseen") if i == 'u' else (flagmap.IS_FLAGGED, "flagged")
+                        if self.C.flags.loaded:
+                            data = self.C.flags.matching(pred)
                         else:
-                            r = ""
-                        data = self.C.connection.search("UTF-8", "{}flagged".format(r))
-                        if self.C.settings.debug.general:
-                            print(data)
-                        data = map(int, data)
+                            if self.C.virtfolder:
+                                r = MessageList(self.C.virtfolder).imapListStr() + " "
+                            else:
+                                r = ""
+                            data = map(int, self.C.connection.search("UTF-8", "{}{}".format(r, key)))
+                        if trace.general:
+                            trace.event("general", data)
                         if self.C.virtfolder:
                             # Convert back to virtual indices
-                            data = map(lambda x: self.C.virtfolder.index(x) + 1, data)
+                            positions = self.virtPositions()
+                            data = (positions[x] for x in data if x in positions)
                         for msg in data: messages.add(msg)
                     else:
                         print("Error: Unrecognized message class :{}".format(i))
@@ -1872,6 +2262,20 @@ class Cmd(cmdprompt.CmdPrompt):
             for j in parseRange(i): messages.add(j)
         return list(messages)
 
+    async def onecmd(self, line):
+        # Charge everything the command does to it, for the stats command.
+        command = self.parseline(line)[0] or "(next)"
+        if self.C.renumbered and not self.C.settings.offline:
+            await self.reopenFolder()
+        if command == "profile":
+            # The command it runs is recorded on its own; recording profile
+            # as well would count the time twice.
+            return await cmdprompt.CmdPrompt.onecmd(self, line)
+        before = profiler.snapshot()
+        try:
+            return await cmdprompt.CmdPrompt.onecmd(self, line)
+        finally:
+            self.C.profiler.record(command, before)
     def precmd(self, line):
         # We set lastcommand in some cases to repeat the last command instead
         # of the default implicit 'next'. When running commands that aren't
@@ -2049,37 +2453,65 @@ class Cmd(cmdprompt.CmdPrompt):
         argsList = args[1:-1].split()
         origArgsList = list(argsList)
         # Always re-cache flags
-        if b'FLAGS' in argsList:
+        if b'FLAGS' in argsList and self.C.settings.offline:
+            # Can't ask; go with what we know
             argsList.remove(b'FLAGS')
-            if self.C.settings.debug.general:
-                print("executing IMAP command FETCH {} {}".format(msgset.imapListStr(), '(FLAGS)'))
+            for i in msgset:
+                if b"%d.FLAGS" % i not in self.C.cache:
+                    self.C.cache[b"%d.FLAGS" % i] = self.knownFlags(i)
+        elif b'FLAGS' in argsList:
+            argsList.remove(b'FLAGS')
+            if trace.general:
+                trace.event("general", "executing IMAP command FETCH {} {}".format(msgset.imapListStr(), '(FLAGS)'))
             data = self.C.connection.fetch(msgset.imapListStr(), b'(FLAGS)')
             for d in data:
                 r = processImapData(d[1], self.C.settings)[0]
-                self.C.cache[b"%s.%s"%(d[0], b'FLAGS')] = getResultPart(b'FLAGS', r)
+                flags = getResultPart(b'FLAGS', r)
+                self.C.cache[b"%s.%s"%(d[0], b'FLAGS')] = flags
+                if self.C.flags.loaded:
+                    self.C.flags.set(int(d[0]), flags)
 
         # Build a fetch list
         flist = MessageList()
+        hits = 0
+        misses = 0
         for i in msgset:
             for a in argsList:
                 if a.upper().startswith(b"BODY.PEEK"):
                     a = b"BODY" + a[9:]
                 if not b'%d.%s'%(i,a) in self.C.cache:
                     flist.add(i)
+                    misses += 1
                     break
+            else:
+                hits += 1
+        if trace.cache:
+            trace.event("cache", "fetch", items=args, missing=flist.imapListStr())
+        metrics.count("cache_lookups_total", hits, cache="message", result="hit")
+        metrics.count("cache_lookups_total", misses, cache="message", result="miss")
         # Fetch and cache
+        if flist and self.C.settings.offline:
+            raise MailnexException("messages {} haven't been fetched, and we're offline".format(flist.imapListStr()))
         if flist:
             args = b'(%s)' % b" ".join(argsList)
-            if self.C.settings.debug.general:
-                print("executing IMAP command FETCH {} {}".format(flist.imapListStr(), args))
+            if trace.general:
+                trace.event("general", "executing IMAP command FETCH {} {}".format(flist.imapListStr(), args))
             data = self.C.connection.fetch(flist.imapListStr(), args)
+            # Remember the addresses of messages we haven't seen before, for
+            # completion
+            book = self.C.addressBook if b'ENVELOPE' in argsList and self.C.settings.addressbook else None
+            sent = book is not None and self.inRecordFolder()
             for d in data:
                 r = processImapData(d[1], self.C.settings)[0]
                 for arg in argsList:
                     if arg.upper().startswith(b"BODY.PEEK"):
                         arg = b"BODY" + arg[9:]
                     part = getResultPart(arg, r)
+                    if arg == b'ENVELOPE':
+                        part = Envelope(*part)
                     self.C.cache[b"%s.%s"%(d[0], arg)] = part
+                if book is not None:
+                    book.addEnvelope(self.C.cache[b"%s.ENVELOPE"%(d[0])], sent)
         data = []
         for i in msgset:
             d = []
@@ -2095,13 +2527,18 @@ class Cmd(cmdprompt.CmdPrompt):
     def getAddressCompleter(self):
         """Return a Completer class that will complete email addresses based on current preferences.
 
-        It will be suitable for prompt_toolkit's completion."""
+        It will be suitable for prompt_toolkit's completion. Addresses come
+        from the local address book straight away; the addresssearchcmd runs
+        in the background, and what it finds is added when it finishes."""
+        book = self.C.addressBook
+        settings = self.C.settings
         class EmailCompleter(Completer):
-            """This class currently requires code that creates objects of this to
-            set an attribute "settings" that will have the searchcmd in it."""
-            def get_completions(self, document, complete_event):
-                if self.settings.addresssearchcmd.value == "":
-                    return
+            def __init__(self):
+                Completer.__init__(self)
+                # Results of the addresssearchcmd, by search text
+                self.external = {}
+            def current(self, document):
+                """Return the address being typed, the leading space, and how far back it starts"""
                 before = document.current_line_before_cursor
                 after = document.current_line_after_cursor
                 # Simple first pass, use comma separation.
@@ -2113,40 +2550,56 @@ class Cmd(cmdprompt.CmdPrompt):
                 thisend = after.split(',')[0]
                 this = thisstart + thisend
                 prefix = " " if this.startswith(" ") else ""
-                this = this.strip()
-                try:
-                    s = subprocess.Popen(self.settings.addresssearchcmd.value.split() + [this], stdin=None, stdout=subprocess.PIPE)
-                except Exception as ev:
-                    # TODO: Log that we failed? Don't want to spam the screen
+                return this.strip(), prefix, -len(thisstart)
+            def completion(self, prefix, start, address, name, meta):
+                if name:
+                    completion = "{} <{}>,".format(name, address)
+                else:
+                    completion = "{},".format(address)
+                return Completion(prefix + completion, display=completion, start_position=start, display_meta=meta)
+            def local(self, document):
+                if not settings.addressbook:
                     return
-                results=[]
-                for i in range(10):
-                    res = s.stdout.readline().strip()
-                    res = res.decode('utf-8')
-                    #print(i,repr(res))
-                    if res == "":
-                        break
-                    # Skip header line
-                    if i == 0:
-                        continue
-                    results.append(res.split('\t'))
-                s.stdout.close()
-                res = s.wait()
-                if res != 0 or len(results) == 0:
-                    #print("res:",res,"len",len(results))
+                this, prefix, start = self.current(document)
+                for entry in book.search(this):
+                    if entry.sent:
+                        meta = "sent {}".format(entry.sent)
+                    elif entry.seen:
+                        meta = "seen {}".format(entry.seen)
+                    else:
+                        meta = None
+                    yield entry.address.lower(), self.completion(prefix, start, entry.address, entry.name, meta)
+            def get_completions(self, document, complete_event):
+                for address, completion in self.local(document):
+                    yield completion
+            async def get_completions_async(self, document, complete_event):
+                shown = set()
+                for address, completion in self.local(document):
+                    shown.add(address)
+                    yield completion
+                cmd = settings.addresssearchcmd.value
+                if not cmd:
                     return
+                this, prefix, start = self.current(document)
+                if this not in self.external:
+                    self.external[this] = await externalAddressSearch(cmd, this)
+                    if settings.addressbook:
+                        book.addExternal((res[0], res[1]) for res in self.external[this])
+                for res in self.external[this]:
+                    if res[0].lower() in shown:
+                        continue
+                    yield self.completion(prefix, start, res[0], res[1], res[2] if len(res) > 2 else None)
+        return EmailCompleter()
 
-                for res in results:
-                    if len(res) > 1:
-                        completion = "{} <{}>,".format(res[1], res[0])
-                        if len(res) > 2:
-                            meta = res[2]
-                        else:
-                            meta = None
-                        yield Completion(prefix + completion, display=completion, start_position=-len(thisstart), display_meta=meta)
-        compl = EmailCompleter()
-        compl.settings = self.C.settings
-        return compl
+    def inRecordFolder(self):
+        """Return whether the open folder is where the 'record' setting saves sent messages"""
+        rec = self.C.settings.record.value
+        if not rec or not self.C.connection:
+            return False
+        if rec.startswith("+"):
+            rec = (self.C.settings.folder.value or "") + rec[1:]
+        url = urlparse.urlparse(rec)
+        return url.hostname == self.C.connection.mailnexHost and url.path.lstrip("/") == self.C.connection.mailnexBox
 
     @showExceptions
     def equals(self, args):
@@ -2224,6 +2677,7 @@ class Cmd(cmdprompt.CmdPrompt):
             print("Error:", type(ev), ev)
             return
         C.connection = M
+        C.flags = flagmap.FlagMap()
         C.currentMessage = 1
         C.nextMessage = 1
         C.lastMessage = len(M) - 1
@@ -2297,31 +2751,22 @@ class Cmd(cmdprompt.CmdPrompt):
             if not self.C.connection:
                 print("No connection. Give a location to this command to establish a connection.\nSee 'help folder' for more info.")
                 return
-            if not b'ESEARCH' in self.C.connection.caps:
-                unseen = len(self.C.connection.search("utf-8", "UNSEEN"))
-            else:
-                searchres = self.C.connection.esearch("COUNT", "utf-8", "UNSEEN")
-                if 'COUNT' in searchres:
-                    unseen = int(searchres['COUNT'])
-                else:
-                    unseen = 0
-            print("\"{}://{}@{}:{}/{}\": {} messages {} unread".format(
-                self.C.connection.mailnexProto,
-                self.C.connection.mailnexUser,
-                self.C.connection.mailnexHost,
-                self.C.connection.mailnexPort,
-                self.C.connection.mailnexBox,
-                self.C.lastMessage,
-                unseen,
-                ))
-            self.status['unread'] = unseen
+            self.showFolderInfo()
             return
 
-
         C = self.C
         argss = args.split()
         user = None
         proto = None
+        c = None
+        # Time spent in each phase of opening the folder, for the 'timing'
+        # debug flag.
+        timings = []
+        lastMark = [time.time()]
+        def phase(name):
+            now = time.time()
+            timings.append((name, now - lastMark[0]))
+            lastMark[0] = now
         if len(argss) == 2:
             host = argss[0]
             port = int(argss[1])
@@ -2375,22 +2820,25 @@ class Cmd(cmdprompt.CmdPrompt):
                     self.C.cache = {}
                     c.mailnexBox = box
             else:
-                print("disconnecting")
-                if C.connection.poller:
-                    C.connection.poller.stop()
-                    C.connection.poller.close()
-                C.connection.close()
-                #C.connection.logout()
+                # Different account. Keep the connection around in case we
+                # come back to it.
+                C.connection.poller = None
+                C.pool.size = C.settings.imappool.value
+                C.pool.release(C.connection)
                 C.connection = None
-                # Since we closed the connection, the message cache is no
+                # Since we left the connection, the message cache is no
                 # longer valid. Wipe it.
                 del self.C.cache
                 self.C.cache = {}
-        if not C.connection:
+        if not c:
+            c = C.pool.lease((proto, user, host, port), box)
+            if c:
+                print("Info: Reusing pooled connection to {}".format(host))
+                c.mailnexBox = box
+        if not c:
             print("Connecting to '%s'" % args)
             c = imap4.imap4ClientConnection()
             c.poller = None
-            c.debug = C.settings.debug.imap
 
             if "cacertsfile_{}".format(host) in self.C.settings:
                 c.setCaCerts(getattr(self.C.settings, "cacertsfile_{}".format(host)).value)
@@ -2407,23 +2855,36 @@ class Cmd(cmdprompt.CmdPrompt):
             except imap4.imap4NoConnect as ev:
                 print(f"Failed to connect: {ev}: {ev.lower}")
                 return
+            phase("connect")
 
             try:
                 if c.isTls():
-                    print("Info: Connection already secure")
+                    print("Info: Connection already secure{}".format(" (resumed)" if c.tlsResumed() else ""))
                 elif proto == "imap+plain":
                         print(self.C.t.red("Warning: Connection is NOT secure! Login credentials are not protected!"))
                 else:
-                    # TODO: if not c.caps, run capability command
-                    if not c.caps or not 'STARTTLS' in c.caps:
+                    if not c.caps or not b'STARTTLS' in c.caps:
                         print("Remote doesn't claim TLS support; trying anyway")
                     print("Info: Startting TLS negotiation")
                     c.starttls()
                     if c.isTls():
-                        print("Info: Connection now secure")
+                        print("Info: Connection now secure{}".format(" (resumed)" if c.tlsResumed() else ""))
                     else:
                         #TODO: Allow user to override (at their own peril) should be per-host. Should possibly not be global.
                         raise Exception("Failed to secure connection!")
+                    phase("tls")
+                # Capabilities rarely change, so remember them between runs
+                # rather than asking every time the server doesn't volunteer
+                # them.
+                hostcaps = loadHostCaps(host, port)
+                oldhostcaps = dict(hostcaps)
+                if not c.caps:
+                    if 'login' in hostcaps:
+                        c.caps = hostcaps['login']
+                    else:
+                        c.getCapabilities()
+                        phase("capability")
+                hostcaps['login'] = c.caps
                 if not user:
                     user = getpass.getuser()
                 if proto == "imap+plain":
@@ -2435,6 +2896,7 @@ class Cmd(cmdprompt.CmdPrompt):
                     pass_ = getpass.getpass()
                 else:
                     _, prompt_to_save, pass_ = getPassword(self.C.settings, proto, user, host, port)
+                phase("password")
                 print("Info: Logging in")
                 # TODO: Retry N times? Or at least, prompt for password entry
                 # if we got the password from an agent or keyring that didn't
@@ -2445,6 +2907,16 @@ class Cmd(cmdprompt.CmdPrompt):
                 # entered by prompt (e.g. by agent (and which agent?) or by
                 # keyring (and which keyring?))
                 c.login(user, pass_)
+                phase("login")
+                if not c.caps:
+                    if 'auth' in hostcaps:
+                        c.caps = hostcaps['auth']
+                    else:
+                        c.getCapabilities()
+                        phase("capability")
+                hostcaps['auth'] = c.caps
+                if hostcaps != oldhostcaps:
+                    saveHostCaps(host, port, hostcaps)
                 if prompt_to_save:
                     # TODO: Allow user to prevent this prompt. Perhaps by
                     # disabling keyring in general, or by disabling it for
@@ -2461,8 +2933,18 @@ class Cmd(cmdprompt.CmdPrompt):
                             break
                         elif line == 'n' or line == 'no':
                             break
+                    phase("keyring prompt")
                 del pass_
                 print("Info: Loggin complete")
+                C.pool.add(c)
+                if self.C.settings.compress and b'COMPRESS=DEFLATE' in c.caps:
+                    try:
+                        c.compress()
+                        print("Info: Compression enabled")
+                    except imap4.imap4Exception as ev:
+                        # Not fatal; we just carry on uncompressed.
+                        print("Info: Couldn't enable compression:", ev)
+                    phase("compress")
             except KeyboardInterrupt:
                 print("Aborting connection")
                 self.C.connection = None
@@ -2483,33 +2965,25 @@ class Cmd(cmdprompt.CmdPrompt):
                 return
         try:
             c.clearCB("exists")
-            if box:
-                c.select(box)
-            else:
-                c.select()
+            # Learn the flags of every message along with the select, without
+            # waiting for the select to finish first. From here on, the
+            # untagged responses keep them up to date.
+            flagSets = c.selectSearches(box if box else None, "utf-8", [key for key, bit, matchSets in flagmap.SEARCHES])
+            phase("select")
             print("Info: Mailbox opened")
             self.C.connection = c
+            self.C.flags = flagmap.FlagMap()
+            self.C.flags.load(c.exists, flagSets)
+            unseenCount = self.C.flags.count(flagmap.IS_UNSEEN)
+            # The callbacks set below adjust the count from here on, and can
+            # run (e.g. on entering IDLE) before showFolderInfo.
+            self.status['unread'] = unseenCount
             # By default, mailx marks the first unseen or flagged message as
             # the current message.
             # TODO: Actually, I think its the first new message, then flagged.
-            if not hasattr(self.C.connection, 'unseen') or not self.C.connection.unseen:
-                # IMAP server didn't give us the first unseen message on
-                # connect; we'll have to ask for it. It could either be that
-                # the server didn't feel like sending one, or there are no
-                # messages that are unseen.
-                unseen = list(map(int, self.C.connection.search("utf-8", "UNSEEN")))
-            else:
-                unseen = [self.C.connection.unseen]
-            if len(unseen) != 0:
-                self.C.currentMessage = sorted(unseen)[0]
-            else:
-                flagged = list(map(int, self.C.connection.search("utf-8", "flagged")))
-                if len(flagged) != 0:
-                    self.C.currentMessage = sorted(flagged)[0]
-                else:
-                    # Final fallback: start at beginning.
-                    # TODO: There's probably a setting to start at the end
-                    self.C.currentMessage = 1
+            # Final fallback: start at beginning.
+            # TODO: There's probably a setting to start at the end
+            self.C.currentMessage = self.C.flags.first(flagmap.IS_UNSEEN) or self.C.flags.first(flagmap.IS_FLAGGED) or 1
             self.C.lastMessage = c.exists
             c.setCB("exists", self.newExist)
             c.setCB("expunge", self.newExpunge)
@@ -2519,14 +2993,17 @@ class Cmd(cmdprompt.CmdPrompt):
                 # range checking is probably good anyway.
                 self.C.currentMessage = self.C.lastMessage
             self.C.nextMessage = C.currentMessage
-            if self.C.settings.debug.general:
+            if trace.general:
                 # TODO: Maybe we should output this kind of info anyway...
-                print("Current message: %s. Last message: %s" % (self.C.currentMessage, self.C.lastMessage))
+                trace.event("general", "Current message: %s. Last message: %s" % (self.C.currentMessage, self.C.lastMessage))
             self.C.lastList = []
             self.C.virtfolder = None
+            self.C.virtfolderPositions = None
             self.C.prevMessage = None
 
             if b'IDLE' in c.caps:
+                # idleRunner keeps the connection idling; bgcheck just looks
+                # after the pools.
                 self.C.bgtimer.stop()
                 self.C.bgtimer.start(60*29, 60*29)
                 c.poller = Poller(self.C.tg, c.socket, self.checkData)
@@ -2534,19 +3011,109 @@ class Cmd(cmdprompt.CmdPrompt):
                 c.doIdle()
             else:
                 self.C.bgtimer.stop()
-                self.C.bgtimer.start(self.bgcheck, 1, 5)
+                self.C.bgtimer.start(1, 5, self.bgcheck, None)
+            self.folderTree(imappool.accountKey(c))
 
         except KeyboardInterrupt:
             print("Aborting")
             return
+        phase("search")
         # Finally, print stats about the connection
-        # We already print this when called with no CLI arguments, so... just
-        # call ourselves with empty CLI arguments to display it.
-        await self.do_folder("")
+        self.showFolderInfo(unseenCount)
         # Finally finally, if 'headers' or 'headers_folder' is set, display
         # headers
         if self.C.settings.headers_folder if self.C.settings.headers_folder.value is not None else self.C.settings.headers:
             self.do_headers("")
+            phase("headers")
+        c.connectTimings = timings
+        if self.C.settings.debug.timing:
+            print("Timing: {}, total {:.3f}s".format(
+                ", ".join("{} {:.3f}s".format(name, t) for name, t in timings),
+                sum(t for name, t in timings),
+                ))
+
+    def virtPositions(self):
+        """Return the position map of the virtual folder (see flagmap.positionMap)"""
+        vf = self.C.virtfolder
+        cached = self.C.virtfolderPositions
+        # The virtual folder is sometimes extended in place (e.g. by more
+        # search results), so check the length as well
+        if cached is None or cached[0] is not vf or cached[1] != len(vf):
+            cached = self.C.virtfolderPositions = (vf, len(vf), flagmap.positionMap(vf))
+        return cached[2]
+
+    def countUnseen(self):
+        """Return the number of unseen messages in the current folder.
+
+        Counted from the flags we know if we can, otherwise asked of the
+        server in a way that returns just the count.
+        """
+        c = self.C.connection
+        if self.C.flags.loaded:
+            return self.C.flags.count(flagmap.IS_UNSEEN)
+        if b'ESEARCH' in c.caps:
+            searchres = c.esearch("COUNT", "utf-8", "UNSEEN")
+            return int(searchres.get('COUNT', 0))
+        # STATUS of the selected folder is frowned on by RFC 3501, but is
+        # still far cheaper than a SEARCH returning every unseen message.
+        try:
+            return c.status(c.mailnexBox, "UNSEEN")[b'UNSEEN']
+        except (imap4.imap4Exception, KeyError):
+            return len(c.search("utf-8", "UNSEEN"))
+
+    def unreadStale(self):
+        """Note that the unread count is out of date.
+
+        The count is asked for again a moment later, in the background, so
+        that a burst of changes (e.g. another client marking thousands of
+        messages read) costs one query rather than one each.
+        """
+        self.C.unreadPending = True
+        if self.C.unreadWake is not None:
+            self.C.unreadWake.set()
+
+    async def unreadRunner(self):
+        """Background task refreshing the unread count when it goes stale"""
+        C = self.C
+        while True:
+            await C.unreadWake.wait()
+            # Coalesce: whatever else goes stale in the meantime is covered
+            # by this one count. Waiting a fixed time rather than for things
+            # to go quiet keeps the count moving during long bursts.
+            await anyio.sleep(UNREAD_DELAY)
+            C.unreadWake = anyio.Event()
+            if not C.unreadPending or not C.connection or C.settings.offline:
+                continue
+            C.unreadPending = False
+            try:
+                self.status['unread'] = self.countUnseen()
+            except imap4.imap4Exception as ev:
+                if trace.general:
+                    trace.event("general", "unread count failed", ev)
+                continue
+            if self.cli.app._is_running:
+                self.cli.app.invalidate()
+
+    def showFolderInfo(self, unseen=None):
+        """Print an overview of the current connection.
+
+        If the unseen count isn't given, work it out (see countUnseen)."""
+        if unseen is None:
+            unseen = self.countUnseen()
+        print("\"{}://{}@{}:{}/{}\": {} messages {} unread".format(
+            self.C.connection.mailnexProto,
+            self.C.connection.mailnexUser,
+            self.C.connection.mailnexHost,
+            self.C.connection.mailnexPort,
+            self.C.connection.mailnexBox,
+            self.C.lastMessage,
+            unseen,
+            ))
+        if self.C.connection.isCompressed():
+            rin, rout = self.C.connection.compressionRatio()
+            print("Compression: in %.1f:1 (%7.3f %sB on the wire), out %.1f:1" % (
+                (rin,) + normalizeSize(self.C.connection.wireIn, bi=True) + (rout,)))
+        self.status['unread'] = unseen
 
     @showExceptions
     @needsConnection
@@ -2556,72 +3123,158 @@ class Cmd(cmdprompt.CmdPrompt):
         usage:
             folders
             folders base/path
+            folders -r [base/path]
 
-        Doesn't currently support much for listing, but is hopefully somewhat
-        helpful for the folder command.
+        Folders with subfolders are shown with the hierarchy delimiter at the
+        end. The list comes from the cached folder tree of the account; it is
+        refreshed in the background when it gets old, or straight away with
+        -r. The first time, the folders are listed from the server before
+        showing them.
 
         NOTE: Some older servers (e.g. uwimapd) will do a full recursive
         descent even when we only ask for one level of hierarchy. If you have
         a deep folder set on the remote side (e.g. a full unix home
-        directory), this command can take a lot of time. Worse, if you have
-        any symbolic loops, it can take a VERY long time (either forever or
-        until the server gets some errors about exceeding path limits)
+        directory), listing the folders from the server can take a lot of
+        time. Only a limited depth is listed, so symbolic loops on the server
+        don't keep us going forever.
 
         See also lsub.
         """
-        oldcb = None
-        if "list" in self.C.connection.cbs:
-            oldcb = self.C.connection.cbs["list"]
-        folders = []
-        def mycb(line):
-            # TODO: More of this ought to be handled by the connection instead
-            # fo us.
-            if not line.startswith(b"* LIST "):
-                raise Exception("Bad format from server")
-            flags, delim, path =  processImapData(line[7:] + b' ', self.C.settings)
-            # TODO: Is this supposed to be case insensitive?
-            # TODO: How to handle servers without the CHILDREN extension? We
-            # could probe or just never give hints about subfolders
-            if b'CHILDREN' in self.C.connection.caps and b'\\HasChildren' in flags:
-                # NOTE: According to RFC3348, a server MAY have both
-                # HasChildren and HasNoChildren if it isn't sure, and then we
-                # shouldn't make assumptions, but on the next line says it is
-                # an error if the server does this. I think we'll err on the
-                # side of having children, and if the user cannot select it,
-                # they'll get an error.
-                print("{}{}".format(path.decode("utf-8"),delim.decode("utf-8")))
-            else:
-                print("{}".format(path.decode("utf-8")))
-        self.C.connection.cbs["list"] = mycb
-        try:
-            if len(args) == 0:
-                self.C.connection.doSimpleCommand(b"LIST \"\" %")
-            else:
-                # TODO: Horrible. Should check formatting, and probably need to
-                # handle escaping the string properly
-                # TODO: obtain the 'correct' final separator somehow instead
-                # of assuming slash
-                self.C.connection.doSimpleCommand(b"LIST \"\" %s/%%"%(args))
-        except:
-            if oldcb:
-                self.C.connection.cbs["list"] = oldcb
+        args = args.strip()
+        refresh = False
+        if args == "-r" or args.startswith("-r "):
+            refresh = True
+            args = args[2:].strip()
+        key = imappool.accountKey(self.C.connection)
+        tree = None if refresh else self.folderTree(key)
+        if tree is None:
+            tree = foldertree.scan(self.C.connection, key)
+            self.C.folderCache.put(tree)
+        base = args.rstrip(tree.delimiter or "")
+        for name in tree.children(base):
+            if tree.hasChildren(name):
+                print("{}{}".format(name, tree.delimiter))
             else:
-                del self.C.connection.cbs["list"]
-            raise
+                print(name)
+
+    def folderTree(self, key):
+        """Return the cached folder tree of an account, or None.
+
+        Asks for the tree to be listed in the background if we don't have it
+        or it's getting old.
+        """
+        if self.C.folderCache is None:
+            # Not a full session (e.g. a benchmark driving commands)
+            return None
+        tree = self.C.folderCache.get(key)
+        if tree is None or tree.age() > foldertree.MAX_AGE:
+            self.C.folderPending.add(key)
+            if self.C.folderWake is not None:
+                self.C.folderWake.set()
+        return tree
+
+    async def folderRunner(self):
+        """Background task listing the folder trees of accounts"""
+        C = self.C
+        # Account -> when listing its folders last failed
+        failed = {}
+        while True:
+            # Trees asked for while offline wait for us to be back
+            with anyio.move_on_after(JOURNAL_CHECK if C.folderPending else None):
+                await C.folderWake.wait()
+            C.folderWake = anyio.Event()
+            if C.settings.offline:
+                continue
+            while C.folderPending:
+                key = C.folderPending.pop()
+                tree = C.folderCache.get(key)
+                if tree is not None and tree.age() <= foldertree.MAX_AGE:
+                    # Done since asked for
+                    continue
+                if time.time() - failed.get(key, 0) < FOLDERS_RETRY:
+                    continue
+                c = C.pool.lease(key, purpose="folders")
+                try:
+                    if c is None:
+                        c = await anyio.to_thread.run_sync(self.connectQuietly, key)
+                        C.pool.add(c, "folders")
+                    tree = await anyio.to_thread.run_sync(foldertree.scan, c, key)
+                except Exception as ev:
+                    # Nobody is waiting on this; the folders command lists
+                    # them itself if it has to.
+                    failed[key] = time.time()
+                    if trace.general:
+                        trace.event("general", "listing folders failed", ev)
+                else:
+                    C.folderCache.put(tree)
+                finally:
+                    if c is not None:
+                        C.pool.release(c)
+
+    def compl_folder(self, document, complete_event):
+        """Complete '+' folder names from the cached folder tree"""
+        before = document.current_line_before_cursor
+        words = before.split()
+        if len(words) != 2 or before[-1:].isspace() or not words[1].startswith("+"):
+            return
+        word = words[1]
+        target = urlAccount(self.C.settings.folder.value or "")
+        if target is None:
+            return
+        key, base = target
+        tree = self.folderTree(key)
+        if tree is None:
+            return
+        for name in tree.complete(base + word[1:]):
+            text = "+" + name[len(base):]
+            if tree.selectable(name):
+                yield cmdprompt.prompt_toolkit.completion.Completion(text, start_position=-len(word))
+            if tree.hasChildren(name):
+                yield cmdprompt.prompt_toolkit.completion.Completion(text + tree.delimiter, start_position=-len(word))
+
+    @showExceptions
+    def do_connections(self, args):
+        """Show IMAP connections held open for reuse.
+
+        connections         list connections and what they are used for
+        connections close   logout connections that aren't in use
+        """
+        args = args.strip()
+        if args == "close":
+            self.C.pool.closeAll()
+            return
+        elif args:
+            print("Unknown argument. See 'help connections'")
+            return
+        if len(self.C.pool) == 0:
+            print("No connections")
+            return
+        for c, purpose in self.C.pool:
+            print(" {}{}://{}@{}:{}/{} ({})".format(
+                '>' if c is self.C.connection else ' ',
+                c.mailnexProto,
+                c.mailnexUser,
+                c.mailnexHost,
+                c.mailnexPort,
+                c.mailnexBox,
+                purpose if purpose else "idle",
+                ))
 
     def newExist(self, value):
         delta = value - self.C.lastMessage
         # Assume new messages must be unseen. Assume we'll get a fetch
         # notification if it subsequently becomes seen. TODO: Verify these
         # assumptions!
-        if self.C.settings.debug.general:
-            print("Notified of new message(s) (newExist = {}, so delta is {})".format(value, delta))
+        if trace.general:
+            trace.event("general", "Notified of new message(s) (newExist = {}, so delta is {})".format(value, delta))
         for i in range(self.C.lastMessage + 1, value + 1):
             p = '{}.FLAGS'.format(i)
             # Don't set \Seen flag
             self.C.cache[p]=[]
-            if self.C.settings.debug.general:
-                print(" Faking cache of {}".format(p))
+            if trace.general:
+                trace.event("general", " Faking cache of {}".format(p))
+        if self.C.flags.loaded:
+            self.C.flags.exists(value)
         self.status['unread'] += delta
         self.C.lastMessage = value
         if self.ttyBusy:
@@ -2659,6 +3312,12 @@ class Cmd(cmdprompt.CmdPrompt):
         # message in the cache; then we can simply remove that UID from the
         # cache and be done, maybe)
         self.C.lastMessage -= 1
+        if self.C.flags.loaded:
+            # We know every message's flags, so the count stays exact
+            old = self.C.flags.expunge(int(value))
+            if old is not None:
+                self.status['unread'] -= flagmap.IS_UNSEEN[old]
+            return
         # was the message unseen? If so, decrement self.status['unread']
         p = b'%s.FLAGS'%(value)
         if p in self.C.cache:
@@ -2669,13 +3328,11 @@ class Cmd(cmdprompt.CmdPrompt):
                 pass
         else:
             # We don't know if it was seen or not.
-            # TODO: Schedule an unseen count in a second or something to
-            # update the status
-            pass
+            self.unreadStale()
 
     def fetchMonitor(self, msg, data):
-        if self.C.settings.debug.general:
-            print("fetchMonitor: processing",msg,data)
+        if trace.general:
+            trace.event("general", "fetchMonitor: processing",msg,data)
         data = processImapData(data, self.C.settings)[0]
         l = lambda: print("fetch received:", msg, data)
 #        if self.cli.app._is_running and self.C.settings.debug.general:
@@ -2686,7 +3343,11 @@ class Cmd(cmdprompt.CmdPrompt):
         if b'FLAGS' in data:
             flags = getResultPart(b'FLAGS', data)
             p = b'%s.FLAGS'%(msg)
-            if p in self.C.cache:
+            if self.C.flags.loaded:
+                # We know every message's flags, so the count stays exact
+                oldflags, new = self.C.flags.set(int(msg), flags)
+                self.status['unread'] += flagmap.IS_UNSEEN[new] - flagmap.IS_UNSEEN[oldflags]
+            elif p in self.C.cache:
                 oldflags = self.C.cache[p]
                 if b'\\Seen' in oldflags and not b'\\Seen' in flags:
                     self.status['unread'] += 1
@@ -2701,15 +3362,7 @@ class Cmd(cmdprompt.CmdPrompt):
                 # unseen count might be inefficient on the server (and
                 # certainly is a waste of network)
                 oldflags = None
-                # TODO: schedule refresh for a second or so later, unless such
-                # a refresh is already pending (once per second shouldn't be
-                # bad if a lot of operations are continuously happening in the
-                # background. If we were instead to delayuntil a second after
-                # things stop can make us look very unresponsive.
-                #unseen = len(self.C.connection.search("utf-8", "UNSEEN"))
-                #self.status['unread'] = unseen
-
-                pass
+                self.unreadStale()
             self.C.cache[p] = flags
             l = lambda: print("New flags:", flags, "old flags:", oldflags)
 #            if self.cli.app._is_running and self.C.settings.debug.general:
@@ -2724,13 +3377,205 @@ class Cmd(cmdprompt.CmdPrompt):
         # This should be done once every 29 minutes or so (servers are allowed
         # to make their timeout as small as 30 minutes). When not idling, this
         # can be set much quicker to find new mail in a reasonable amount of
-        # time.
-        if self.C.connection:
+        # time. When idling, idleRunner restarts the IDLE instead.
+        if self.C.settings.offline or self.C.renumbered:
+            # Leave the server alone (see offlineChanged and expungeLocally)
+            if self.C.smtpSessions:
+                self.C.smtpSessions.expire()
+            return
+        if self.C.connection and not getattr(self.C.connection, 'idleWanted', False):
             try:
                 self.C.connection.doSimpleCommand(b"noop")
             except:
+                self.C.pool.forget(self.C.connection)
                 self.C.connection = None
                 raise
+        if self.C.pool:
+            self.C.pool.keepalive()
+        if self.C.smtpSessions:
+            self.C.smtpSessions.expire()
+    def offlineChanged(self, opt):
+        """Stop or restart listening to the server when 'offline' changes.
+
+        Going offline stops the poller and leaves IDLE, so that nothing the
+        server says gets applied to the folder behind our back (our message
+        numbers can stop matching the server's; see expungeLocally). Back
+        online, IDLE is restarted, unless the folder is to be reopened.
+        """
+        c = self.C.connection
+        if not hasattr(c, 'idleWanted'):
+            # Not an IMAP connection
+            return
+        if opt.value:
+            if c.poller:
+                c.poller.stop()
+                c.poller = None
+            try:
+                c.stopIdle()
+            except (imap4.imap4Exception, OSError) as ev:
+                # Probably no network; the next command online will find
+                # out
+                if trace.general:
+                    trace.event("general", "leaving idle failed", ev)
+                c.idling = False
+        elif b'IDLE' in c.caps and not self.C.renumbered and not c.poller:
+            c.poller = Poller(self.C.tg, c.socket, self.checkData)
+            c.poller.start()
+            # idleRunner enters IDLE
+            c.idleWanted = True
+
+    async def idleRunner(self):
+        """Background task returning the connection to IDLE after commands.
+
+        Commands leave IDLE; going back is left until they've stopped for a
+        moment, and done here (see imap4's idleTick). This also restarts
+        IDLE before servers time it out.
+        """
+        while True:
+            c = self.C.connection
+            if self.C.settings.offline or self.C.renumbered:
+                # Leave the server alone (see expungeLocally)
+                c = None
+            due = c.idleDue() if c is not None and hasattr(c, 'idleDue') else None
+            if due == 0:
+                try:
+                    c.idleTick()
+                except (imap4.imap4Exception, OSError) as ev:
+                    # Connection's gone. Let the next command find out and
+                    # complain, as it would have without us.
+                    if trace.general:
+                        trace.event("general", "idle failed", ev)
+                    c.idleWanted = False
+                continue
+            await anyio.sleep(IDLE_CHECK if due is None else min(due, IDLE_CHECK))
+
+    async def watchRunner(self):
+        """Background task keeping the counts of the watched folders.
+
+        Watches the folders named by the watchfolders setting, on the account
+        of the current folder, over a pooled connection. Uses NOTIFY if the
+        server has it, and polls otherwise (see watcher).
+        """
+        C = self.C
+        c = None
+        notify = False
+        nextPoll = 0
+        lastActive = 0
+        lastError = None
+        while True:
+            if C.settings.offline:
+                await anyio.sleep(WATCH_CHECK)
+                continue
+            boxes = C.settings.watchfolders.value.split()
+            if boxes and hasattr(C.connection, "mailnexProto"):
+                key = imappool.accountKey(C.connection)
+            else:
+                # Nothing to watch, or not on an IMAP account (e.g. a
+                # maildir)
+                key = None
+            if C.watcher is not None and (C.watcher.key, C.watcher.boxes) != (key, boxes):
+                # Watching something else now
+                if c is not None:
+                    if notify:
+                        await anyio.to_thread.run_sync(self.watchStop, c)
+                    # The pool is only touched from the event loop
+                    C.pool.release(c)
+                    c = None
+                C.watcher = None
+                self.showWatched()
+            if not boxes or key is None:
+                await anyio.sleep(WATCH_CHECK)
+                continue
+            if C.watcher is None:
+                C.watcher = watcher.FolderWatcher(key, boxes, max(1, C.settings.watchinterval.value))
+                nextPoll = 0
+            w = C.watcher
+            try:
+                if c is None:
+                    c = C.pool.lease(key, purpose="watch")
+                    if c is None:
+                        c = await anyio.to_thread.run_sync(self.connectQuietly, key)
+                        C.pool.add(c, "watch")
+                    notify = b'NOTIFY' in c.caps
+                    if notify:
+                        c.setCB("status", lambda data: w.update(*self.watchedStatus(data)))
+                        await anyio.to_thread.run_sync(c.notify, [box.encode("utf8") for box in boxes])
+                    lastActive = time.time()
+                    lastError = None
+                now = time.time()
+                if notify:
+                    if w.stale:
+                        results = await anyio.to_thread.run_sync(c.statusMany, sorted(w.stale), watcher.ITEMS)
+                        for box, values in results.items():
+                            w.update(box, values)
+                        # Don't ask again for boxes the server wouldn't
+                        # tell us about
+                        w.stale.clear()
+                        lastActive = time.time()
+                    elif now - lastActive > WATCH_KEEPALIVE:
+                        await anyio.to_thread.run_sync(c.doSimpleCommand, b"NOOP")
+                        lastActive = time.time()
+                    else:
+                        # Wait for the server to tell us something, coming
+                        # back now and then to see whether the settings
+                        # changed.
+                        with anyio.move_on_after(WATCH_CHECK):
+                            if not c.hasPendingData():
+                                await anyio.wait_socket_readable(c.socket)
+                            c.doIdleData()
+                            # Give a burst of changes a moment, so that
+                            # asking for the missing counts covers all of
+                            # them.
+                            await anyio.sleep(UNREAD_DELAY)
+                            if c.hasPendingData():
+                                c.doIdleData()
+                elif now >= nextPoll:
+                    results = await anyio.to_thread.run_sync(c.statusMany, boxes, watcher.ITEMS)
+                    w.polled(results)
+                    nextPoll = time.time() + w.delay
+                else:
+                    await anyio.sleep(min(WATCH_CHECK, nextPoll - now))
+            except Exception as ev:
+                if c is not None:
+                    C.pool.forget(c)
+                    c.close()
+                    c = None
+                error = "Couldn't watch folders {}: {}".format(" ".join(boxes), ev)
+                if error != lastError:
+                    # Only complain when something changes; retried with
+                    # the poll's back off.
+                    l = lambda: C.printWarning(error)
+                    if self.cli.app._is_running:
+                        self.cli.run_in_terminal(l)
+                    else:
+                        l()
+                lastError = error
+                w.delay = min(w.delay * 2, w.interval * watcher.MAX_BACKOFF)
+                await anyio.sleep(w.delay)
+                continue
+            self.showWatched()
+
+    def watchedStatus(self, data):
+        """Return (box, {item: value}) for an untagged STATUS response"""
+        box, values = imap4.parseStatus(data)
+        return box.decode("utf8", "replace"), values
+
+    def watchStop(self, c):
+        """Turn off NOTIFY on the connection watchRunner was using"""
+        try:
+            c.notifyNone()
+        except (imap4.imap4Exception, OSError):
+            # The pool will find out if it's dead
+            pass
+
+    def showWatched(self):
+        """Put the counts of the watched folders in the toolbar, if changed"""
+        folders = self.C.watcher.toolbar() if self.C.watcher else []
+        if folders != self.status['folders']:
+            self.status['folders'] = folders
+            if self.cli.app._is_running:
+                self.cli.app.invalidate()
+
     def checkData(self, poll_handle, events, errno):
         #print(poll_handle)
         #print(events)
@@ -3008,8 +3853,8 @@ class Cmd(cmdprompt.CmdPrompt):
                     c.parent = p
                     p.children.append(c)
                 else:
-                    if c.parent is not p and self.C.settings.debug.general:
-                        print("At message %i, Would have set %i as parent to %i, but already had parent %i" % (i, p.mseq, c.mseq, c.parent.mseq))
+                    if c.parent is not p and trace.general:
+                        trace.event("general", "At message %i, Would have set %i as parent to %i, but already had parent %i" % (i, p.mseq, c.mseq, c.parent.mseq))
             # TODO NEXT: change this so that we look for current message
             # in list. If it already exists, we need to update mseq/muid
             # (2 cases: this was a stub from a previously encountered
@@ -3027,8 +3872,8 @@ class Cmd(cmdprompt.CmdPrompt):
             p = c # The parent of this message is the last child dealt with above, if any.
             if mid in messages:
                 this = messages[mid]
-                if self.C.settings.debug.general:
-                    print("update mid",mid)
+                if trace.general:
+                    trace.event("general", "update mid",mid)
                 if this.mseq == -1:
                     # found a placeholder. Update its info
                     this.mseq = i
@@ -3037,8 +3882,8 @@ class Cmd(cmdprompt.CmdPrompt):
                         # had a parent. Replace it with this message's
                         # parent
                         if not this.parent.mid == p.mid:
-                            if self.C.settings.debug.general:
-                                print("Reparenting %i from %i to %i" % (this.mseq, this.parent.mseq, p.mseq))
+                            if trace.general:
+                                trace.event("general", "Reparenting %i from %i to %i" % (this.mseq, this.parent.mseq, p.mseq))
                             this.parent.children.remove(this)
                             this.parent = p
                             # TODO: Could we already be listed as a child?
@@ -3130,9 +3975,9 @@ class Cmd(cmdprompt.CmdPrompt):
             if not m.parent:
                 messageLeaders[m.mid] = m
         t3=time.time()
-        if self.C.settings.debug.general:
-            print("Done")
-            print("duration:", t3-t1)
+        if trace.general:
+            trace.event("general", "Done")
+            trace.event("general", "duration:", t3-t1)
             if t2:
                 # Note: most of the fetch duration is parsing the IMAP response
                 # data
@@ -3143,8 +3988,8 @@ class Cmd(cmdprompt.CmdPrompt):
                 #
                 # Of the fetch duration, less than 0.5 was getting the data over a
                 # slow-ish link where the server already had the data cached.
-                print("  fetch duration:", t2-t1)
-                print("  calc duration:", t3-t2)
+                trace.event("general", "  fetch duration:", t2-t1)
+                trace.event("general", "  calc duration:", t3-t2)
         if self.C.settings.debug.findrefs:
             # More detailed stats
             for m,d in messageLeaders.items():
@@ -3470,6 +4315,7 @@ class Cmd(cmdprompt.CmdPrompt):
             # the connection) if we fetched multiple messages at once.
             if i > C.lastMessage:
                 break
+            started = time.perf_counter()
             try:
                 #data = M.fetch(i, '(UID BODYSTRUCTURE)')
                 #print(typ)
@@ -3551,6 +4397,8 @@ class Cmd(cmdprompt.CmdPrompt):
                 idterm = u"Q" + str(uid)
                 doc.add_boolean_term(idterm)
                 db.replace_document(idterm, doc)
+                metrics.count("index_messages_total")
+                metrics.count("index_seconds_total", time.perf_counter() - started)
                 i += 1
                 lastuid = uid
             except KeyboardInterrupt:
@@ -3575,7 +4423,38 @@ class Cmd(cmdprompt.CmdPrompt):
             f.write(b"%i %i" % (self.C.connection.uidvalidity, uid))
         print("Done!")
 
-    def getTextPlainParts(self, index, allParts=False):
+    async def cryptoCall(self, key, func, *args):
+        """Run a blocking gpg operation in a worker thread, or reuse its earlier result.
+
+        key identifies the data being worked on (see getTextPlainParts). func
+        is one of the gpg helpers, e.g. verifyGpg; it gets args and the key
+        index. The prompt stays live while gpg runs, and interrupting the
+        command abandons the operation.
+        """
+        cache = self.C.cryptoCache
+        stamp = self.C.keyIndex.currentStamp()
+        if stamp != self.C.cryptoStamp:
+            # Keys were imported, trust changed, etc. Earlier results might
+            # not hold any more.
+            cache.clear()
+            self.C.cryptoStamp = stamp
+        if key in cache:
+            metrics.count("cache_lookups_total", cache="crypto", result="hit")
+            cache.move_to_end(key)
+            return cache[key]
+        metrics.count("cache_lookups_total", cache="crypto", result="miss")
+        done, ret = await runInterruptible(func, *args, self.C.keyIndex)
+        if not done:
+            print("Interrupted; skipping gpg")
+            return None
+        result, cacheable = ret
+        if cacheable:
+            cache[key] = result
+            while len(cache) > CRYPTO_CACHE_SIZE:
+                cache.popitem(last=False)
+        return result
+
+    async def getTextPlainParts(self, index, allParts=False):
         """Get the plain text parts of a message and all headers.
 
         Returns a list of tuples. Each list entry represents one part.
@@ -3586,8 +4465,11 @@ class Cmd(cmdprompt.CmdPrompt):
         return everything instead of just text parts.
         """
         resparts = []
-        parts = self.cacheFetch(index, b'(BODY.PEEK[HEADER] BODYSTRUCTURE)')[0]
+        parts = self.cacheFetch(index, b'(UID BODY.PEEK[HEADER] BODYSTRUCTURE)')[0]
         headers = getResultPart(b'BODY[HEADER]', parts[1])
+        # Identifies the message for the crypto cache; sequence numbers
+        # shift around, UIDs don't
+        uid = (self.C.connection.mailnexBox, getResultPart(b'UID', parts[1]))
         # TODO: Headers are required to be ASCII or encoded using a header
         # encoding that results in ASCII (lists charset and encodes as
         # quoted-printable or base64 with framing). We should decode headers
@@ -3654,7 +4536,7 @@ class Cmd(cmdprompt.CmdPrompt):
             # the end of the message itself? (that is, the normally first
             # element of the structure)
             structureStrings.append("SECINFO: {}".format(repr(secinfo)))
-        def pickparts(struct, allParts=False):
+        async def pickparts(struct, allParts=False):
             """Pick the parts we are going to use to produce a regular view of the message.
 
             We'll build a visualization of the structure while we are at it (much of
@@ -3667,57 +4549,31 @@ class Cmd(cmdprompt.CmdPrompt):
             sigres = None
             secondaryStruct = None
             # TODO: What are protected-headers="v1"?
-            if struct.type_ == "multipart" and struct.subtype == 'encrypted':
-                if '{}.d.SUBSTRUCTURE'.format(struct.tag) in self.C.cache:
+            if struct.type_ == "multipart" and struct.subtype == b'encrypted':
+                if b'%s.d.SUBSTRUCTURE' % (struct.tag) in self.C.cache:
                     # Already decoded this message
                     secondaryStruct = self.C.cache[b'%s.d.SUBSTRUCTURE'%(struct.tag)]
+                    sigres = self.C.cache.get(b'%s.d.SIGRES'%(struct.tag))
                 else:
                     p = struct.parameters
-                    if p and 'protocol' in p and p['protocol'].lower() == 'application/pgp-encrypted':
+                    if p and b'protocol' in p and p[b'protocol'].lower() == b'application/pgp-encrypted':
                         # TODO: What if the message doesn't have the protocol
                         # parameter but otherwise follows the protocol?
-                        if haveGpg:
-                            inner = struct.tag.split('.')[1:]
-                            encpart = ".".join(inner + ['2'])
+                        if haveGpg or haveGpgme:
+                            inner = struct.tag.split(b'.')[1:]
+                            encpart = b".".join(inner + [b'2'])
                             data = self.cacheFetch(index, b'(BODY.PEEK[%s])' % (encpart))[0]
                             message = getResultPart(b"BODY[%s]"%(encpart), data[1])
-                            ctx = gpg.Context()
-                            skipEncrypted = False
-                            try:
-                                result, decrypt_info, verify_info = ctx.decrypt(message, verify=True)
-                            except gpg.errors.GPGMEError:
-                                skipEncrypted = True
-                            except gpg.errors.BadSignatures as ev:
-                                # We handle displaying bad signatures
-                                # ourselves. Extract the values we wanted
-                                # anyways.
-                                result, decrypt_info, verify_info = ev.results
-                            if not skipEncrypted:
-                                for sig in verify_info.signatures:
-                                    # TODO: Handle displaying multiple signatures
-                                    sigres = sigresToStringGpg(ctx, sig)
-                                m = email.message_from_string(result)
+                            res = await self.cryptoCall(
+                                    (uid, encpart, hashlib.sha256(message).digest()),
+                                    decryptGpg if haveGpg else decryptGpgme,
+                                    message)
+                            if res is not None:
+                                result, sigres = res
+                                m = email.message_from_bytes(result)
                                 secondaryStruct = unpackStructM(m, {"cache": self.C.cache}, 1, struct.tag + b".d")
                                 self.C.cache[b"%s.d.SUBSTRUCTURE"%(struct.tag)] = secondaryStruct
-                        elif haveGpgme:
-                            inner = struct.tag.split('.')[1:]
-                            encpart = ".".join(inner + ['2'])
-                            data = self.cacheFetch(index, b'(BODY.PEEK[%s])' % (encpart))[0]
-                            message = getResultPart(b"BODY[%s]"%(encpart), data[1])
-                            ctx = gpgme.Context()
-                            msgdat = io.BytesIO(message)
-                            result = io.BytesIO()
-                            try:
-                                ret = ctx.decrypt_verify(msgdat, result)
-                            except gpgme.GpgmeError:
-                                pass
-                            else:
-                                for sig in ret:
-                                    # TODO: Handle displaying multiple signatures
-                                    sigres = sigresToString(ctx, sig)
-                                m = email.message_from_string(result.getvalue())
-                                secondaryStruct = unpackStructM(m, {"cache": self.C.cache}, 1, struct.tag + b".d")
-                                self.C.cache["{}.d.SUBSTRUCTURE".format(struct.tag)] = secondaryStruct
+                                self.C.cache[b"%s.d.SIGRES"%(struct.tag)] = sigres
 
             if struct.type_ == "multipart" and struct.subtype == b"signed":
                 p = struct.parameters
@@ -3732,39 +4588,19 @@ class Cmd(cmdprompt.CmdPrompt):
                     # the protocol, it could be some other spec than we know
                     # how to handle, and we probably shouldn't give the user
                     # misleading information.
-                    if haveGpg:
+                    if haveGpg or haveGpgme:
                         inner = struct.tag.split(b'.')[1:]
                         messageTag = b".".join(inner + [b'1'])
                         signatureTag = b".".join(inner + [b'2'])
                         data = self.cacheFetch(index, b'(BODY.PEEK[%s.MIME] BODY.PEEK[%s] BODY.PEEK[%s])'%(messageTag, messageTag, signatureTag))[0]
                         messageData = getResultPart(b'BODY[%s.MIME]'%(messageTag), data[1]) + getResultPart(b'BODY[%s]'%(messageTag), data[1])
                         sigData = getResultPart(b'BODY[%s]'%(signatureTag), data[1])
-
-                        ctx = gpg.Context()
-                        try:
-                            _, ret = ctx.verify(messageData, signature=sigData)
-                            ret = ret.signatures
-                        except gpg.errors.BadSignatures as ev:
-                            ret=ev.result # or '_, ret = ev.results'
-                            ret=ret.signatures
-                        for sig in ret:
-                            # TODO: Handle displaying multiple signatures
-                            sigres = sigresToStringGpg(ctx, sig)
-                    elif haveGpgme:
-                        inner = struct.tag.split(b'.')[1:]
-                        messageTag = ".".join(inner + ['1'])
-                        signatureTag = ".".join(inner + ['2'])
-                        data = self.cacheFetch(index, b'(BODY.PEEK[%s.MIME] BODY.PEEK[%s] BODY.PEEK[%s])'%(messageTag, messageTag, signatureTag))[0]
-                        messageData = getResultPart(b'BODY[%s.MIME]'%(messageTag), data[1]) + getResultPart(b'BODY[%s]'%(messageTag), data[1])
-                        sigData = getResultPart(b'BODY[%s]'%(signatureTag), data[1])
-
-                        ctx = gpgme.Context()
-                        msgdat = io.BytesIO(messageData)
-                        sigdat = io.BytesIO(sigData)
-                        ret = ctx.verify(sigdat, msgdat, None)
-                        for sig in ret:
-                            # TODO: Handle displaying multiple signatures
-                            sigres = sigresToString(ctx, sig)
+                        digest = hashlib.sha256(messageData)
+                        digest.update(sigData)
+                        sigres = await self.cryptoCall(
+                                (uid, b".".join(inner), digest.digest()),
+                                verifyGpg if haveGpg else verifyGpgme,
+                                messageData, sigData)
             if hasattr(struct, "disposition") and struct.disposition not in [None, "NIL"]:
                 extra += " (%s)" % struct.disposition[0]
 # mailx shows attachments inline if they are text or message type. We
@@ -3825,10 +4661,10 @@ class Cmd(cmdprompt.CmdPrompt):
             if hasattr(struct, "subs"):
                 # This is a multipart, walk through the sub parts recursively
                 for i in struct.subs:
-                    pickparts(i, allParts)
+                    await pickparts(i, allParts)
             if secondaryStruct:
-                pickparts(secondaryStruct, allParts)
-        pickparts(struct, allParts)
+                await pickparts(secondaryStruct, allParts)
+        await pickparts(struct, allParts)
         structureString = u"\n".join(structureStrings)
         resparts.append((None, None, structureString + '\r\n\r\n'))
         if len(fetchParts) == 0:
@@ -3869,8 +4705,8 @@ class Cmd(cmdprompt.CmdPrompt):
                     # CP1252 and then claiming it is iso-8859-1.
                     for c in map(chr, range(0x80,0xa0)):
                         if c in d:
-                            if self.C.settings.debug.general:
-                                print("Found control characters!")
+                            if trace.general:
+                                trace.event("general", "Found control characters!")
                             raise UnicodeDecodeError(str(charset), b"", 0, 1, b"control character detected")
                 except UnicodeDecodeError as err:
                     if charset == 'iso-8859-1':
@@ -3880,13 +4716,13 @@ class Cmd(cmdprompt.CmdPrompt):
                         # except encourage the sender to stop using outlook.
                         try:
                             d = dstr.decode('windows-1252')
-                            if self.C.settings.debug.general:
-                                print("decoded as cp-1252 instead of iso-8859-1")
+                            if trace.general:
+                                trace.event("general", "decoded as cp-1252 instead of iso-8859-1")
                             realcharset = 'windows-1252'
                         except:
                             d = "Part %s: failed to decode as %s or windows-1252\r\n" % (o[0], charset)
                     else:
-                        if self.C.settings.debug.general:
+                        if trace.general:
                             d = "Part %s: failed to decode as %s (%s)\r\n%s" % (o[0], charset, err, repr(dstr))
                         else:
                             d = "Part %s: failed to decode as %s" % (o[0], charset)
@@ -3896,8 +4732,8 @@ class Cmd(cmdprompt.CmdPrompt):
                     # TODO: Attempt to recover? Maybe the contents are just
                     # ASCII anyway?
                 else:
-                    if self.C.settings.debug.general:
-                        print("Successfully decoded as", charset)
+                    if trace.general:
+                        trace.event("general", "Successfully decoded as", charset)
                     realcharset = charset
             else:
                 # No charset was given. Try ascii, then utf-8, then cp-1252
@@ -3927,22 +4763,13 @@ class Cmd(cmdprompt.CmdPrompt):
     def lex_help(self, pos, text, rest, res):
         # TODO: we aren't highlighting if there is more than one space before
         # the help topic
-        if "do_{}".format(rest) in dir(self):
-            res.append((pos, cmdprompt.Generic.Heading, rest))
-        elif "help_{}".format(rest) in dir(self):
+        if rest in self.helpTopicSet:
             res.append((pos, cmdprompt.Generic.Heading, rest))
         else:
             res.append((pos, cmdprompt.Text, rest))
     def compl_help(self, document, complete_event):
-        topics = []
         this_word = document.get_word_before_cursor()
-        for i in dir(self):
-            cmdstr = "do_{}".format(this_word)
-            helpstr = "help_{}".format(this_word)
-            if i.startswith(cmdstr):
-                topics.append(i[3:])
-            elif i.startswith(helpstr):
-                topics.append(i[5:])
+        topics = [i for i in self.helpTopics if i.startswith(this_word)]
         # TODO: Should we really do icase sort? We aren't matching
         # insensitively. This feels inconsistent.
         topics.sort(key=lambda x:x.lower())
@@ -4140,7 +4967,7 @@ class Cmd(cmdprompt.CmdPrompt):
                     body += "\033[7mPart %s:\033[0m\n" % (part[0] or '1')
             if self.C.settings.allpartlabels:
                 body += "\033[7mPart %s:\033[0m\n" % (part[0] or '1')
-            if self.C.settings.debug.general:
+            if trace.general:
                 if hasattr(part[1], 'encoding') and part[1].encoding:
                     body += "encoding: " + part[1].encoding.decode() + "\r\n"
                 if part[1]:
@@ -4358,16 +5185,16 @@ class Cmd(cmdprompt.CmdPrompt):
                 #    val.lines if hasattr(val, "lines") else None
                 #    ))
                 #print()
-                if val.disposition and val.disposition[0].lower() == "attachment":
+                if val.disposition and val.disposition[0].lower() == b"attachment":
                     fname=None
                     #print("disp: {}".format(repr(val.disposition[1])))
                     try:
-                        fname = getResultPart(b'filename', val.disposition[1])
+                        fname = getResultPart(b'filename', val.disposition[1]).decode('utf-8', 'replace')
                     except mailnexPartNotFound:
                         pass
-                    if val.tag == "":
-                        val.tag = ".TEXT"
-                    partsavelist.append(("{}{}".format(msg,val.tag),val,fname))
+                    if val.tag == b"":
+                        val.tag = b".TEXT"
+                    partsavelist.append(("{}{}".format(msg,val.tag.decode('ascii')),val,fname))
                 # TODO: Recursively search down the message structure
             if len(partsavelist):
                 savelist.extend(partsavelist)
@@ -4386,9 +5213,9 @@ class Cmd(cmdprompt.CmdPrompt):
             # TODO: Any other characters we should convert? Maybe let the user add some mappings (e.g. some people might not like explamation points or line feeds in their file names, even though Unix typically doesn't care)
             name = name.replace("/","_")
 
-            msgid = msgid.split('.')
+            msgid = msgid.split('.', 1)
             #print("fetching {}, {}".format(repr(msgid), repr(part)))
-            data = self.fetchAndDecode(msgid, part)
+            data = self.fetchAndDecode([msgid[0], msgid[1].encode('ascii')], part)
             if data is None:
                 self.C.printWarning("Failed to decode '{}'; skipping".format(name))
                 continue
@@ -4405,7 +5232,7 @@ class Cmd(cmdprompt.CmdPrompt):
                     self.C.printWarning("Failed to create unique name for '{}'; skipping".format(outname))
                     continue
 
-            with open(outname, 'w') as outfile:
+            with open(outname, 'wb') as outfile:
                 self.C.printInfo("Writing '{}'".format(outname))
                 outfile.write(data)
                 outfile.flush()
@@ -4669,7 +5496,7 @@ class Cmd(cmdprompt.CmdPrompt):
         vindex = index
         if self.C.virtfolder:
             index = self.C.virtfolder[index - 1]
-        parts = self.getTextPlainParts(index)
+        parts = await self.getTextPlainParts(index)
         # TODO: This code copied from do_print.
         # Should be made common. See also TODOs from there.
         body = await self.partsToString(parts)
@@ -4677,7 +5504,7 @@ class Cmd(cmdprompt.CmdPrompt):
         content += body.encode('utf-8')
         res = await self.runAProgramWithInput(["less","-R"], content)
         if res == 0:
-            self.C.connection.doSimpleCommand(b"STORE %d +FLAGS (\\Seen)" % index)
+            self.storeFlags([index], b"+", b"\\Seen")
         return vindex
 
     @shortcut("p")
@@ -4772,7 +5599,7 @@ class Cmd(cmdprompt.CmdPrompt):
                 print("Message {} out of range".format(index))
                 return
             index = self.C.virtfolder[index - 1]
-        parts = self.getTextPlainParts(index)
+        parts = await self.getTextPlainParts(index)
         if len(parts) < 2:
             print("Message has no displayable parts")
             return
@@ -4801,7 +5628,7 @@ class Cmd(cmdprompt.CmdPrompt):
             #
             # However, some people probably like the mailx behavior better
             # because they are used to it, so we ought to support it.
-            M.doSimpleCommand(b"STORE %d +FLAGS (\\Seen)" % index)
+            self.storeFlags([index], b"+", b"\\Seen")
         # TODO: Raise exception if not successful?
         # Pros: Explicitly lets the user know something went wrong (no output
         # is probably a bad thing
@@ -4843,7 +5670,7 @@ class Cmd(cmdprompt.CmdPrompt):
                 print("Message {} out of range".format(index))
                 return
             index = self.C.virtfolder[index - 1]
-        parts = self.getTextPlainParts(index, allParts=True)
+        parts = await self.getTextPlainParts(index, allParts=True)
         if len(parts) < 2:
             print("Message has no displayable parts")
             return
@@ -4856,7 +5683,7 @@ class Cmd(cmdprompt.CmdPrompt):
         res = await self.runAProgramWithInput(["less","-R"], content)
         if res == 0:
             # TODO: Allow asynchronous mode. See do_print for details.
-            M.doSimpleCommand(b"STORE %d +FLAGS (\\Seen)" % index)
+            self.storeFlags([index], b"+", b"\\Seen")
 
     @showExceptions
     @optionalNeeds(haveXapian, "Needs python-xapian package installed")
@@ -4997,7 +5824,7 @@ class Cmd(cmdprompt.CmdPrompt):
                 print("Message {} out of range".format(index))
                 return
             index = self.C.virtfolder[index - 1]
-        parts = self.getTextPlainParts(index)
+        parts = await self.getTextPlainParts(index)
         hdrs = processHeaders(parts[0][2].encode('ascii'))
         # The spec doesn't say specifically how to handle replies, leaving it
         # up to individual implementations.
@@ -5171,7 +5998,7 @@ class Cmd(cmdprompt.CmdPrompt):
         print("Message to %s, replying to %s, subject %s" % (", ".join(to), from_, subject))
         sent = await self.editMessage(newmsg)
         if sent:
-            M.doSimpleCommand(b"STORE %d +FLAGS (\\Answered)" % index)
+            self.storeFlags([index], b"+", b"\\Answered")
 
     async def editMessage(self, message):
         """Run message composer until it is sent or the user aborts.
@@ -5183,6 +6010,7 @@ class Cmd(cmdprompt.CmdPrompt):
         editor = composer.editorCmds(self.C, message, self.singleprompt, self.cli, self.getAddressCompleter, self.runAProgramStraight, composer.editorCompleter())
         while True:
             if await editor.run() == False:
+                composer.cleanupAttachments(editor)
                 return False
             self.C.printInfo("Sending message...")
 
@@ -5207,8 +6035,263 @@ class Cmd(cmdprompt.CmdPrompt):
                         print(ev)
             else:
                 break
+        composer.cleanupAttachments(editor)
         return res
 
+    def smtpTarget(self, constr):
+        """Parse an smtp sending URL.
+
+        Returns a tuple of (scheme, user, host, port, security), where
+        security is one of the smtp.SEC_* values.
+        """
+        # TODO: handle SMTP URIs more formally. See at least RFC3986
+        # (URI), RFC5092 (IMAP-URI) and draft-melnikov-smime-msa-to-mda-04
+        # or draft-earhart-url-smtp for details of proposed URL schemes
+        # and their basis
+        url = urlparse.urlparse(constr)
+        if url.path:
+            raise Exception("path part '{}' doesn't make sense in sending url '{}'".format(url.path, constr))
+        scheme = url.scheme
+        user = url.username
+        host = url.hostname
+        port = url.port
+        ssl = False
+        if scheme == "smtps":
+            defport = 465
+            ssl = smtp.SEC_SSL
+        elif scheme == "smtp+plain":
+            defport = 25
+            ssl = smtp.SEC_NONE
+        elif scheme == "submission":
+            defport = 587
+            ssl = smtp.SEC_STARTTLS
+        elif scheme == "smtp":
+            defport = 25
+            ssl = smtp.SEC_STARTTLS
+        elif scheme == "submission+plain":
+            defport = 587
+            ssl = smtp.SEC_NONE
+        else:
+            self.C.printError("'smtp' option is set, but we don't understand the '{}' URI scheme".format(scheme))
+            self.C.printInfo("See the help for option 'smtp' (command: set smtp??), or unset it to try local delivery")
+            raise MailnexException("Uknown protocol: {}".format(scheme))
+        if not port:
+            port = defport
+        if user:
+            if ':' in user:
+                self.C.printError("Passwords in smtp URL aren't supported")
+                self.C.printInfo("Instead of specifying a password in the URL of the 'smtp' setting, use one of the password handlers, such as agent-shell options, or a keyring")
+                raise MailnexException("Don't put passwords into the URL")
+            if ';' in user:
+                self.C.printError("modifiers found in 'smtp' setting URI; these aren't suppoted yet")
+                raise MailnexException("We don't yet support modifiers")
+        return scheme, user, host, port, ssl
+
+    def smtpConnect(self, target, verbose=True):
+        """Connect to the server of an smtpTarget() tuple. Doesn't login."""
+        scheme, user, host, port, ssl = target
+        s = smtp.smtpClient()
+        s.verbose = verbose
+        if "cacertsfile_{}".format(host) in self.C.settings:
+            s.cacerts = (getattr(self.C.settings, "cacertsfile_{}".format(host)).value)
+        else:
+            s.cacerts = self.C.settings.cacertsfile.value
+        # TODO: Allow overriding CA somehow
+        # TODO: Allow user certificates
+        # TODO: DANE?
+        #   import dns # (package python3-dnspython)
+        #   myresolver = dns.resolver.Resolver() # Get a system default resolver
+        #   myresolver.ednsflags |= dns.flags.DO # enable DNSSEC
+        #   timeout = 15 # default in lib is 5, but it can take a bit longer doing DNSSEC
+        #   res = myresolver.resolve("_%d._tcp.%s" % (port, host), "TLSA", lifetime=timeout)
+        #   if (res.response.ednsflags & dns.flags.DO) and (res.response.flags & dns.flags.AD):
+        #       data = str(res.response.rrset[0]) # Should verify response is what we asked? (CNAME/DNAME may complicate). Should iterate over all results (might have multiple acceptible cert infos)
+        s.connect(host, port, ssl)
+        return s
+
+    def outboxCredentials(self, constr, target):
+        """Make sure background sending through the given smtp URL has a password.
+
+        Prompts for it if needed. The password is only kept in memory.
+        """
+        scheme, user, host, port, ssl = target
+        if not user or constr in self.C.outbox.credentials:
+            return
+        if ssl == smtp.SEC_NONE:
+            print(self.C.t.red("Warning: Insecure link. Don't send your password lightly!"))
+            password = getpass.getpass()
+        else:
+            # TODO: Offer to save the password in the keyring once the
+            # background sender has logged in with it.
+            _, _, password = getPassword(self.C.settings, scheme, user, host, port)
+        self.C.outbox.credentials[constr] = password
+
+    def outboxConnect(self, constr):
+        """Connect and login for background sending.
+
+        Runs in a worker thread, so this never prompts. If a password is
+        needed and we don't have one, the message is held until the user
+        retries it with the outbox command.
+        """
+        target = self.smtpTarget(constr)
+        scheme, user, host, port, ssl = target
+        if user:
+            password = self.C.outbox.credentials.get(constr)
+            if password is None and ssl != smtp.SEC_NONE:
+                _, _, password = getPassword(self.C.settings, scheme, user, host, port, interactive=False)
+            if password is None:
+                raise outbox.HoldDelivery("password needed; use 'outbox retry' to enter it")
+        s = self.smtpConnect(target, verbose=False)
+        if user and s.login(user, password) == False:
+            s.close()
+            self.C.outbox.credentials.pop(constr, None)
+            raise outbox.HoldDelivery("smtp login failed; use 'outbox retry' to try again")
+        return s
+
+    async def outboxRunner(self):
+        """Background task sending whatever is in the outbox"""
+        C = self.C
+        while True:
+            delay = C.outbox.nextDue()
+            if delay != 0:
+                # Sleep until something is due, or until we are woken up by a
+                # newly queued message or the outbox command.
+                with anyio.move_on_after(delay):
+                    await C.outboxWake.wait()
+                C.outboxWake = anyio.Event()
+                continue
+            try:
+                results = await anyio.to_thread.run_sync(C.outbox.deliver, self.outboxConnect)
+            except Exception as ev:
+                # Most likely trouble with the spool directory itself. Don't
+                # take the rest of the program down over it.
+                l = lambda: C.printError("Outbox: {}".format(ev))
+                results = []
+                if self.cli.app._is_running:
+                    self.cli.run_in_terminal(l)
+                else:
+                    l()
+                await anyio.sleep(outbox.RETRY_BASE)
+            for entry, error in results:
+                if error is None and entry.get('sentCopy'):
+                    key, box = entry['record']
+                    C.tg.start_soon(self.recordMessage, entry['sentCopy'], (tuple(key), box))
+            if results:
+                l = lambda: self.outboxReport(results)
+                if self.cli.app._is_running:
+                    self.cli.run_in_terminal(l)
+                else:
+                    l()
+            # Entries another instance is busy sending still look due; don't
+            # spin on them.
+            await anyio.sleep(1)
+
+    def outboxReport(self, results):
+        for entry, error in results:
+            what = "'{}' to {}".format(entry['subject'] or "(no subject)", ", ".join(entry['to']))
+            if error is None:
+                print("Info: Sent {}".format(what))
+            elif isinstance(error, outbox.HoldDelivery):
+                self.C.printError("Not sending {}: {}".format(what, error))
+            else:
+                self.C.printWarning("Sending {} failed, will retry: {}".format(what, error))
+
+    def recordTarget(self):
+        """Work out where the 'record' setting says to save sent messages.
+
+        Returns a tuple of (account, box), where account is as used by the
+        connection pool, or None if the setting isn't set.
+        """
+        rec = self.C.settings.record.value
+        if not rec:
+            return None
+        if rec.startswith("+"):
+            if not self.C.settings.folder.value:
+                self.C.printError("'record' starts with '+', but 'folder' isn't set")
+                raise MailnexException("can't resolve record folder")
+            rec = self.C.settings.folder.value + rec[1:]
+        target = urlAccount(rec)
+        if target is None:
+            self.C.printError("Don't know how to save to '{}' for the 'record' setting".format(rec))
+            raise MailnexException("Unknown protocol: {}".format(urlparse.urlparse(rec).scheme))
+        return target
+
+    def connectQuietly(self, key):
+        """Open and login an IMAP connection without involving the user.
+
+        For background work, so it may run in a worker thread. Only works if
+        the password can be had without asking. Raises on failure.
+        """
+        proto, user, host, port = key
+        if proto == "imap+plain":
+            raise Exception("won't login in the clear without asking")
+        c = imap4.imap4ClientConnection()
+        c.poller = None
+        # Don't charge the login to whatever command is running
+        c.background = True
+        if "cacertsfile_{}".format(host) in self.C.settings:
+            c.setCaCerts(getattr(self.C.settings, "cacertsfile_{}".format(host)).value)
+        else:
+            c.setCaCerts(self.C.settings.cacertsfile.value)
+        c.mailnexProto = proto
+        c.mailnexUser = user
+        c.mailnexHost = host
+        c.mailnexPort = port
+        c.mailnexBox = None
+        c.connect(host, port=port)
+        if not c.isTls():
+            c.starttls()
+            if not c.isTls():
+                c.close()
+                raise Exception("Failed to secure connection")
+        if not c.caps:
+            c.getCapabilities()
+        if not user:
+            user = getpass.getuser()
+        _, _, pass_ = getPassword(self.C.settings, proto, user, host, port, interactive=False)
+        if pass_ is None:
+            c.close()
+            raise Exception("no password for {}@{} available without asking".format(user, host))
+        c.login(user, pass_)
+        del pass_
+        if c.state != imap4.STATE_AUTH:
+            c.close()
+            raise Exception("login failed")
+        if not c.caps:
+            c.getCapabilities()
+        if self.C.settings.compress and b'COMPRESS=DEFLATE' in c.caps:
+            try:
+                c.compress()
+            except imap4.imap4Exception:
+                pass
+        return c
+
+    async def recordMessage(self, path, target):
+        """Save a sent message to the record folder, in the background.
+
+        path is a file holding the message; it's removed once saved. Uses a
+        pooled connection to the folder's account if there is one.
+        """
+        C = self.C
+        key, box = target
+        c = C.pool.lease(key, purpose="record")
+        try:
+            if c is None:
+                c = await anyio.to_thread.run_sync(self.connectQuietly, key)
+                C.pool.add(c, "record")
+            await anyio.to_thread.run_sync(appendFile, c, box, path)
+        except Exception as ev:
+            l = lambda: C.printWarning("Couldn't save a copy of the sent message to '{}': {}\nThe copy is in {}".format(box, ev, path))
+            if self.cli.app._is_running:
+                self.cli.run_in_terminal(l)
+            else:
+                l()
+        else:
+            os.unlink(path)
+        finally:
+            if c is not None:
+                C.pool.release(c)
+
     async def sendMessage(self, editor, message):
 
         message.set_payload(quopri.encodestring(message.get_payload().encode('utf-8')))
@@ -5250,7 +6333,10 @@ class Cmd(cmdprompt.CmdPrompt):
         def addrs(data):
             return [a[1] for a in email.utils.getaddresses(data)]
 
-        m = composer.doAttachments(editor, m)
+        # Signing and encryption need the whole message in memory anyway, so
+        # only stream attachments when not doing those.
+        stream = not (editor.pgpsign or editor.pgpencrypt)
+        m = composer.doAttachments(editor, m, stream)
         if m is False:
             return False
 
@@ -5265,6 +6351,8 @@ class Cmd(cmdprompt.CmdPrompt):
         if len(recipients) == 0:
             self.C.printError("There are no recipients for this message")
             raise MailnexException("empty recipients list")
+        if self.C.settings.addressbook:
+            self.C.addressBook.addSent(email.utils.getaddresses(m.get_all('To', []) + m.get_all('cc', []) + m.get_all('bcc', [])))
 
         # TODO: Allow user to select behavior:
         # 1) message content excludes Bcc list
@@ -5308,18 +6396,13 @@ class Cmd(cmdprompt.CmdPrompt):
                 ctx = gpg.Context()
             else:
                 ctx = gpgme.Context()
-            keys = []
             # TODO: What about sender vs from, etc.
             if self.C.settings.pgpkey:
                 keysearch = self.C.settings.pgpkey.value
             else:
-                # TODO: Search keys using just the email address without the
-                # full name part after doing the full search
+                # The key index matches on the address part of this
                 keysearch = m['from']
-            for k in ctx.keylist(keysearch, True):
-                keys.append(k)
-            # TODO: Filter on keys that can sign. Possibly filter out
-            # expired/revoked keys.
+            keys = self.C.keyIndex.signingKeys(ctx, keysearch)
             if len(keys) == 0:
                 self.C.printError("No keys found for '%s'." % keysearch)
                 self.C.printInfo("Try changing your 'from', set the 'pgpkey' setting, disable pgpsigning, or add a key to gpg for '%s'." % keysearch)
@@ -5371,7 +6454,7 @@ class Cmd(cmdprompt.CmdPrompt):
             if editor.pgpencrypt:
                 rkeys = []
                 for r in recipients:
-                    kl = list(ctx.keylist(r))
+                    kl = self.C.keyIndex.encryptionKeys(ctx, r)
                     if len(kl) == 0:
                         self.C.printError("No key found for recipient {}!".format(r))
                         self.C.printInfo("Try adding a key for {} to gpg, or disable pgpencrypt for this message".format(r))
@@ -5489,109 +6572,97 @@ class Cmd(cmdprompt.CmdPrompt):
         #print(fp.getvalue())
         #return False
 
+        # Where to save a copy once sent, if anywhere
+        record = self.recordTarget()
+
         if('smtp' in self.C.settings and self.C.settings.smtp):
-            from . import smtp
             # Use SMTP
             # Note: port 25 is plain SMTP, 465 is TLS wrapped plain SMTP, and
             # 587 is SUBMIT (SUBMISSION). Both 25 and 587 are plain text until
             # STARTTLS is used. If no protocol is given, we should probably
             # use SUBMISSION by default.
             constr = self.C.settings.smtp.value
-            # TODO: handle SMTP URIs more formally. See at least RFC3986
-            # (URI), RFC5092 (IMAP-URI) and draft-melnikov-smime-msa-to-mda-04
-            # or draft-earhart-url-smtp for details of proposed URL schemes
-            # and their basis
-            url = urlparse.urlparse(constr)
-            if url.path:
-                raise Exception("path part '{}' doesn't make sense in sending url '{}'".format(url.path, constr))
-            scheme = url.scheme
-            user = url.username
-            host = url.hostname
-            port = url.port
-            ssl = False
-            if scheme == "smtps":
-                defport = 465
-                ssl = smtp.SEC_SSL
-            elif scheme == "smtp+plain":
-                defport = 25
-                ssl = smtp.SEC_NONE
-            elif scheme == "submission":
-                defport = 587
-                ssl = smtp.SEC_STARTTLS
-            elif scheme == "smtp":
-                defport = 25
-                ssl = smtp.SEC_STARTTLS
-            elif scheme == "submission+plain":
-                defport = 587
-                ssl = smtp.SEC_NONE
-            else:
-                self.C.printError("'smtp' option is set, but we don't understand the '{}' URI scheme".format(scheme))
-                self.C.printInfo("See the help for option 'smtp' (command: set smtp??), or unset it to try local delivery")
-                raise MailnexException("Uknown protocol: {}".format(scheme))
-            if not port:
-                port = defport
-            print("user: {}\nhost: {}\nport: {}".format(user,host,port))
-            if user:
-                if ':' in user:
-                    self.C.printError("Passwords in smtp URL aren't supported")
-                    self.C.printInfo("Instead of specifying a password in the URL of the 'smtp' setting, use one of the password handlers, such as agent-shell options, or a keyring")
-                    raise MailnexException("Don't put passwords into the URL")
-                if ';' in user:
-                    self.C.printError("modifiers found in 'smtp' setting URI; these aren't suppoted yet")
-                    raise MailnexException("We don't yet support modifiers")
-            s = smtp.smtpClient()
-            if "cacertsfile_{}".format(host) in self.C.settings:
-                s.cacerts = (getattr(self.C.settings, "cacertsfile_{}".format(host)).value)
+            target = self.smtpTarget(constr)
+            scheme, user, host, port, ssl = target
+            # TODO: What if multiple from? Should use sender. Or, should we
+            # allow explicitly setting the smtp from value?
+            envelope_from = m['from'].encode('ascii')
+            envelope_to = list(map(lambda x: x.encode('ascii'), recipients))
+            data = composer.streamMessage(fp.getvalue(), m)
+            if self.C.settings.outbox:
+                # Leave the actual sending to the background; we only need
+                # to be around in case a password has to be entered.
+                self.outboxCredentials(constr, target)
+                self.C.outbox.add(
+                        envelope_from.decode('ascii'),
+                        [x.decode('ascii') for x in envelope_to],
+                        data,
+                        constr,
+                        str(m['subject']) if 'subject' in m else None,
+                        record)
+                self.C.outboxWake.set()
+                print("Info: Message queued for sending ({} in outbox)".format(len(self.C.outbox)))
+                return True
+            s = self.C.smtpSessions.take(constr)
+            if s:
+                print("Info: Reusing connection to {}".format(host))
             else:
-                s.cacerts = self.C.settings.cacertsfile.value
-            # TODO: Allow overriding CA somehow
-            # TODO: Allow user certificates
-            # TODO: DANE?
-            #   import dns # (package python3-dnspython)
-            #   myresolver = dns.resolver.Resolver() # Get a system default resolver
-            #   myresolver.ednsflags |= dns.flags.DO # enable DNSSEC
-            #   timeout = 15 # default in lib is 5, but it can take a bit longer doing DNSSEC
-            #   res = myresolver.resolve("_%d._tcp.%s" % (port, host), "TLSA", lifetime=timeout)
-            #   if (res.response.ednsflags & dns.flags.DO) and (res.response.flags & dns.flags.AD):
-            #       data = str(res.response.rrset[0]) # Should verify response is what we asked? (CNAME/DNAME may complicate). Should iterate over all results (might have multiple acceptible cert infos)
-            s.connect(host, port, ssl)
-            if user:
-                prompt_to_save = False
-                if ssl == smtp.SEC_NONE:
-                    print(self.C.t.red("Warning: Insecure link. Don't send your password lightly!"))
+                print("user: {}\nhost: {}\nport: {}".format(user,host,port))
+                s = self.smtpConnect(target)
+                if user:
                     prompt_to_save = False
-                    password = getpass.getpass()
-                else:
-                    _, prompt_to_save, password = getPassword(self.C.settings, scheme, user, host, port)
-                res = s.login(user, password)
-                if res == False:
-                    self.C.printError("smtp login failed. Probably bad username or password")
-                    raise MailnexException("auth failure")
-                if prompt_to_save:
-                    # TODO: Make a common function with the IMAP side
-                    while True:
-                        line = await self.singleprompt("Save password to keyring (yes/no)? ").lower().strip()
-                        if line == 'y' or line == 'yes':
-                            print(" Saving...")
-                            try:
-                                keyring.set_password("%s://%s" % (scheme, host), user, password)
-                            except RuntimeError:
-                                print("Error: couldn't save password to keyring")
-                            break
-                        elif line == 'n' or line == 'no':
-                            break
+                    if ssl == smtp.SEC_NONE:
+                        print(self.C.t.red("Warning: Insecure link. Don't send your password lightly!"))
+                        prompt_to_save = False
+                        password = getpass.getpass()
+                    else:
+                        _, prompt_to_save, password = getPassword(self.C.settings, scheme, user, host, port)
+                    res = s.login(user, password)
+                    if res == False:
+                        self.C.printError("smtp login failed. Probably bad username or password")
+                        raise MailnexException("auth failure")
+                    if prompt_to_save:
+                        # TODO: Make a common function with the IMAP side
+                        while True:
+                            line = await self.singleprompt("Save password to keyring (yes/no)? ").lower().strip()
+                            if line == 'y' or line == 'yes':
+                                print(" Saving...")
+                                try:
+                                    keyring.set_password("%s://%s" % (scheme, host), user, password)
+                                except RuntimeError:
+                                    print("Error: couldn't save password to keyring")
+                                break
+                            elif line == 'n' or line == 'no':
+                                break
 
-            # TODO: What if multiple from? Should use sender. Or, should we
-            # allow explicitly setting the smtp from value?
+            copy = None
+            if record:
+                copy = self.C.outbox.newSentCopy()
+                data = teeChunks(data, copy)
             # Note: s.sendmail currently always returns None or raises and
             # Exception, so we don't handle res here.
-            envelope_from = m['from'].encode('ascii')
-            envelope_to = list(map(lambda x: x.encode('ascii'), recipients))
-            res = s.sendmail(envelope_from, envelope_to, fp.getvalue().encode('ascii'))
+            try:
+                res = s.sendmail(envelope_from, envelope_to, data)
+            except:
+                if copy:
+                    copy.close()
+                    os.unlink(copy.name)
+                # A refusal leaves the session usable (or sendmail closed
+                # it). Anything else may have left it half way through the
+                # message; don't let the next message be sent over that.
+                if isinstance(sys.exc_info()[1], smtp.Refused):
+                    self.C.smtpSessions.put(constr, s)
+                else:
+                    s.close()
+                raise
+            # Keep the session for the next message
+            self.C.smtpSessions.put(constr, s)
             #for addr in res.keys():
                 # This could be done better. Also use error reporting
                 #print("Error: Sending to {} failed".format(addr))
-            s.quit()
+            if copy:
+                copy.close()
+                self.C.tg.start_soon(self.recordMessage, copy.name, record)
             return True
         s = subprocess.Popen([
             # TODO: Allow the user to override this somehow
@@ -5601,12 +6672,29 @@ class Cmd(cmdprompt.CmdPrompt):
             # TODO: Support delivery status notification settings? "-N" "failure, delay, success, never"
             ] + recipients,
             stdin=subprocess.PIPE)
-        resstr = s.communicate(fp.getvalue())
+        data = composer.streamMessage(fp.getvalue(), m)
+        copy = None
+        if record:
+            copy = self.C.outbox.newSentCopy()
+            data = teeChunks(data, copy)
+        try:
+            for chunk in data:
+                s.stdin.write(chunk)
+            s.stdin.close()
+        except BrokenPipeError:
+            # sendmail gave up early; its exit status will say why
+            pass
         res = s.wait()
+        if copy:
+            copy.close()
         if res == 0:
+            if copy:
+                self.C.tg.start_soon(self.recordMessage, copy.name, record)
             return True
         else:
-            self.C.printError("Failed to send: sendmail proccess returned error {}, message: {}".format(res, resstr))
+            if copy:
+                os.unlink(copy.name)
+            self.C.printError("Failed to send: sendmail proccess returned error {}".format(res))
             raise Exception("sendmail error")
 
     @showExceptions
@@ -5778,9 +6866,11 @@ class Cmd(cmdprompt.CmdPrompt):
     def showHeadersNonVF(self, messageList, file=sys.stdout):
         """Show headers, given a global message list only"""
         msgset = messageList.imapListStr()
-        args = b"(ENVELOPE INTERNALDATE FLAGS)"
-        if self.C.settings.debug.general:
-            print("FETCH {} {}".format(messageList.imapListStr(), args))
+        # UIDs are asked for too, so that messages listed can be changed
+        # offline (see storeFlags)
+        args = b"(UID ENVELOPE INTERNALDATE FLAGS)"
+        if trace.general:
+            trace.event("general", "FETCH {} {}".format(messageList.imapListStr(), args))
         data = self.cacheFetch(messageList, args)
         #data = normalizeFetch(data)
         resset = []
@@ -5788,7 +6878,6 @@ class Cmd(cmdprompt.CmdPrompt):
             envelope = getResultPart(b"ENVELOPE", d[1])
             internaldate = getResultPart(b"INTERNALDATE", d[1])
             flags = getResultPart(b"FLAGS", d[1])
-            envelope = Envelope(*envelope)
 
             # Handle attrs. First pass, only do collapsed form.
             # TODO for second pass, define a class that is initialized with
@@ -5842,7 +6931,7 @@ class Cmd(cmdprompt.CmdPrompt):
             try:
                 gnum = int(d[0])
                 if self.C.virtfolder:
-                    num = self.C.virtfolder.index(gnum) + 1 if gnum in self.C.virtfolder else ""
+                    num = self.virtPositions().get(gnum, "")
                 else:
                     num = gnum
                 datestr = envelope.date
@@ -5862,42 +6951,22 @@ class Cmd(cmdprompt.CmdPrompt):
                     # perhaps better, make it part of the headline setting so if
                     # the user wants, they can see both.
                     date = date.astimezone(dateutil.tz.tzlocal())
-                try:
-                    subject = str(email.header.make_header(email.header.decode_header(envelope.subject.decode("ascii"))))
-                except Exception as ev:
-                    if self.C.settings.debug.general:
-                        print("Subject error",ev)
-                    subject = envelope.subject
+                subject = envelope.subjectText
                 this = True if (num == self.C.currentMessage) else False
-                froms = [x[0] if not x[0] in [None, b'NIL'] else b"%s@%s" % (x[2], x[3]) for x in envelope.from_]
-                # Not great, but try to decode the froms fields
-                newfroms = []
-                for fr in froms:
-                    try:
-                        newfroms.append(str(email.header.make_header(email.header.decode_header(fr))))
-                    except:
-                        try:
-                            # TODO: Log warning about guessing?
-                            newfroms.append(fr.decode("utf-8"))
-                        except:
-                            # TODO: Show error in listing, or drop the header?
-                            newfroms.append(u"<bad from>")
-                froms = newfroms
+                froms = envelope.fromNames or [u""]
 
                 for_me = False
-                if envelope.to:
-                    tos = [b"%s@%s" % (x[2], x[3]) for x in envelope.to]
-                    for t in tos:
-                        if t.decode('utf-8') in self.C.settings.highlightto.value:
-                            for_me = True
-                            break
+                # Group syntax (e.g. 'undisclosed-recipients:;') has
+                # entries without an address; envelopeAddresses skips them.
+                for t, name in addressbook.envelopeAddresses(envelope.to):
+                    if t in self.C.settings.highlightto.value:
+                        for_me = True
+                        break
                 rel_me = False
-                if envelope.cc:
-                    ccs = [b"%s@%s" % (x[2], x[3]) for x in envelope.cc]
-                    for c in ccs:
-                        if c.decode('utf-8') in self.C.settings.highlightto.value:
-                            rel_me = True
-                            break
+                for c, name in addressbook.envelopeAddresses(envelope.cc):
+                    if c in self.C.settings.highlightto.value:
+                        rel_me = True
+                        break
 
                 if self.C.virtfolderExtra and num:
                     extra = self.C.virtfolderExtra[num - 1]
@@ -5977,7 +7046,7 @@ class Cmd(cmdprompt.CmdPrompt):
                     print("  %s  (error displaying because %s '%s'. Data follows)" % (d[0], type(ev), ev), repr(d), file=file)
                     import traceback
                     traceback.print_exc(file=file)
-                elif self.C.settings.debug.general:
+                elif trace.general:
                     print("  %s  (error displaying because %s '%s'. Data follows)" % (d[0], type(ev), ev), repr(d), file=file)
                 else:
                     print("  %s  (error displaying because %s '%s')" % (d[0], type(ev), ev), file=file)
@@ -6023,7 +7092,7 @@ class Cmd(cmdprompt.CmdPrompt):
         if self.C.virtfolder:
             msglist = [self.C.virtfolder[x - 1] for x in msglist]
         try:
-            self.C.connection.doSimpleCommand(b"STORE %s +FLAGS (\\Deleted)" % b",".join(map(lambda x: b'%d' % x, msglist)))
+            self.storeFlags(msglist, b"+", b"\\Deleted")
             # TODO: either run once per flag, or collect errors to show at
             # end.
         except Exception as ev:
@@ -6046,7 +7115,7 @@ class Cmd(cmdprompt.CmdPrompt):
         if self.C.virtfolder:
             msglist = [self.C.virtfolder[x - 1] for x in msglist]
         try:
-            self.C.connection.doSimpleCommand(b"STORE %s -FLAGS (\\Deleted)" % b",".join(map(lambda x: b'%d' % x, msglist)))
+            self.storeFlags(msglist, b"-", b"\\Deleted")
             # TODO: either run once per flag, or collect errors to show at
             # end.
         except Exception as ev:
@@ -6056,8 +7125,237 @@ class Cmd(cmdprompt.CmdPrompt):
     @needsConnection
     def do_expunge(self, args):
         """Flush deleted messages (actually remove them).
+
+        Offline, the messages deleted now are expunged when we are back
+        online (see the 'offline' setting).
+        """
+        C = self.C
+        if not C.settings.offline:
+            C.connection.doSimpleCommand(b"EXPUNGE")
+            return
+        if C.flags.loaded:
+            deleted = C.flags.matching(flagmap.IS_DELETED)
+        else:
+            deleted = sorted(int(k.split(b".")[0]) for k, v in C.cache.items() if isinstance(k, bytes) and k.endswith(b".FLAGS") and b'\\Deleted' in v)
+        if not deleted:
+            print("No deleted messages")
+            return
+        missing = []
+        uids = self.knownUids(deleted, missing)
+        if missing:
+            C.printWarning("Not expunging messages {}: their UIDs aren't known; list them (e.g. with headers) before going offline".format(
+                MessageList(missing).imapListStr()))
+            missing = set(missing)
+            deleted = [seq for seq in deleted if seq not in missing]
+            if not deleted:
+                return
+        C.journal.add(imappool.accountKey(C.connection), C.connection.mailnexBox, C.connection.uidvalidity, "expunge", uids)
+        self.expungeLocally(deleted)
+        print("{} message{} will be expunged when back online".format(len(deleted), "" if len(deleted) == 1 else "s"))
+
+    def expungeLocally(self, gone):
+        """Drop messages from the folder as we know it, as if expunged.
+
+        For expunging offline. The messages after them are renumbered, along
+        with what we have cached of them, so that the folder looks the way
+        it will once the expunge is made. Until the folder is opened again
+        (see reopenFolder), our message numbers don't match the server's.
+        """
+        C = self.C
+        gone = sorted(gone)
+        # Last first, so that the numbers of the others still hold
+        for seq in reversed(gone):
+            self.newExpunge(b"%d" % seq, None)
+        goneSet = set(gone)
+        cache = {}
+        for key, value in C.cache.items():
+            if isinstance(key, bytes):
+                seq, dot, rest = key.partition(b".")
+                if seq.isdigit():
+                    seq = int(seq)
+                    if seq in goneSet:
+                        continue
+                    key = b"%d%s%s" % (seq - bisect.bisect_left(gone, seq), dot, rest)
+            cache[key] = value
+        C.cache = cache
+        # Lists made before now name other messages
+        C.lastList = []
+        C.virtfolder = None
+        C.virtfolderPositions = None
+        C.virtfolderExtra = None
+        for name in ("currentMessage", "nextMessage", "prevMessage"):
+            seq = getattr(C, name)
+            if seq is not None:
+                setattr(C, name, min(seq - bisect.bisect_left(gone, seq), C.lastMessage))
+        C.renumbered = True
+
+    async def reopenFolder(self):
+        """Open the current folder afresh, after expunging offline.
+
+        Makes the journal's changes first, so that the expunged messages
+        don't come back.
         """
-        self.C.connection.doSimpleCommand(b"EXPUNGE")
+        C = self.C
+        C.renumbered = False
+        c = C.connection
+        if c is None:
+            return
+        print("Info: Back online; reopening the folder to catch up with the offline expunge")
+        self.syncJournal()
+        # Our cache is by our numbers, which the server doesn't share
+        C.cache = {}
+        await self.do_folder("{}://{}{}:{}/{}".format(
+            c.mailnexProto,
+            c.mailnexUser + "@" if c.mailnexUser else "",
+            c.mailnexHost,
+            c.mailnexPort,
+            c.mailnexBox,
+            ))
+
+    def storeFlags(self, msglist, change, flag):
+        """Add (change b"+") or remove (b"-") a flag on messages.
+
+        msglist is of global message numbers. Offline, the change is made to
+        the messages as we know them, and written to the journal to be made
+        on the server when we are back online.
+        """
+        C = self.C
+        if not C.settings.offline:
+            C.connection.doSimpleCommand(b"STORE %s %sFLAGS (%s)" % (b",".join(b"%d" % x for x in msglist), change, flag))
+            return
+        C.journal.add(imappool.accountKey(C.connection), C.connection.mailnexBox, C.connection.uidvalidity,
+                change.decode("ascii") + "FLAGS", self.knownUids(msglist), flag.decode("ascii"))
+        for seq in msglist:
+            flags = [f for f in self.knownFlags(seq) if f.lower() != flag.lower()]
+            if change == b"+":
+                flags.append(flag)
+            # As if the server had told us
+            self.fetchMonitor(b"%d" % seq, b"(FLAGS (%s))" % b" ".join(flags))
+
+    def knownFlags(self, seq):
+        """Return the flags of a message as last known, without asking"""
+        flags = self.C.cache.get(b"%d.FLAGS" % seq)
+        if flags is not None:
+            return list(flags)
+        if self.C.flags.loaded and 0 < seq <= len(self.C.flags):
+            return flagmap.flagNames(self.C.flags.get(seq))
+        return []
+
+    def knownUids(self, msglist, missing=None):
+        """Return the UIDs of messages, from the cache.
+
+        Raises MailnexException if we don't know them all; messages only
+        have their UIDs cached once listed (e.g. by headers) or read. If a
+        missing list is given, the messages we don't know are added to it
+        instead, and left out.
+        """
+        res = []
+        unknown = []
+        for seq in msglist:
+            uid = self.C.cache.get(b"%d.UID" % seq)
+            if uid is None:
+                unknown.append(seq)
+            else:
+                res.append(int(uid))
+        if missing is not None:
+            missing.extend(unknown)
+        elif unknown:
+            raise MailnexException("don't know the UIDs of messages {}; list them (e.g. with headers) before going offline".format(
+                MessageList(unknown).imapListStr()))
+        return res
+
+    def syncFolder(self, c, box, entries):
+        """Make the changes of journal entries for a folder, over connection c.
+
+        All the changes go in one round trip. Returns the number of entries
+        made, the number dropped because the folder's UIDVALIDITY changed,
+        and the errors of any commands that failed.
+        """
+        if c.mailnexBox != box:
+            c.select(box)
+            c.mailnexBox = box
+        valid = [e for e in entries if e["uidvalidity"] == c.uidvalidity]
+        failures = []
+        for result in c.pipeline(journal.commands(valid, b'UIDPLUS' in c.caps)):
+            if isinstance(result, Exception):
+                failures.append(str(result))
+        return len(valid), len(entries) - len(valid), failures
+
+    def journalDone(self, box, entries, made, dropped, failures):
+        """Forget synchronized journal entries, and return anything to tell the user, or None"""
+        self.C.journal.remove(entries)
+        res = []
+        if dropped:
+            res.append("Dropped {} offline change{} to '{}': the folder was recreated on the server since, so its messages can't be matched up".format(
+                dropped, "" if dropped == 1 else "s", box))
+        if failures:
+            res.append("Some offline changes to '{}' failed: {}".format(box, "; ".join(failures)))
+        return "\n".join(res) or None
+
+    def syncJournal(self):
+        """Make the journal's changes now (e.g. when quitting)"""
+        C = self.C
+        for key, box in C.journal.folders():
+            entries = C.journal.pending(key, box)
+            c = C.pool.lease(key, box, purpose="journal")
+            try:
+                if c is None:
+                    c = self.connectQuietly(key)
+                    C.pool.add(c, "journal")
+                report = self.journalDone(box, entries, *self.syncFolder(c, box, entries))
+            except Exception as ev:
+                C.printWarning("Couldn't make offline changes to '{}': {}".format(box, ev))
+                continue
+            finally:
+                if c is not None:
+                    C.pool.release(c)
+            if report:
+                C.printWarning(report)
+
+    async def journalRunner(self):
+        """Background task making the journal's changes once we are online"""
+        C = self.C
+        # Account -> when making changes to it last failed
+        failed = {}
+        while True:
+            with anyio.move_on_after(JOURNAL_CHECK):
+                await C.journalWake.wait()
+            C.journalWake = anyio.Event()
+            if C.settings.offline or not len(C.journal):
+                continue
+            for key, box in C.journal.folders():
+                if time.time() - failed.get(key, 0) < JOURNAL_RETRY:
+                    continue
+                if C.renumbered and hasattr(C.connection, 'mailnexBox') and (key, box) == (imappool.accountKey(C.connection), C.connection.mailnexBox):
+                    # Left to reopenFolder, so that the expunges it makes
+                    # aren't applied to our renumbered folder a second time
+                    continue
+                entries = C.journal.pending(key, box)
+                c = C.pool.lease(key, box, purpose="journal")
+                try:
+                    if c is None:
+                        c = await anyio.to_thread.run_sync(self.connectQuietly, key)
+                        C.pool.add(c, "journal")
+                    result = await anyio.to_thread.run_sync(self.syncFolder, c, box, entries)
+                except Exception as ev:
+                    # Tell the user the first time; keep trying quietly
+                    if key not in failed:
+                        report = "Couldn't make offline changes to '{}' yet: {}".format(box, ev)
+                    else:
+                        report = None
+                    failed[key] = time.time()
+                else:
+                    failed.pop(key, None)
+                    report = self.journalDone(box, entries, *result)
+                finally:
+                    if c is not None:
+                        C.pool.release(c)
+                if report:
+                    l = lambda: C.printWarning(report)
+                    if self.cli.app._is_running:
+                        self.cli.run_in_terminal(l)
+                    else:
+                        l()
 
     @showExceptions
     @needsConnection
@@ -6074,7 +7372,7 @@ class Cmd(cmdprompt.CmdPrompt):
         if self.C.virtfolder:
             msglist = [self.C.virtfolder[x - 1] for x in msglist]
         try:
-            self.C.connection.doSimpleCommand(b"STORE %s +FLAGS (\\Seen)" % b",".join(map(lambda x: b"%d"%x, msglist)))
+            self.storeFlags(msglist, b"+", b"\\Seen")
             # TODO: either run once per flag, or collect errors to show at
             # end.
         except Exception as ev:
@@ -6097,7 +7395,7 @@ class Cmd(cmdprompt.CmdPrompt):
         if self.C.virtfolder:
             msglist = [self.C.virtfolder[x - 1] for x in msglist]
         try:
-            self.C.connection.doSimpleCommand(b"STORE %s -FLAGS (\\Seen)" % b",".join(map(lambda x: b"%d"%x, msglist)))
+            self.storeFlags(msglist, b"-", b"\\Seen")
             # TODO: either run once per flag, or collect errors to show at
             # end.
         except Exception as ev:
@@ -6123,7 +7421,7 @@ class Cmd(cmdprompt.CmdPrompt):
         if self.C.virtfolder:
             msglist = [self.C.virtfolder[x - 1] for x in msglist]
         try:
-            self.C.connection.doSimpleCommand(b"STORE %s +FLAGS (\\Flagged)" % b",".join(map(lambda x: b"%d"%x, msglist)))
+            self.storeFlags(msglist, b"+", b"\\Flagged")
             # TODO: either run once per flag, or collect errors to show at
             # end.
         except Exception as ev:
@@ -6148,7 +7446,7 @@ class Cmd(cmdprompt.CmdPrompt):
         if self.C.virtfolder:
             msglist = [self.C.virtfolder[x - 1] for x in msglist]
         try:
-            self.C.connection.doSimpleCommand(b"STORE %s -FLAGS (\\Flagged)" % b",".join(map(lambda x: b"%d"%x, msglist)))
+            self.storeFlags(msglist, b"-", b"\\Flagged")
             # TODO: either run once per flag, or collect errors to show at
             # end.
         except Exception as ev:
@@ -6330,7 +7628,7 @@ class Cmd(cmdprompt.CmdPrompt):
                 pass
             else:
                 # Restore default value
-                opt.value = opt.default
+                self.C.settings.reset(args)
         except KeyError:
             print("No setting named %s" % args)
 
@@ -6439,10 +7737,9 @@ class Cmd(cmdprompt.CmdPrompt):
                 elif args[-1] == '&':
                     # Reset to default value
                     try:
-                        opt = self.C.settings[args[:-1]]
+                        self.C.settings.reset(args[:-1])
                     except KeyError:
                         print("No setting named %s" % args[:-1])
-                    opt.value = opt.default
                 elif args[-1].isalpha():
                     # Must be a boolean
                     print("nye")
@@ -6614,11 +7911,16 @@ class Cmd(cmdprompt.CmdPrompt):
             print("No applicable messages")
             return
         #TODO: Make 'interesting' criteria a user setting
-        msgs = list(map(int,self.C.connection.search('utf-8', '(or FLAGGED NEW)')))
-        if self.C.virtfolder:
-            msgs = [self.C.virtfolder.index(x) for x in msgs if x in self.C.virtfolder]
-        if self.C.settings.debug.general:
-            print("{} msgs {}".format(len(msgs), msgs))
+        positions = self.virtPositions() if self.C.virtfolder else None
+        if self.C.flags.loaded:
+            interestingPages = self.C.flags.pages(flagmap.IS_INTERESTING, rows, positions)
+        else:
+            msgs = map(int,self.C.connection.search('utf-8', '(or FLAGGED NEW)'))
+            if positions is not None:
+                msgs = (positions[x] for x in msgs if x in positions)
+            interestingPages = sorted(set((x - 1) // rows for x in msgs))
+        if trace.general:
+            trace.event("general", "{} interesting pages".format(len(interestingPages)))
         # Observing mailx behavior, if there isn't anything interesting, go to
         # the last page. If we were on the last page, and '-' isn't specified
         # in args, display also the "On last page or messages" message.
@@ -6626,40 +7928,33 @@ class Cmd(cmdprompt.CmdPrompt):
         # display the message and go to the last interesting page.
         # This should be able to be generalized by selecting the last message
         # for the target page and performing the normal actions.
-        if len(msgs) == 0:
-            msgs = [lastMessage]
         # These ignores feel dirty
         ignoreFirstPage = False
         ignoreLastPage = False
         # Current information.
         currentPage = (self.C.currentMessage - 1) // rows
         lastPage = (lastMessage - 1) // rows
-        interestingPages = sorted(list(set((x - 1) // rows for x in msgs)))
-        if self.C.settings.debug.general:
-            print("Current {}\nLast {}\n{} Interesting {}\n".format(currentPage, lastPage, len(interestingPages), tuple((x, x * rows) for x in interestingPages)))
-        if currentPage in interestingPages:
-            i = interestingPages.index(currentPage)
+        if len(interestingPages) == 0:
+            interestingPages = [lastPage]
+        if trace.general:
+            trace.event("general", "Current {}\nLast {}\n{} Interesting {}\n".format(currentPage, lastPage, len(interestingPages), tuple((x, x * rows) for x in interestingPages)))
+        i = bisect.bisect_left(interestingPages, currentPage)
+        if i < len(interestingPages) and interestingPages[i] == currentPage:
             addedPage = False
             incDrop = False
         else:
             # insert current page into list so that we can get a list index
-            # for it. There is surely a more effecient way to do this, but I'm
-            # hoping no one has a huge list of interesting messages anyway.
-            for i in range(len(interestingPages)):
-                if interestingPages[i] > currentPage:
-                    interestingPages.insert(i, currentPage)
-                    if (i == 0):
-                        ignoreFirstPage = True
-                    break
-            else:
-                # Didn't find it yet, so we must be biggest, append to list
-                interestingPages.append(currentPage)
-                i += 1
+            # for it.
+            interestingPages.insert(i, currentPage)
+            if i == 0:
+                ignoreFirstPage = True
+            elif i == len(interestingPages) - 1:
+                # We're past the last, so we're at the end of the list
                 ignoreLastPage = True
             addedPage = True
             incDrop = True
-        if self.C.settings.debug.general:
-            print("page index {} of {}".format(i, interestingPages))
+        if trace.general:
+            trace.event("general", "page index {} of {}".format(i, interestingPages))
         # Now proceed like 'z', but on our list. Also, don't accept anything
         # other than '+' and '-' (for whatever reason). TODO: Allow it via an
         # option? Just allow it anyhow?
@@ -6701,14 +7996,177 @@ class Cmd(cmdprompt.CmdPrompt):
         ml.addRange(start, end)
         self.showHeaders(ml)
 
+    @showExceptions
+    def do_outbox(self, args):
+        """Show or manage messages waiting to be sent.
+
+        outbox            list messages in the outbox
+        outbox retry      try sending everything now
+        outbox retry N    try sending message N now
+        outbox drop N     remove message N from the outbox without sending it
+
+        Messages are put in the outbox when the 'outbox' setting is on.
+        """
+        args = args.split()
+        entries = self.C.outbox.entries()
+        if len(args) == 0:
+            if len(entries) == 0:
+                print("Outbox is empty")
+                return
+            now = time.time()
+            for i, entry in enumerate(entries):
+                if entry['held']:
+                    state = "held"
+                elif entry['next'] <= now:
+                    state = "sending"
+                else:
+                    state = "retry in {}s".format(int(entry['next'] - now))
+                size = normalizeSize(entry['size'])
+                print("{:3} {} {:>6} '{}' to {} ({})".format(
+                    i + 1,
+                    time.strftime("%b %d %H:%M", time.localtime(entry['created'])),
+                    "{:.0f}{}".format(size[0], size[1]),
+                    entry['subject'] or "(no subject)",
+                    ", ".join(entry['to']),
+                    state,
+                    ))
+                if entry['error']:
+                    print("      last error (attempt {}): {}".format(entry['attempts'], entry['error']))
+            return
+        if args[0] not in ("retry", "drop") or len(args) > 2 or (args[0] == "drop" and len(args) != 2):
+            print("Unknown arguments. See 'help outbox'")
+            return
+        if len(args) == 2:
+            try:
+                index = int(args[1])
+            except ValueError:
+                index = 0
+            if index < 1 or index > len(entries):
+                print("No message {} in the outbox".format(args[1]))
+                return
+            entries = [entries[index - 1]]
+        if args[0] == "drop":
+            self.C.outbox.remove(entries[0])
+            print("Dropped message to {}".format(", ".join(entries[0]['to'])))
+            return
+        for entry in entries:
+            # Held messages are usually waiting on a password. We can ask for
+            # it here, where we are allowed to prompt.
+            self.outboxCredentials(entry['smtp'], self.smtpTarget(entry['smtp']))
+            self.C.outbox.retry(entry)
+        self.C.outboxWake.set()
+
+    async def do_profile(self, args):
+        """Run a command under the python profiler.
+
+        profile {command}   run command, then show where the time went
+
+        Shows the command's server, parsing, and other time, followed by the
+        functions with the most cumulative time.
+        """
+        import cProfile
+        import pstats
+        if not args.strip():
+            print("Usage: profile {command}")
+            return
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            res = await self.onecmd(args)
+        finally:
+            prof.disable()
+        command, delta = self.C.profiler.last
+        wall, parse, wait, roundTrips, bytesIn, bytesOut = delta
+        print("{}: {:.1f}ms; server {:.1f}ms in {} round trips, parse {:.1f}ms, other {:.1f}ms; {} bytes in, {} out".format(
+            command,
+            wall * 1000,
+            wait * 1000,
+            roundTrips,
+            parse * 1000,
+            (wall - wait - parse) * 1000,
+            bytesIn,
+            bytesOut,
+            ))
+        stream = StringIO()
+        stats = pstats.Stats(prof, stream=stream)
+        stats.sort_stats("cumulative").print_stats(25)
+        print(stream.getvalue())
+        return res
+
+    def do_stats(self, args):
+        """Show how long commands have taken this session.
+
+        stats               all commands, a latency histogram over them, and
+                            the session metrics
+        stats {command}     just the given command, and its latency histogram
+
+        'server' is time spent waiting on IMAP servers, 'parse' is time spent
+        parsing their responses, and 'other' is everything else (our own
+        processing, and writing to the terminal). 'trips' counts round trips
+        to the server, and in and out are bytes on the wire.
+
+        The session metrics count IMAP and SMTP commands by type and server,
+        with percentiles of how long servers took to answer them, along with
+        literal sizes, reconnects, IDLE restarts, cache hit rates, and index
+        throughput. See the metricsfile setting for exporting them.
+        """
+        command = args.strip() or None
+        if command is not None and command not in self.C.profiler.commands:
+            print("No runs of '{}' this session".format(command))
+            return
+        for line in self.C.profiler.report(command):
+            print(line)
+        if command is None:
+            print()
+            print("Session metrics:")
+            for line in metrics.report():
+                print(line)
+
+    def writeMetrics(self):
+        """Write the session metrics to the metricsfile, if one is set.
+
+        Returns an error message, or None.
+        """
+        path = self.C.settings.metricsfile.value
+        if not path:
+            return None
+        try:
+            metrics.writePrometheus(path, {"user": getpass.getuser(), "pid": os.getpid()})
+        except OSError as ev:
+            return "Couldn't write metrics: {}".format(ev)
+        return None
+
+    async def metricsRunner(self):
+        """Background task writing the session metrics every metricsinterval seconds"""
+        lastError = None
+        while True:
+            interval = self.C.settings.metricsinterval.value
+            await anyio.sleep(interval if interval > 0 else 60)
+            if interval <= 0:
+                continue
+            error = self.writeMetrics()
+            if error and error != lastError:
+                # Only complain when something changes; the file is retried
+                # every interval.
+                l = lambda: self.C.printError(error)
+                if self.cli.app._is_running:
+                    self.cli.run_in_terminal(l)
+                else:
+                    l()
+            lastError = error
+
     @showExceptions
     def do_quit(self, args):
-        # TODO: Support synchronizing if user setting asks for it. Something like:
-        #print("Synchronizing events")
-        #for i in self.C.pending:
-            #print(" ",i)
-            #self.commitaction(i)
-        # TODO: Synchronize and quit
+        count = len(self.C.outbox)
+        if count:
+            print("Info: {} message{} still in the outbox; sending will continue next time".format(count, "" if count == 1 else "s"))
+        count = len(self.C.journal)
+        if count and not self.C.settings.offline:
+            print("Synchronizing {} offline change{}".format(count, "" if count == 1 else "s"))
+            self.syncJournal()
+            count = len(self.C.journal)
+        if count:
+            print("Info: {} offline change{} still to be made; they will be made next time".format(count, "" if count == 1 else "s"))
         return True
 
     @showExceptions
@@ -6730,6 +8188,13 @@ class Cmd(cmdprompt.CmdPrompt):
 
 def getOptionsSet():
     options = settings.Options()
+    options.addOption(settings.BoolOption("addressbook", True, doc="""Set to remember addresses for completion.
+
+    The From, To, and Cc addresses of messages as their headers are fetched,
+    and the recipients of messages sent, are kept in a local address book
+    used for completing recipients. Messages in the 'record' folder count as
+    sent. Completion from it doesn't wait on the addresssearchcmd, which is
+    run in the background and its results added when it finishes."""))
     options.addOption(settings.StringOption("addresssearchcmd", "khard email -p", doc="""Command to use for searching addresses
     Used for address completion (e.g. in the ~h command when editing a message).
     Command output is expected to be the address, a tab, the name, and then
@@ -6808,15 +8273,21 @@ def getOptionsSet():
 
     For local imap servers, you can set this to the public cert file of the
     server, for example '/etc/dovecot/dovecot.pem'"""))
+    options.addOption(settings.BoolOption("compress", True, doc="""Use stream compression for IMAP connections when the server supports it.
+
+    Compression (COMPRESS=DEFLATE) is negotiated after logging in. It mostly
+    helps on slow links when pulling lots of headers or message text, at the
+    cost of some CPU on both ends. Only applies to new connections."""))
     options.addOption(settings.FlagsOption("debug", [], doc="""Enable various debug modes
+        * cache     - message cache lookups
         * exception - show detailed exceptions instead of short messages
         * general   - show general tidbits during runtime
-        * imap      - debug output from imap handler (only applies on new imap
-                      connections)
+        * imap      - debug output from imap handler
         * parse     - debug from parsers (e.g. IMAP data structures)
         * python    - enable the python command for mucking with program
                       internals live.
         * struct    - debug output from message structure parser
+        * timing    - show time spent in each phase of opening a folder
         """))
     options.addOption(settings.StringOption("defaultTZ", "UTC"))
     options.addOption(settings.StringOption("folder", "", doc="Replacement text for folder related commands that start with '+'"))
@@ -6913,6 +8384,11 @@ def getOptionsSet():
         ], doc="Prefered order of headers. Headers not mentioned in this list are displayed in the order of the message. Set this to empty in order to not re-order any headers for display."))
     options.addOption(settings.BoolOption('headerorderend', False, doc="Set to display the preferred headers (those mentioned in 'headerorder') at the end of the headers list. Clear to display preferred headers at the start."))
     options.addOption(settings.FlagsOption("highlightto", [], doc="Set a list of email addresses to highlight when matching in listings."))
+    options.addOption(settings.NumericOption("imappool", 2, doc="""Number of unused IMAP connections to keep open per account.
+
+    When the folder command switches to a different account, the old
+    connection is kept logged in so that switching back doesn't need a new
+    TLS handshake and login. Set to 0 to close connections instead."""))
     options.addOption(settings.FlagsOption("ignoredheaders", [
         'content-transfer-encoding',
         'in-reply-to',
@@ -6926,6 +8402,15 @@ def getOptionsSet():
         'content-transfer-encoding',
         'mime-version',
         ], doc="Mime Headers to ignore (as opposed to message headers). See also 'ignoredheaders'."))
+    options.addOption(settings.StringOption("metricsfile", "", doc="""File to write the session metrics to, in the Prometheus text format.
+
+    Written every 'metricsinterval' seconds and when quitting, replacing the
+    file each time, e.g. for node_exporter's textfile collector. Every series
+    is labelled with the local user and process id. When empty, the metrics
+    are only shown by the stats command."""))
+    options.addOption(settings.NumericOption("metricsinterval", 60, doc="""Seconds between writes of the metricsfile.
+
+    Set to 0 to only write it when quitting."""))
     options.addOption(settings.StringOption("middomain", None, doc="""Message-ID Domain name.
 
         If given, this string is used for the domain part of the message-id of outgoing messages.
@@ -6942,6 +8427,27 @@ def getOptionsSet():
     options.addOption(settings.FlagsOption("mimeheaderorder", [
         #TODO: a default ordering?
         ], doc="Prefered order of MIME headers. See also 'headerorder'."))
+    options.addOption(settings.BoolOption("offline", False, doc="""Work without the server, e.g. with no network.
+
+    Marking messages read, flagged, or deleted, and expunging, are kept in a
+    journal and made on the server once this is unset again (or when
+    quitting online), a batch at a time. Messages and headers already
+    fetched can still be read. Messages can only be changed offline if they
+    were listed (e.g. by headers) or read beforehand. Expunged messages go
+    from the folder straight away; the folder is opened again once back
+    online, to match the server's numbering. Background network tasks
+    (IDLE, watched folders, folder listing) wait until back online.
+
+    Changes are matched to messages by UID. If the folder was recreated on
+    the server meanwhile, its changes are dropped, with a warning."""))
+    options.addOption(settings.BoolOption("outbox", True, doc="""Send messages in the background.
+
+    When set and 'smtp' is in use, finished messages are put in an outbox
+    and the composer returns right away. Messages are sent from the outbox
+    in the background, and retried later if sending fails (e.g. the server
+    is down). See the 'outbox' command for what is waiting to be sent.
+
+    When unset, the composer waits until the message has been sent."""))
 
     options.addOption(settings.StringOption("PAGER", "internal"))
     options.addOption(settings.StringOption("pipe", None, doc="""Filter content prior to display using command.
@@ -7031,6 +8537,15 @@ def getOptionsSet():
     See also 'pipe' and 'pipe-ienc'
     """))
     options.addOption(settings.StringOption("pgpkey", None, doc="PGP key search string. Can be an email address, UID, or fingerprint as recognized by gnupg. When unset, try to use the from field."))
+    options.addOption(settings.StringOption("record", None, doc="""Folder to save a copy of sent messages in.
+
+    Like the folder command, a leading '+' is replaced with the value of the
+    'folder' setting. e.g. '+Sent'.
+
+    The copy is saved once the message has been sent, in the background,
+    over a spare connection to the folder's account. If there isn't one, a
+    new connection is made, but only if the password can be had without
+    asking (e.g. from the keyring)."""))
     options.addOption(settings.BoolOption('showstructure', True, doc="Set to display the structure of the message between the headers and the body when printing."))
     options.addOption(settings.StringOption('smtp', None, doc="""Set to an smtp/submission URI to send messages via SMTP instead of local sendmail agent.
 
@@ -7047,6 +8562,15 @@ def getOptionsSet():
         smtp, smtps, or submission as the protocol part.
 
         """))
+    options.addOption(settings.NumericOption("smtpidle", 120, doc="""Seconds to keep an SMTP connection open after sending.
+
+    Sending another message within this time reuses the connection, skipping
+    the connect, TLS handshake, and login. Set to 0 to disconnect after
+    every message."""))
+    options.addOption(settings.StringOption("tracefile", "", doc="""File to append debug output to.
+
+    When empty, output from the cache, general, imap, and parse debug modes
+    goes to the terminal."""))
     options.addOption(settings.StringOption("trusted-mta-ids", None, doc="""List of MTA identifiers trusted for things like Authentication Results and pulling TLS info
 
         For example, if set to 'mx1.example.com', the following headers will be used for presenting message security information:
@@ -7067,6 +8591,18 @@ def getOptionsSet():
         Authentication-Results headers, so this option accepts a comma
         separate list of the IDs to trust for this information."""))
     options.addOption(settings.BoolOption('usekeyring', True, doc="Set to attempt to use system keyrings for password storage"))
+    options.addOption(settings.StringOption("watchfolders", "", doc="""Space separated folders to watch for new mail.
+
+    Folders are on the account of the current folder, named as on the server
+    (e.g. 'INBOX Lists/dev'). Their unread and new message counts are shown
+    in the toolbar, kept up to date over a spare connection to the account.
+    If the server supports NOTIFY, it tells us when they change; otherwise
+    they are checked every 'watchinterval' seconds, less often while nothing
+    changes."""))
+    options.addOption(settings.NumericOption("watchinterval", 60, doc="""Seconds between checks of the watchfolders, if the server can't notify us.
+
+    While nothing changes, checks slow down to as little as every 8 times
+    this."""))
     return options
 
 def instancemethod(func, obj, cls):
@@ -7080,8 +8616,44 @@ def instancemethod(func, obj, cls):
     """
     return func.__get__(obj, cls)
 
+def setupContext(C):
+    """Give a Context the pools, caches, and queues of a session.
+
+    C.settings must be set. Shared by interact() and tools that drive
+    commands without a terminal (e.g. experiments/imap-bench.py), so that
+    they see the same session the prompt does.
+    """
+    options = C.settings
+    C.pool = imappool.ConnectionPool(options.imappool.value, options.debug.imap)
+    C.smtpSessions = smtp.SessionCache(options.smtpidle.value)
+    C.keyIndex = keyindex.KeyIndex(debug=options.debug.general)
+    C.addressBook = addressbook.AddressBook(addressBookFile)
+    C.folderCache = foldertree.FolderCache(foldersFile)
+    C.journal = journal.Journal(journalFile)
+    C.profiler = profiler.Profiler()
+    C.outbox = outbox.Outbox(outboxDir, options.debug.general, C.smtpSessions)
+    C.outboxWake = anyio.Event()
+    C.unreadWake = anyio.Event()
+    C.folderWake = anyio.Event()
+    C.journalWake = anyio.Event()
+
+def startBackground(cmd, tg):
+    """Start the background tasks of a session set up by setupContext()"""
+    C = cmd.C
+    C.tg = tg
+    C.bgtimer = Timer(tg, 1, 5, cmd.bgcheck, None)
+    tg.start_soon(cmd.outboxRunner)
+    tg.start_soon(cmd.unreadRunner)
+    tg.start_soon(cmd.idleRunner)
+    tg.start_soon(cmd.watchRunner)
+    tg.start_soon(cmd.folderRunner)
+    tg.start_soon(cmd.journalRunner)
+    tg.start_soon(cmd.metricsRunner)
+
 async def interact(invokeOpts):
+    lazy.mark("event loop")
     cmd = Cmd(prompt="mailnex> ", histfile=histFile)
+    lazy.mark("command prompt")
     C = Context()
     C.dbpath = defDbFile # TODO: allow get from config file
     C.lastcommand=""
@@ -7102,6 +8674,9 @@ async def interact(invokeOpts):
     cmd.C = C
     options = getOptionsSet()
     C.settings = options
+    options.watch("debug", lambda opt: trace.configure(opt.value))
+    options.watch("tracefile", lambda opt: trace.setFile(opt.value))
+    options.watch("offline", cmd.offlineChanged)
     postConfFolder = None
     global confFile
     cmd.C.accounts = {}
@@ -7116,12 +8691,17 @@ async def interact(invokeOpts):
         res = cmd.processConfig("cmdline account", 1, ['account {}'.format(invokeOpts.account)])
         if res:
             postConfFolder = res
+    lazy.mark("configuration")
     C.t = blessings.Terminal()
+    setupContext(C)
+    lazy.mark("terminal, pools, and outbox")
     async with anyio.create_task_group() as tg:
-        C.tg = tg
-        C.bgtimer = Timer(tg, 1, 5, cmd.bgcheck, None)
+        startBackground(cmd, tg)
         if postConfFolder:
             await cmd.do_folder(postConfFolder)
+            lazy.mark("opening {}".format(postConfFolder))
+        if invokeOpts.startup_profile:
+            lazy.report()
         try:
             await cmd.cmdloop()
         except KeyboardInterrupt:
@@ -7133,6 +8713,12 @@ async def interact(invokeOpts):
                 print("Bailing on exception",ev)
         # We are done, the cmdloop exited. Let's clean up all our other tasks
         print("cleanup")
+        C.pool.closeAll()
+        C.smtpSessions.closeAll()
+        C.addressBook.save()
+        error = cmd.writeMetrics()
+        if error:
+            C.printError(error)
         tg.cancel_scope.cancel()
         print("done")
 
@@ -7211,6 +8797,7 @@ async def amain():
     parser = argparse.ArgumentParser(description="command line mail user agent")
     parser.add_argument('--config', help='custom configuration file')
     parser.add_argument('--account','-A', help='run account command after config file is read')
+    parser.add_argument('--startup-profile', action='store_true', help='show where the time went before the first prompt')
     args = parser.parse_args()
     await interact(args)
 
@@ -0,0 +1,209 @@
+# Session metrics.
+#
+# Where profiler charges costs to the commands typed at the prompt, these
+# count what the session did on the wire: IMAP and SMTP commands by type and
+# server, how long servers took to answer them, literal sizes, reconnects and
+# IDLE restarts, cache hit rates, and index throughput. They are meant for
+# long-running sessions, to spot accounts that are hammering their server.
+#
+# Everything lives in module globals, like trace, so the protocol libraries
+# can count without a reference to the program's context:
+#
+#     from . import metrics
+#     metrics.count("imap_commands_total", command="FETCH", server=host)
+#     metrics.observe("imap_response_seconds", elapsed, command="FETCH", server=host)
+#
+# Counting is a dict update, so keep it to once per command or per message,
+# not per byte. Totals something else already keeps (e.g. the IMAP byte
+# counters) are pulled in at report time by a function added to 'sources'.
+#
+# Counting is safe from other threads (the outbox sends from one).
+#
+# writePrometheus() writes everything in the Prometheus text format, e.g. for
+# node_exporter's textfile collector.
+
+import os
+import threading
+
+# Number of recent observations kept per series for percentiles
+SAMPLES = 1024
+
+# Percentiles shown and exported for observed series
+QUANTILES = (0.5, 0.9, 0.99)
+
+# Help text for the series we know of. Series without it are still reported.
+HELP = {
+        "imap_commands_total": "IMAP commands sent",
+        "imap_response_seconds": "Time from sending an IMAP command to its tagged response",
+        "imap_literal_bytes": "Sizes of literals received from IMAP servers",
+        "imap_connects_total": "IMAP connections made",
+        "imap_reconnects_total": "IMAP connections made to a server connected to earlier in the session",
+        "imap_connections_lost_total": "IMAP connections closed by the server or network",
+        "imap_idle_restarts_total": "Times IDLE was entered again on a connection after leaving it",
+        "imap_bytes_received_total": "Bytes received from IMAP servers, on the wire",
+        "imap_bytes_sent_total": "Bytes sent to IMAP servers, on the wire",
+        "imap_round_trips_total": "Reads that waited on an IMAP server to answer",
+        "imap_server_wait_seconds_total": "Time spent waiting on IMAP servers to answer",
+        "smtp_commands_total": "SMTP commands sent",
+        "smtp_response_seconds": "Time from sending an SMTP command to its reply",
+        "smtp_connects_total": "SMTP connections made",
+        "smtp_sessions_reused_total": "Messages sent on an already open SMTP connection",
+        "smtp_bytes_received_total": "Bytes received from SMTP servers",
+        "smtp_bytes_sent_total": "Bytes sent to SMTP servers",
+        "smtp_messages_total": "Messages accepted by SMTP servers",
+        "cache_lookups_total": "Message cache lookups, by result",
+        "index_messages_total": "Messages added to the search index",
+        "index_seconds_total": "Time spent adding messages to the search index",
+        }
+
+class Samples(object):
+    """Count, sum, and the most recent values of an observed series"""
+    __slots__ = ('count', 'total', 'recent', 'pos')
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.recent = []
+        self.pos = 0
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if len(self.recent) < SAMPLES:
+            self.recent.append(value)
+        else:
+            self.recent[self.pos] = value
+            self.pos = (self.pos + 1) % SAMPLES
+    def quantiles(self, qs=QUANTILES):
+        """Return the given quantiles of the recent values (nearest rank)"""
+        if not self.recent:
+            return [0] * len(qs)
+        ordered = sorted(self.recent)
+        last = len(ordered) - 1
+        return [ordered[min(last, int(q * len(ordered)))] for q in qs]
+
+# Series, keyed by (name, ((label, value), ...))
+counters = {}
+samples = {}
+lock = threading.Lock()
+
+# Functions returning [(name, labels dict, value)] of counters kept elsewhere
+sources = []
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+def count(name, amount=1, **labels):
+    """Add amount to a counter"""
+    key = _key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+def observe(name, value, **labels):
+    """Record one observation (a duration, a size) of a series"""
+    key = _key(name, labels)
+    with lock:
+        s = samples.get(key)
+        if s is None:
+            s = samples[key] = Samples()
+        s.add(value)
+
+def allCounters():
+    """Return our counters merged with those from the sources"""
+    with lock:
+        res = dict(counters)
+    for source in sources:
+        for name, labels, value in source():
+            key = _key(name, labels)
+            res[key] = res.get(key, 0) + value
+    return res
+
+def get(name, **labels):
+    """Return the total of a counter over every series matching labels"""
+    want = set(_key(name, labels)[1])
+    return sum(v for (n, l), v in allCounters().items() if n == name and want.issubset(l))
+
+def _name(name, labels):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join("{}={}".format(k, v) for k, v in labels))
+
+def report():
+    """Return lines describing the session's metrics"""
+    values = allCounters()
+    rows = [(_name(name, labels), _formatValue(values[(name, labels)])) for (name, labels) in sorted(values)]
+    hits = get("cache_lookups_total", result="hit")
+    misses = get("cache_lookups_total", result="miss")
+    if hits + misses:
+        rows.append(("cache hit rate", "{:.1f}%".format(100 * hits / (hits + misses))))
+    indexed = get("index_messages_total")
+    spent = get("index_seconds_total")
+    if indexed and spent:
+        rows.append(("index messages per second", "{:.1f}".format(indexed / spent)))
+    with lock:
+        series = [(_name(name, labels), name.endswith("_seconds"), s.count, s.total, s.quantiles()) for (name, labels), s in sorted(samples.items())]
+    width = max([len(r[0]) for r in rows] + [len(r[0]) for r in series] + [6])
+    lines = ["{:{}} {:>12}".format(name, width, value) for name, value in rows]
+    if series:
+        lines.append("")
+        lines.append("{:{}} {:>7} {:>10} {:>10} {:>10} {:>10}".format("series", width, "count", "mean", "p50", "p90", "p99"))
+        for name, seconds, count, total, quantiles in series:
+            scale, unit = (1000, "ms") if seconds else (1, "")
+            lines.append("{:{}} {:7} {:>10} {:>10} {:>10} {:>10}".format(
+                name, width, count,
+                *("{:.1f}{}".format(v * scale, unit) for v in [total / count] + quantiles)))
+    return lines
+
+def _formatValue(value):
+    if isinstance(value, float):
+        return "{:.3f}".format(value)
+    return str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _series(name, labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels))
+
+def prometheus(common=None):
+    """Return the metrics in the Prometheus text exposition format.
+
+    common is a dict of labels added to every series (e.g. to tell sessions
+    apart).
+    """
+    common = tuple(sorted((common or {}).items()))
+    out = []
+    values = allCounters()
+    done = set()
+    for (name, labels) in sorted(values):
+        if name not in done:
+            done.add(name)
+            if name in HELP:
+                out.append("# HELP {} {}".format(name, HELP[name]))
+            out.append("# TYPE {} counter".format(name))
+        out.append("{} {}".format(_series(name, common + labels), values[(name, labels)]))
+    with lock:
+        series = sorted(samples.items())
+    for (name, labels), s in series:
+        if name not in done:
+            done.add(name)
+            if name in HELP:
+                out.append("# HELP {} {}".format(name, HELP[name]))
+            out.append("# TYPE {} summary".format(name))
+        for q, v in zip(QUANTILES, s.quantiles()):
+            out.append("{} {}".format(_series(name, common + labels, [("quantile", q)]), v))
+        out.append("{} {}".format(_series(name + "_sum", common + labels), s.total))
+        out.append("{} {}".format(_series(name + "_count", common + labels), s.count))
+    return "\n".join(out) + "\n"
+
+def writePrometheus(path, common=None):
+    """Write the metrics to path, replacing it atomically.
+
+    Collectors reading the file never see it half written.
+    """
+    path = os.path.expanduser(path)
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(prometheus(common))
+    os.replace(tmp, path)
@@ -0,0 +1,279 @@
+# Local outbox for outgoing mail.
+#
+# Sending a message over SMTP means connecting, possibly a TLS handshake,
+# logging in, and pushing the message over the wire. Rather than make the user
+# wait in the composer for all of that (or lose the message because the relay
+# is down), the composer drops the finished message into a spool directory and
+# returns to the prompt. A background task then delivers the spool, reusing
+# one SMTP connection for everything queued for the same server, and retries
+# failed messages with an increasing delay. Messages the server refuses
+# outright (a 5xx reply) aren't retried; they are held for the user to fix or
+# drop, as are messages waiting for a password.
+#
+# Each queued message is two files in the spool directory:
+#   ID.msg   the message as it goes on the wire
+#   ID.json  the envelope (sender, recipients), the smtp URL to send through,
+#            and delivery state (attempts, next attempt time, last error)
+#
+# Both are written to a temporary directory first and renamed into place, so
+# a crash never leaves half a message behind. The .json is written last; an
+# entry without one isn't queued yet.
+#
+# Delivery takes an exclusive lock on the .msg file, so that two instances of
+# mailnex sharing a spool don't send the same message twice.
+#
+# Messages that should be saved to a 'record' folder once sent are moved into
+# the 'sent' subdirectory on delivery, where they wait for the upload.
+
+import os
+import json
+import time
+import fcntl
+import itertools
+import tempfile
+from . import smtp
+
+# Delay before the first retry, doubled on each further failure up to
+# RETRY_MAX.
+RETRY_BASE = 60
+RETRY_MAX = 60 * 60
+
+class HoldDelivery(Exception):
+    """Delivery can't proceed without the user (e.g. a password is needed).
+
+    Entries failing with this are held until retried from the outbox command,
+    rather than being retried automatically."""
+    pass
+
+class Outbox(object):
+    """Spool directory of messages waiting to be sent."""
+    def __init__(self, path, debug=False, sessions=None):
+        object.__init__(self)
+        self.path = path
+        self.tmppath = os.sep.join((path, "tmp"))
+        self.sentpath = os.sep.join((path, "sent"))
+        self.debug = debug
+        # smtp.SessionCache to take connections from and return them to, if
+        # any
+        self.sessions = sessions
+        # Passwords given by the user this session, keyed by smtp URL. Kept
+        # only in memory, so background delivery never has to prompt.
+        self.credentials = {}
+        self.counter = itertools.count()
+        # Queued mail is private. makedirs only gives the mode to the
+        # directories it creates last, so make the spool itself first (and
+        # tighten it, should an older version have made it).
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        os.chmod(path, 0o700)
+        os.makedirs(self.tmppath, mode=0o700, exist_ok=True)
+        os.makedirs(self.sentpath, mode=0o700, exist_ok=True)
+    def _write(self, name, data):
+        """Atomically write data to name in the spool.
+
+        data can be bytes or an iterable of bytes. Returns the number of bytes
+        written.
+        """
+        tmpname = os.sep.join((self.tmppath, name))
+        size = 0
+        try:
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                for chunk in smtp.iterChunks(data):
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpname, os.sep.join((self.path, name)))
+        except BaseException:
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            raise
+        return size
+    def _save(self, entry):
+        state = {k: v for k, v in entry.items() if k != 'id'}
+        self._write(entry['id'] + ".json", json.dumps(state).encode('utf-8'))
+    def add(self, sender, recipients, message, url, subject=None, record=None):
+        """Queue a message.
+
+        sender and recipients are the envelope (str), message is the message
+        as bytes, a binary file, or an iterable of bytes, and url is the smtp
+        URL to deliver through. record, if given, is where to save a copy
+        once sent; it's kept in the entry for the caller. Returns the new
+        entry.
+        """
+        id_ = "{:d}.{:d}.{:d}".format(int(time.time() * 1000000), os.getpid(), next(self.counter))
+        entry = {
+                'id': id_,
+                'from': sender,
+                'to': recipients,
+                'smtp': url,
+                'subject': subject,
+                'created': time.time(),
+                'size': 0,
+                'attempts': 0,
+                'next': 0,
+                'error': None,
+                'held': False,
+                'record': record,
+                }
+        entry['size'] = self._write(id_ + ".msg", message)
+        self._save(entry)
+        return entry
+    def entries(self):
+        """Return the list of queued entries, oldest first"""
+        res = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return res
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.sep.join((self.path, name)), "rb") as f:
+                    entry = json.loads(f.read().decode('utf-8'))
+            except (OSError, ValueError):
+                # Probably just got delivered by someone else
+                continue
+            entry['id'] = name[:-5]
+            res.append(entry)
+        res.sort(key=lambda e: e['created'])
+        return res
+    def __len__(self):
+        return len(self.entries())
+    def due(self, now=None):
+        """Return the entries that should be attempted now"""
+        if now is None:
+            now = time.time()
+        return [e for e in self.entries() if not e['held'] and e['next'] <= now]
+    def nextDue(self, now=None):
+        """Seconds until an entry is due, 0 if one is due now, or None if nothing is waiting"""
+        if now is None:
+            now = time.time()
+        times = [e['next'] for e in self.entries() if not e['held']]
+        if not times:
+            return None
+        return max(0, min(times) - now)
+    def remove(self, entry):
+        """Drop an entry from the queue"""
+        # The .json goes first, so that the entry stops being visible before
+        # its message does.
+        for ext in (".json", ".msg"):
+            try:
+                os.unlink(os.sep.join((self.path, entry['id'] + ext)))
+            except FileNotFoundError:
+                pass
+    def newSentCopy(self):
+        """Create a file for holding a sent message until it's saved to the record folder"""
+        return tempfile.NamedTemporaryFile(dir=self.sentpath, suffix=".msg", delete=False)
+    def retry(self, entry):
+        """Make an entry due now, releasing it if held"""
+        entry['held'] = False
+        entry['next'] = 0
+        self._save(entry)
+    def _failed(self, entry, error, hold=False):
+        entry['attempts'] += 1
+        entry['error'] = error
+        entry['held'] = hold
+        entry['next'] = time.time() + min(RETRY_MAX, RETRY_BASE * 2 ** (entry['attempts'] - 1))
+        self._save(entry)
+    def deliver(self, connect):
+        """Attempt delivery of all due entries.
+
+        Blocks; meant to be run outside the event loop. connect(url) must
+        return a connected and logged in smtpClient for the given URL, or
+        raise. Connections are reused for all entries going to the same URL.
+        When done, they go back to the session cache, or are closed if there
+        isn't one.
+
+        Returns a list of (entry, error) tuples, where error is None for
+        delivered messages. Delivered entries with a 'record' have their
+        message moved to the file named by their 'sentCopy'.
+        """
+        results = []
+        clients = {}
+        # URLs we couldn't connect to this round, and why
+        failed = {}
+        try:
+            for entry in self.due():
+                url = entry['smtp']
+                try:
+                    f = open(os.sep.join((self.path, entry['id'] + ".msg")), "rb")
+                except FileNotFoundError:
+                    # Delivered or dropped since we looked
+                    continue
+                with f:
+                    try:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        # Someone else is sending it
+                        continue
+                    if not os.path.exists(os.sep.join((self.path, entry['id'] + ".json"))):
+                        # ...and already finished
+                        continue
+                    if url in failed:
+                        ev = failed[url]
+                        self._failed(entry, str(ev), isinstance(ev, HoldDelivery))
+                        results.append((entry, ev))
+                        continue
+                    try:
+                        client = clients.get(url)
+                        if client is None or client.state == smtp.DISCONNECTED:
+                            clients.pop(url, None)
+                            client = self.sessions.take(url) if self.sessions is not None else None
+                            if client is None:
+                                client = connect(url)
+                            clients[url] = client
+                    except Exception as ev:
+                        failed[url] = ev
+                        self._failed(entry, str(ev), isinstance(ev, HoldDelivery))
+                        results.append((entry, ev))
+                        continue
+                    try:
+                        sender = entry['from'].encode('ascii')
+                        recipients = [x.encode('ascii') for x in entry['to']]
+                    except UnicodeEncodeError as ev:
+                        # Would fail the same way every time; nothing was
+                        # sent, so the client is fine.
+                        ev = HoldDelivery("address isn't ASCII ({}); use 'outbox drop' and send it again".format(ev))
+                        self._failed(entry, str(ev), True)
+                        results.append((entry, ev))
+                        continue
+                    try:
+                        client.sendmail(sender, recipients, f)
+                    except smtp.Refused as ev:
+                        # The connection is still usable (sendmail hangs up
+                        # itself when it isn't). A permanent refusal would
+                        # only be refused again; hold the message for the
+                        # user to fix or drop.
+                        if ev.permanent:
+                            ev = HoldDelivery("refused by the server: {}; use 'outbox drop' or 'outbox retry'".format(ev))
+                        self._failed(entry, str(ev), isinstance(ev, HoldDelivery))
+                        results.append((entry, ev))
+                        continue
+                    except Exception as ev:
+                        # Anything else may have left the link broken. Start
+                        # afresh for the next message.
+                        client.close()
+                        self._failed(entry, str(ev))
+                        results.append((entry, ev))
+                        continue
+                    if entry.get('record'):
+                        entry['sentCopy'] = os.sep.join((self.sentpath, entry['id'] + ".msg"))
+                        os.rename(os.sep.join((self.path, entry['id'] + ".msg")), entry['sentCopy'])
+                    self.remove(entry)
+                    results.append((entry, None))
+        finally:
+            for url, client in clients.items():
+                if client.state == smtp.DISCONNECTED:
+                    continue
+                if self.sessions is not None:
+                    self.sessions.put(url, client)
+                    continue
+                try:
+                    client.quit()
+                except Exception:
+                    client.close()
+        return results
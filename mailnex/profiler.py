@@ -0,0 +1,125 @@
+# Per-command profiling.
+#
+# Every command run from the prompt is timed, along with what it cost on the
+# IMAP side (round trips, time waiting for the server, bytes each way) and
+# time spent parsing IMAP responses. Whatever is left of the wall time went
+# into our own processing, rendering, and the terminal. Connections used by
+# background tasks (see imappool.BACKGROUND) aren't counted, as their work
+# isn't the command's, even though it happens meanwhile.
+#
+# Only running totals and a latency histogram are kept per command, so this
+# is cheap enough to leave on for the whole session.
+
+import time
+from . import imap4
+
+# Seconds spent in processImapData, over the whole session. The parser adds
+# to this directly.
+parseTime = 0.0
+
+# Upper bounds of the latency histogram buckets, in milliseconds. Anything
+# slower lands in a final overflow bucket.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+def snapshot():
+    """Return the current values of the counters a command is charged for"""
+    return (
+            time.perf_counter(),
+            parseTime,
+            imap4.imap4ClientConnection.foregroundWait,
+            imap4.imap4ClientConnection.foregroundRoundTrips,
+            imap4.imap4ClientConnection.foregroundIn,
+            imap4.imap4ClientConnection.foregroundOut,
+            )
+
+class CommandStats(object):
+    """Running totals for one command"""
+    __slots__ = ('count', 'wall', 'worst', 'parse', 'wait', 'roundTrips', 'bytesIn', 'bytesOut', 'buckets')
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.worst = 0.0
+        self.parse = 0.0
+        self.wait = 0.0
+        self.roundTrips = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+class Profiler(object):
+    """Collects CommandStats for each command run this session"""
+    def __init__(self):
+        object.__init__(self)
+        self.commands = {}
+        self.last = None
+    def record(self, command, before):
+        """Charge the cost since snapshot 'before' to command.
+
+        Returns the deltas (wall, parse, wait, round trips, bytes in, bytes
+        out).
+        """
+        after = snapshot()
+        delta = tuple(a - b for a, b in zip(after, before))
+        wall, parse, wait, roundTrips, bytesIn, bytesOut = delta
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.count += 1
+        stats.wall += wall
+        stats.worst = max(stats.worst, wall)
+        stats.parse += parse
+        stats.wait += wait
+        stats.roundTrips += roundTrips
+        stats.bytesIn += bytesIn
+        stats.bytesOut += bytesOut
+        ms = wall * 1000
+        for i, bound in enumerate(BUCKETS):
+            if ms < bound:
+                stats.buckets[i] += 1
+                break
+        else:
+            stats.buckets[-1] += 1
+        self.last = (command, delta)
+        return delta
+    def report(self, command=None, width=40):
+        """Return lines describing the session's commands.
+
+        Ends with a latency histogram of the given command, or of all
+        commands together.
+        """
+        lines = []
+        lines.append("{:12} {:>5} {:>9} {:>9} {:>8} {:>8} {:>8} {:>6} {:>9} {:>9}".format(
+            "command", "runs", "avg ms", "max ms", "server", "parse", "other", "trips", "in", "out"))
+        for name in sorted(self.commands):
+            if command is not None and name != command:
+                continue
+            s = self.commands[name]
+            other = s.wall - s.wait - s.parse
+            lines.append("{:12} {:5} {:9.1f} {:9.1f} {:7.0f}% {:7.0f}% {:7.0f}% {:6} {:9} {:9}".format(
+                name,
+                s.count,
+                s.wall * 1000 / s.count,
+                s.worst * 1000,
+                100 * s.wait / s.wall if s.wall else 0,
+                100 * s.parse / s.wall if s.wall else 0,
+                100 * other / s.wall if s.wall else 0,
+                s.roundTrips,
+                s.bytesIn,
+                s.bytesOut,
+                ))
+        if command is None:
+            buckets = [sum(x) for x in zip(*(s.buckets for s in self.commands.values()))]
+        elif command in self.commands:
+            buckets = self.commands[command].buckets
+        else:
+            buckets = None
+        if buckets:
+            most = max(buckets)
+            lines.append("")
+            labels = ["<{}ms".format(b) for b in BUCKETS] + [">={}ms".format(BUCKETS[-1])]
+            for label, count in zip(labels, buckets):
+                if count == 0:
+                    continue
+                bar = "#" * max(1, count * width // most)
+                lines.append("{:>9} {:5} {}".format(label, count, bar))
+        return lines
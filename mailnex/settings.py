@@ -26,6 +26,8 @@ class Options(object):
     def __init__(self):
         object.__init__(self)
         self.options = {}
+        # Functions to call when an option changes, by option name
+        self.watchers = {}
     def addOption(self, opt):
         assert isinstance(opt, Option)
         assert opt.name not in self.options, "An option already exists by that name"
@@ -46,6 +48,19 @@ class Options(object):
         if not key in self.options:
             raise KeyError("No option named %s" % key)
         self.options[key].setValue(value)
+        self.notify(key)
+    def watch(self, name, func):
+        """Call func(option) whenever the named option is set or reset"""
+        self.watchers.setdefault(name, []).append(func)
+    def notify(self, name):
+        """Tell watchers of the named option that it changed"""
+        for func in self.watchers.get(name, ()):
+            func(self.options[name])
+    def reset(self, name):
+        """Return the named option to its default value"""
+        opt = self.options[name]
+        opt.value = opt.default
+        self.notify(name)
     def __getattr__(self, name):
         # handle x.y syntax
         if name in self.options:
@@ -119,7 +134,7 @@ class NumericOption(Option):
         return str(self.value)
     def setValue(self, value):
         # Ensure value is an integer
-        if not isinstance(value, (int, long)):
+        if not isinstance(value, int):
             # TODO: Wrap in a nicer try/except block?
             # TODO: Error if it was a float that got truncated?
             value = int(value, 0)
@@ -2,10 +2,40 @@
 # In particular, the python-2 version didn't appear to provide any facilities
 # for validating a server when using TLS (it accepted any certificate for
 # anybody applied to any server, including self-signed certs).
+#
+# Extensions we make use of when the server has them:
+#   PIPELINING (RFC 2920) - send MAIL, RCPT, and DATA without waiting for each
+#       reply in turn.
+#   CHUNKING (RFC 3030) - send the message body with BDAT in large blocks
+#       instead of DATA, which avoids dot-stuffing and the end-of-data scan on
+#       the server.
 
 import socket
 import ssl
 import codecs
+import re
+import time
+import threading
+from . import metrics
+
+# Size of blocks we send the message body in, and read replies with.
+CHUNK_SIZE = 1024 * 1024
+RECV_SIZE = 4096
+
+re_eol = re.compile(rb'\r?\n')
+
+class Refused(Exception):
+    """The server refused the message (or some of its recipients).
+
+    code is the reply code. The connection is left usable unless the state
+    says otherwise."""
+    def __init__(self, message, code):
+        Exception.__init__(self, message)
+        self.code = code
+    @property
+    def permanent(self):
+        """Whether sending the same message again would be refused again"""
+        return self.code // 100 == 5
 
 def parseExtension(extensions, data):
     """Parses a single line of EHLO response data"""
@@ -19,34 +49,53 @@ def parseExtension(extensions, data):
         args = None
     extensions[name] = args
 
-def parseExtensions(extensions, data):
-    """Parses all lines of EHLO response data"""
-    for line in data.split(b'\r\n'):
-        if len(line) < 3:
-            print("Error:", line)
-            return False
-        if len(line) < 4:
-            # Something is wrong. Should be 3 digit status followed by hyphen
-            # or space. We can conclude the server erroneously sent us a line
-            # with just the 3 byte code.
-            if line[0:1] != b'2':
-                print("Server unhappy:", line)
-                return False
-            break
-        elif line[3:4] == b'-':
-            # Multiline data
-            parseExtension(extensions, line[4:])
-            continue
-        elif line[3:4] == b' ':
-            # Last line
-            parseExtension(extensions, line[4:])
-            if line[0:1] != b'2':
-                print("Server unhappy:", line)
-                return False
-            break
+def iterChunks(message):
+    """Yield the message in blocks.
+
+    message can be bytes, a binary file-like object, or any iterable of bytes.
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        message = bytes(message)
+        for pos in range(0, len(message), CHUNK_SIZE):
+            yield message[pos:pos + CHUNK_SIZE]
+    elif hasattr(message, 'read'):
+        while True:
+            data = message.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    else:
+        for data in message:
+            yield data
+
+def canonicalChunks(chunks, dotstuff):
+    """Convert blocks of message data to CRLF line endings, optionally dot-stuffing.
+
+    Works on whole blocks at a time rather than line by line. Line endings
+    split across blocks are carried over to the next block. The output always
+    ends with CRLF.
+    """
+    atLineStart = True
+    carry = b""
+    for chunk in chunks:
+        chunk = carry + chunk
+        # A trailing CR might be the first half of a CRLF
+        if chunk.endswith(b'\r'):
+            carry = b'\r'
+            chunk = chunk[:-1]
         else:
-            print("Invalid response", line)
-            return False
+            carry = b""
+        if not chunk:
+            continue
+        chunk = re_eol.sub(b'\r\n', chunk)
+        if dotstuff:
+            if atLineStart and chunk.startswith(b'.'):
+                chunk = b'.' + chunk
+            chunk = chunk.replace(b'\n.', b'\n..')
+        atLineStart = chunk.endswith(b'\n')
+        yield chunk
+    if not atLineStart or carry:
+        yield b'\r\n'
 
 # NONE: Do not use TLS
 SEC_NONE = 0
@@ -65,17 +114,35 @@ class smtpClient(object):
         object.__init__(self)
         self.state = DISCONNECTED
         self.cacerts = None
+        self.sock = None
+        self.rbuf = b""
+        self.extensions = {}
+        # Server name, for the session metrics
+        self.host = None
+        # Set to False to keep connection progress off the terminal (e.g.
+        # when sending in the background)
+        self.verbose = True
+    def _context(self):
+        # TODO: Handle older python without the default context, like our
+        # imap lib does (e.g. as on Ubuntu 14.04)
+        if self.cacerts:
+            import os
+            if not os.access(self.cacerts, os.R_OK):
+                print("WARNING: cannot access", self.cacerts)
+            return ssl.create_default_context(cafile=self.cacerts)
+        return ssl.create_default_context()
     def connect(self, host, port=587, secure=SEC_STARTTLS):
         targets = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, 0)
         # TODO: should we iterate through targets in order, randomly, or
         # randomly by address family (that is, try IPv6 first, then IPv4, then
         # whatever is left)?
         for i in targets:
-            print("Trying", i[4][0],i[3]) # address, canonical name (if available)
+            if self.verbose:
+                print("Trying", i[4][0],i[3]) # address, canonical name (if available)
             s = socket.socket(*i[:3])
             if secure == SEC_SSL:
                 oldSock = s
-                s = ssl.SSLSocket(s, ca_certs=self.ca_certs, cert_reqs=ssl.CERT_REQUIRED if self.ca_certs else ssl.CERT_NONE)
+                s = self._context().wrap_socket(s, server_hostname=host)
             else:
                 oldSock = None
             try:
@@ -83,7 +150,8 @@ class smtpClient(object):
                 self._negotiate(s, host, secure)
                 break
             except socket.error as ev:
-                print("Failed, socket error: ", ev.strerror, ev)
+                if self.verbose:
+                    print("Failed, socket error: ", ev.strerror, ev)
                 continue
         else:
             # TODO: Provide some more info. Ideally, we'd have some
@@ -91,18 +159,78 @@ class smtpClient(object):
             # no route, etc.
             # May be difficult due to multiple connection attempts.
             raise Exception("unable to connect")
+    def _send(self, data):
+        metrics.count("smtp_bytes_sent_total", len(data), server=self.host)
+        self.sock.sendall(data)
+    def _readLine(self):
+        """Read one reply line (without the line ending)"""
+        while True:
+            pos = self.rbuf.find(b'\n')
+            if pos != -1:
+                line = self.rbuf[:pos]
+                self.rbuf = self.rbuf[pos + 1:]
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                return line
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise Exception("Server closed the connection")
+            metrics.count("smtp_bytes_received_total", len(data), server=self.host)
+            self.rbuf += data
+    def _getReply(self):
+        """Read a complete, possibly multi-line, reply.
+
+        Returns the reply code as an int and the list of text lines (with the
+        code and separator removed).
+        """
+        lines = []
+        while True:
+            line = self._readLine()
+            if len(line) < 3 or not line[0:3].isdigit():
+                raise Exception("Invalid response {}".format(line))
+            lines.append(line[4:])
+            # Continuation lines have a hyphen after the code; the last line
+            # has a space (or nothing at all from some sloppy servers)
+            if line[3:4] != b'-':
+                return int(line[0:3]), lines
+    def _counted(self, cmd):
+        """Count a command in the session metrics, returning its name"""
+        name = cmd.split(b" ", 1)[0].split(b":", 1)[0].upper().decode("ascii", "replace")
+        if name == ".":
+            name = "END-DATA"
+        metrics.count("smtp_commands_total", command=name, server=self.host)
+        return name
+    def _command(self, cmd):
+        """Send a command and return its reply"""
+        name = self._counted(cmd)
+        start = time.perf_counter()
+        self._send(cmd + b"\r\n")
+        reply = self._getReply()
+        metrics.observe("smtp_response_seconds", time.perf_counter() - start, command=name, server=self.host)
+        return reply
+    def _ehlo(self, s, myhostname):
+        code, lines = self._command(b"EHLO %s" % (myhostname.encode()))
+        if code // 100 != 2:
+            print("Server unhappy:", code, lines)
+            return False
+        # The first line is the server greeting us; the rest are extensions
+        extensions = {}
+        for line in lines[1:]:
+            parseExtension(extensions, line)
+        return extensions
     def _negotiate(self, s, host, security):
-        r = s.recv(1024)
-        if not r.startswith(b"2"):
-            raise Exception("Server unhappy: {}".format(r))
+        self.sock = s
+        self.rbuf = b""
+        self.host = host
+        metrics.count("smtp_connects_total", server=host)
+        code, lines = self._getReply()
+        if code // 100 != 2:
+            raise Exception("Server unhappy: {} {}".format(code, lines))
         # TODO: Check if hostname isn't fqdn; warn user? fail?
         #myhostname=socket.gethostname()
         myhostname="ehlo.thunderbird.net" # K9 mail uses this
-        s.send(b"EHLO %s\r\n"%(myhostname.encode()))
-        r = s.recv(1024)
-        extensions = {}
-        r = parseExtensions(extensions, r)
-        if r == False:
+        extensions = self._ehlo(s, myhostname)
+        if extensions == False:
             raise Exception("Failed to parse extensions")
         if security == SEC_STARTTLS :
             if 'STARTTLS' not in extensions:
@@ -110,29 +238,20 @@ class smtpClient(object):
                 # attack attempt and we might get through, or it could be a
                 # misconfigured proxy, and the command might also get through
                 raise Exception("Server reports no TLS capability")
-            s.send(b"STARTTLS\r\n")
-            r = s.recv(1024)
-            if r[0:1] != b"2":
-                raise Exception("Failed to start TLS: {}".format(r))
+            code, lines = self._command(b"STARTTLS")
+            if code // 100 != 2:
+                raise Exception("Failed to start TLS: {} {}".format(code, lines))
+            if self.rbuf:
+                # Anything received before the handshake was sent in the clear
+                # and could have been injected by someone in the middle.
+                raise Exception("Unexpected data from server before TLS")
             oldSock = s
-            # TODO: Handle older python without the default context, like our
-            # imap lib does (e.g. as on Ubuntu 14.04)
-            if self.cacerts:
-                import os
-                if not os.access(self.cacerts, os.R_OK):
-                    print("WARNING: cannot access", self.cacerts)
-                context = ssl.create_default_context(cafile=self.cacerts)
-            else:
-                context = ssl.create_default_context()
-            s = context.wrap_socket(s, server_hostname=host)
+            s = self._context().wrap_socket(s, server_hostname=host)
+            self.sock = s
             # Now that we are secure, re-get extensions
-            s.send(b"EHLO %s\r\n"%(myhostname.encode()))
-            r = s.recv(1024)
-            extensions = {}
-            r = parseExtensions(extensions, r)
-            if r == False:
+            extensions = self._ehlo(s, myhostname)
+            if extensions == False:
                 raise Exception("Failed to parse extensions after STARTTLS")
-        self.sock = s
         self.extensions = extensions
         self.state = CONNECTED
         # Notes:
@@ -142,49 +261,196 @@ class smtpClient(object):
         # I don't know how to get from the peer to the CA (a la Firefox or
         # Chrome's cert chain view)
     def login(self, username, password):
-        s = self.sock
         if 'AUTH' in self.extensions and 'PLAIN' in self.extensions['AUTH']:
-            authstr = b"AUTH PLAIN %s\r\n"%(codecs.encode("{}\x00{}\x00{}".format(username, username, password).encode(), 'base64')).replace(b'\n',b'')
-            s.send(authstr)
-            r = s.recv(1024)
-            if r[0:1] != b'2':
-                print("failed", r)
+            authstr = b"AUTH PLAIN %s"%(codecs.encode("{}\x00{}\x00{}".format(username, username, password).encode(), 'base64')).replace(b'\n',b'')
+            code, lines = self._command(authstr)
+            if code // 100 != 2:
+                print("failed", code, lines)
                 return False
             self.state = AUTENTICATED
         else:
             raise Exception("No auth")
     def sendmail(self, from_, to, message):
+        """Send a message.
+
+        from_ and to are the envelope sender (bytes) and list of recipients
+        (bytes). message can be bytes, a binary file-like object, or an
+        iterable of bytes blocks; it is sent as it is read, and line endings
+        are converted to CRLF.
+
+        Raises an exception on failure. If any recipients are refused, none
+        are sent to, and the exception lists all of the refused recipients.
+        """
         # TODO: some basic validation of from and to
-        s = self.sock
-        s.send(b"MAIL FROM:<%s>\r\n"%(from_))
-        r = s.recv(1024)
-        if r[0:1] != b'2': raise Exception("bad from line: {}".format(r))
+        pipelining = 'PIPELINING' in self.extensions
+        chunking = 'CHUNKING' in self.extensions
+        cmds = [b"MAIL FROM:<%s>" % (from_)]
         for i in to:
-            s.send(b"RCPT TO:<%s>\r\n"%(i))
-            r = s.recv(1024)
-            # TODO: Collect failed recipients into a list to give caller.
-            # If we fail on the first, the user can get frustrated correcting
-            # 1 mistake at a time instead of correcting multiple at once
-            if r[0:1] != b'2': raise Exception("bad to: {}, {}".format(i, r))
-        s.send(b"DATA\r\n")
-        r = s.recv(1024)
-        if not r.startswith(b'354'): raise Exception("Unexpected {}".format(r))
-        # TODO: normalize line endings?
-        # TODO: correct line length?
-        for line in message.split(b'\n'):
-            if line.endswith(b'\r'):
-                line = line[:-1]
-            if line.startswith(b"."):
-                line = b'.' + line
-            s.send(line + b'\r\n')
-        s.send(b'.\r\n') # terminate message
-        r = s.recv(1024)
-        if r[0:1] != b'2': raise Exception("Failed to send data: {}".format(r))
+            cmds.append(b"RCPT TO:<%s>" % (i))
+        if not chunking:
+            cmds.append(b"DATA")
+        if pipelining:
+            # The replies come back together; each command is charged the
+            # time until its own reply arrived.
+            names = [self._counted(cmd) for cmd in cmds]
+            start = time.perf_counter()
+            self._send(b"".join(cmd + b"\r\n" for cmd in cmds))
+            replies = []
+            for name in names:
+                replies.append(self._getReply())
+                metrics.observe("smtp_response_seconds", time.perf_counter() - start, command=name, server=self.host)
+        else:
+            replies = []
+            for cmd in cmds:
+                if cmd == b"DATA" and any(code // 100 != 2 for code, lines in replies):
+                    # A recipient was refused; stop before DATA so that RSET
+                    # (below) leaves the session usable for the next message.
+                    break
+                replies.append(self._command(cmd))
+                if replies[-1][0] // 100 != 2 and cmd.startswith(b"MAIL"):
+                    # No point in trying the rest
+                    break
+        error = None
+        code, lines = replies[0]
+        if code // 100 != 2:
+            error = "bad from line: {} {}".format(code, lines)
+            errorCode = code
+        else:
+            badto = []
+            # Temporary if any recipient might be accepted on a retry
+            errorCode = 599
+            for i, (code, lines) in zip(to, replies[1:len(to) + 1]):
+                if code // 100 != 2:
+                    badto.append("{}, {} {}".format(i, code, lines))
+                    errorCode = min(errorCode, code)
+            if badto:
+                error = "bad to: {}".format("; ".join(badto))
+        if not chunking and len(replies) == len(cmds) and replies[-1][0] == 354:
+            if error:
+                # The server is waiting for the message even though we aren't
+                # going to send it (this only happens with PIPELINING, when
+                # some recipients were refused). Ending the data would deliver
+                # an empty message to the others, so hang up instead.
+                self.close()
+                raise Refused(error, errorCode)
+        elif error:
+            self.rset()
+            raise Refused(error, errorCode)
+        elif not chunking:
+            code, lines = replies[-1]
+            raise Exception("Unexpected {} {}".format(code, lines))
+
+        if chunking:
+            self._sendBdat(canonicalChunks(iterChunks(message), dotstuff=False))
+        else:
+            for chunk in canonicalChunks(iterChunks(message), dotstuff=True):
+                self._send(chunk)
+            code, lines = self._command(b'.') # terminate message
+            if code // 100 != 2: raise Refused("Failed to send data: {} {}".format(code, lines), code)
+        metrics.count("smtp_messages_total", server=self.host)
+    def _sendBdat(self, chunks):
+        """Send the message body with BDAT, CHUNK_SIZE at a time"""
+        pending = []
+        pendingLen = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            pendingLen += len(chunk)
+            if pendingLen >= CHUNK_SIZE:
+                data = b"".join(pending)
+                self._counted(b"BDAT")
+                self._send(b"BDAT %d\r\n" % len(data))
+                self._send(data)
+                code, lines = self._getReply()
+                if code // 100 != 2: raise Exception("Failed to send data: {} {}".format(code, lines))
+                pending = []
+                pendingLen = 0
+        data = b"".join(pending)
+        self._counted(b"BDAT")
+        self._send(b"BDAT %d LAST\r\n" % len(data))
+        self._send(data)
+        code, lines = self._getReply()
+        if code // 100 != 2: raise Refused("Failed to send data: {} {}".format(code, lines), code)
+    def rset(self):
+        """Abort the current transaction, leaving the connection usable"""
+        code, lines = self._command(b"RSET")
+        if code // 100 != 2: raise Exception("Failed to reset: {} {}".format(code, lines))
     def quit(self):
-        s = self.sock
-        s.send(b"QUIT\r\n")
-        r = s.recv(1024)
-        if r[0:1] != b'2': raise Exception("Failed to quit: {}".format(r))
+        code, lines = self._command(b"QUIT")
+        if code // 100 != 2: raise Exception("Failed to quit: {} {}".format(code, lines))
+        self.close()
+        return
+    def close(self):
+        """Drop the connection without saying goodbye"""
+        if self.sock:
+            self.sock.close()
         self.sock = None
+        self.rbuf = b""
         self.state = DISCONNECTED
-        return
+
+class SessionCache(object):
+    """Logged in SMTP sessions kept open for the next message, keyed by URL.
+
+    Sessions are taken out while in use and put back afterwards, so a session
+    is only ever used by one sender (or thread) at a time. Sessions unused for
+    longer than 'idle' seconds are closed by expire().
+    """
+    def __init__(self, idle=120):
+        object.__init__(self)
+        self.idle = idle
+        # URL -> (client, time last used)
+        self.sessions = {}
+        self.lock = threading.Lock()
+    def take(self, url):
+        """Return a live session for url, or None.
+
+        The session is RSET before being handed out, which also checks that
+        the server is still there.
+        """
+        with self.lock:
+            item = self.sessions.pop(url, None)
+        if item is None:
+            return None
+        client, lastUsed = item
+        if time.time() - lastUsed > self.idle:
+            self._close(client)
+            return None
+        try:
+            client.rset()
+        except Exception:
+            client.close()
+            return None
+        metrics.count("smtp_sessions_reused_total", server=client.host)
+        return client
+    def put(self, url, client):
+        """Keep a session for reuse (or close it if we aren't keeping any)"""
+        if client.state == DISCONNECTED:
+            return
+        if self.idle <= 0:
+            self._close(client)
+            return
+        with self.lock:
+            old = self.sessions.pop(url, None)
+            self.sessions[url] = (client, time.time())
+        if old:
+            self._close(old[0])
+    def expire(self):
+        """Close sessions that have been unused for too long"""
+        now = time.time()
+        with self.lock:
+            stale = [url for url, (client, lastUsed) in self.sessions.items() if now - lastUsed > self.idle]
+            clients = [self.sessions.pop(url)[0] for url in stale]
+        for client in clients:
+            self._close(client)
+    def closeAll(self):
+        with self.lock:
+            clients = [client for client, lastUsed in self.sessions.values()]
+            self.sessions = {}
+        for client in clients:
+            self._close(client)
+    def __len__(self):
+        return len(self.sessions)
+    def _close(self, client):
+        try:
+            client.quit()
+        except Exception:
+            client.close()
@@ -0,0 +1,69 @@
+# Debug tracing.
+#
+# Testing the debug setting directly (settings.debug.parse) goes through
+# Options.__getattr__, a dict lookup, and FlagsOption.__getattr__ searching
+# the flag list. That's fine for a one-off, but not in the IMAP parser, which
+# checks once per character.
+#
+# Instead, each trace category is a plain module global here, rebound by
+# configure() whenever the debug setting changes. With tracing off, a check
+# costs one global lookup:
+#
+#     from . import trace
+#     if trace.parse:
+#         trace.event("parse", "start list", depth=len(lset))
+#
+# Anything expensive to compute for the event belongs inside the check.
+#
+# Events normally go to the terminal. setFile() sends them to a file instead,
+# so that they don't interleave with the program's own output.
+
+import os
+import sys
+import time
+
+# Categories, and whether they are being traced
+parse = False
+imap = False
+cache = False
+general = False
+CATEGORIES = ("cache", "general", "imap", "parse")
+
+# Where events go; None for stdout
+_file = None
+
+def configure(flags):
+    """Turn categories on or off to match a list of debug flags.
+
+    Flags that aren't trace categories are ignored.
+    """
+    module = sys.modules[__name__]
+    for name in CATEGORIES:
+        setattr(module, name, name in flags)
+
+def setFile(path):
+    """Send events to the named file (appending), or back to the terminal if path is empty"""
+    global _file
+    if _file is not None:
+        _file.close()
+        _file = None
+    if path:
+        try:
+            _file = open(os.path.expanduser(path), "a", buffering=1)
+        except OSError as ev:
+            print("Can't open trace file; tracing to the terminal:", ev)
+
+def event(category, *args, **fields):
+    """Emit a trace event.
+
+    args are joined as by print; fields are appended as name=value pairs.
+    Callers should check the category flag before calling.
+    """
+    parts = ["{:.6f}".format(time.time()), category]
+    parts.extend(str(a) for a in args)
+    parts.extend("{}={!r}".format(k, v) for k, v in fields.items())
+    line = " ".join(parts)
+    if _file is None:
+        print(line)
+    else:
+        _file.write(line + "\n")
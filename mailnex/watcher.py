@@ -0,0 +1,78 @@
+# Counts of unread and new messages in folders other than the open one.
+#
+# Only the selected folder tells us about new mail (EXISTS while idling), so
+# mail that filters deliver into other folders went unnoticed until we went
+# and looked. The folders in the 'watchfolders' setting are watched over a
+# pooled background connection instead, and their counts shown in the
+# toolbar.
+#
+# How depends on the server. With NOTIFY (RFC 5465), the server tells us
+# when something changes, as untagged STATUS responses, and we only ask for
+# the counts it leaves out. Otherwise we poll: the status of every watched
+# folder in one round trip, with LIST-STATUS (RFC 5819) if the server has
+# it, else pipelined STATUS commands.
+#
+# Polling backs off while nothing changes, doubling the interval up to
+# MAX_BACKOFF times the 'watchinterval' setting, and drops back as soon as
+# something does, so that a quiet mailbox costs the server little and a busy
+# one is still followed closely.
+#
+# This module only keeps the counts; the connection is looked after by
+# mailnex's watchRunner.
+
+# What we ask the server for each folder
+ITEMS = b"MESSAGES UNSEEN RECENT"
+
+# Most the poll interval grows to, as a multiple of the base interval
+MAX_BACKOFF = 8
+
+class FolderWatcher(object):
+    """Counts of the watched folders of an account"""
+    def __init__(self, key, boxes, interval=60):
+        object.__init__(self)
+        # Account (as imappool.accountKey) and the mailbox names watched
+        self.key = key
+        self.boxes = list(boxes)
+        # Base and current seconds between polls
+        self.interval = interval
+        self.delay = interval
+        # Mailbox -> {item: value}, as from STATUS
+        self.counts = {}
+        # Mailboxes whose counts are incomplete (e.g. NOTIFY only said how
+        # many messages there are now) and should be asked for
+        self.stale = set()
+    def update(self, box, values):
+        """Merge the items of a STATUS response for box.
+
+        Returns True if any count changed. Boxes we aren't watching are
+        ignored.
+        """
+        if box not in self.boxes:
+            return False
+        old = self.counts.get(box, {})
+        new = dict(old)
+        new.update(values)
+        self.counts[box] = new
+        if b'UNSEEN' in values and b'RECENT' in values:
+            self.stale.discard(box)
+        elif new != old or not old:
+            # Something happened that the server didn't give the counts for
+            self.stale.add(box)
+        return new != old
+    def polled(self, results):
+        """Merge the results of a poll, and work out when to poll next"""
+        changed = [self.update(box, values) for box, values in results.items()]
+        if any(changed):
+            self.delay = self.interval
+        else:
+            self.delay = min(self.delay * 2, self.interval * MAX_BACKOFF)
+        return any(changed)
+    def toolbar(self):
+        """Return (box, unread, new) for each watched box we have counts for"""
+        res = []
+        for box in self.boxes:
+            values = self.counts.get(box)
+            if values is None or b'UNSEEN' not in values:
+                continue
+            res.append((box, values[b'UNSEEN'], values.get(b'RECENT', 0)))
+        return res